@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 # Author: djosix
 # License: MIT
-# Description: A simple web file manager written in Python using FastAPI
+# Description: A simple web file manager written in Python using Starlette (or FastAPI)
 
 # autopep8 --max-line-length 130 -i `which webdir`
 
+from __future__ import annotations
+
 import json
 import re
 import os
@@ -12,16 +14,42 @@ import sys
 import random
 import string
 import enum
+import errno
+import hmac
+import time
 import base64
+import hashlib
+import secrets
 import traceback
 import textwrap
 import getpass
+import functools
+import tempfile
+import mmap
+import threading
+import signal
+from array import array
+from stat import S_IMODE, S_ISDIR, S_ISREG
 from datetime import datetime, timedelta, timezone
-from typing import NamedTuple, Union, Optional
+from typing import TYPE_CHECKING, NamedTuple, Union, Optional
 from argparse import ArgumentParser
-from contextlib import suppress
+from collections import OrderedDict
+from contextlib import suppress, asynccontextmanager, contextmanager, nullcontext
 from dataclasses import dataclass
 from urllib.parse import quote as urlquote
+from html import escape as html_escape
+from http.cookies import SimpleCookie
+
+if TYPE_CHECKING:
+    # imported where used, so they stay off the startup path; the starlette names are bound at runtime by
+    # import_web_packages(), these only let tooling resolve them
+    import sqlite3
+    from fastapi import FastAPI
+    from starlette.exceptions import HTTPException
+    from starlette.requests import Request
+    from starlette.responses import (Response, FileResponse, RedirectResponse, JSONResponse, HTMLResponse,
+                                     PlainTextResponse, StreamingResponse)
+    from starlette.concurrency import run_in_threadpool
 
 
 def exit_with_package_import_error(e: ImportError):
@@ -30,7 +58,6 @@ def exit_with_package_import_error(e: ImportError):
         'fastapi',
         'uvicorn',
         'cryptography',
-        'markupsafe',
         'python-multipart'
     ]
     print(traceback.format_exc())
@@ -39,19 +66,22 @@ def exit_with_package_import_error(e: ImportError):
     sys.exit(1)
 
 
-try:
-    import uvicorn
-    import multipart as _
-    from fastapi import FastAPI, HTTPException, Request, Depends
-    from fastapi.security import HTTPBasic, HTTPBasicCredentials
-    from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, HTMLResponse, PlainTextResponse
-    from markupsafe import escape
-except ImportError as e:
-    exit_with_package_import_error(e)
+def import_web_packages():
+    # Deferred until an app is built, so --help and the command line helpers start quickly
+    global HTTPException, Request, Response, FileResponse, RedirectResponse, JSONResponse, HTMLResponse, \
+        PlainTextResponse, StreamingResponse, run_in_threadpool
+    try:
+        from starlette.exceptions import HTTPException
+        from starlette.requests import Request
+        from starlette.responses import (Response, FileResponse, RedirectResponse, JSONResponse, HTMLResponse,
+                                         PlainTextResponse, StreamingResponse)
+        from starlette.concurrency import run_in_threadpool
+    except ImportError as e:
+        exit_with_package_import_error(e)
 
 
 class Constant:
-    STYLE = textwrap.dedent('''
+    STYLE = '''
     * {
         font-family: monospace;
     }
@@ -155,6 +185,11 @@ class Constant:
     .table-row {
         height: 24px;
     }
+
+    .browse {
+        margin-left: 8px;
+        font-size: small;
+    }
     
     input.table-row-checkbox-all, input.table-row-checkbox {
         width: 16px;
@@ -198,9 +233,9 @@ class Constant:
         0% { transform: rotate(0deg); }
         100% { transform: rotate(360deg); }
     }
-    ''')
+    '''
 
-    SCRIPT = textwrap.dedent('''
+    SCRIPT = '''
     function refreshFilterResult(filterRegex) {
         let regex;
         try {
@@ -219,11 +254,42 @@ class Constant:
         refreshCheckboxState(null);
     }
 
-    document.querySelector('input.name-filter').addEventListener('input', function (e) {
+    // rows are hidden as you type while that stays cheap, Enter filters on the server
+    const LIVE_FILTER_MAX_ROWS = 5000;
+    const filterInput = document.querySelector('input.name-filter');
+    const rowCount = document.querySelectorAll('.table-row').length;
+
+    filterInput.addEventListener('input', function (e) {
+        e.preventDefault();
+        if (rowCount <= LIVE_FILTER_MAX_ROWS) {
+            refreshFilterResult(e.target.value);
+        }
+    });
+
+    filterInput.addEventListener('keydown', function (e) {
+        if (e.key !== 'Enter') {
+            return;
+        }
         e.preventDefault();
-        refreshFilterResult(e.target.value);
+        const params = new URLSearchParams(location.search);
+        if (e.target.value) {
+            params.set('filter', e.target.value);
+        } else {
+            params.delete('filter');
+        }
+        location.search = params.toString();
     });
 
+    function bulkSelection() {
+        // everything the server listed is selected and the page hides nothing: send what it filtered by, not the names
+        const checkboxAll = document.querySelector('input.table-row-checkbox-all');
+        if (!checkboxAll.checked || filterInput.value !== (listingQuery.filter || '')) {
+            return null;
+        }
+        const fields = Object.entries(listingQuery);
+        return fields.length ? fields : [['glob', '*']];
+    }
+
     function refreshButtons() {
         const checkboxes = [...document.querySelectorAll('input.table-row-checkbox')];
         const selected = checkboxes.filter(el => el.checked);
@@ -231,6 +297,12 @@ class Constant:
         const newFolderButton = document.querySelector('button#newfolder');
         const deleteButton = document.querySelector('button#delete');
         const moveButton = document.querySelector('button#move');
+        const checksumButton = document.querySelector('button#checksum');
+        if (selected.length > 0) {
+            checksumButton?.removeAttribute('disabled');
+        } else {
+            checksumButton?.setAttribute('disabled', '');
+        }
         if (!modifiable || selected.length > 1 ||
             (selected.length === 0 && !writable) ||
             (selected.length === 1 && !selected[0].getAttribute('data-entry-perm').includes('W')))
@@ -309,36 +381,33 @@ class Constant:
         });
     });
 
-    function refreshTableRowOrder(criterion, sign) {
-        criterion ||= x => x.getAttribute('data-sort-order');
-        sign = Math.sign(sign || 1);
-        let table = document.querySelector('table.table');
-        let rows = [...table.querySelectorAll('.table-row')];
-        console.log(rows);
-        rows.sort((a, b) => (criterion(a) > criterion(b) ? sign : -sign));
-        for (let el of rows) {
-            el.remove();
-            table.appendChild(el);
-        }
-    }
-
     function createUploadForm(action = '') {
-        let form = createHiddenForm(action, 'post');
+        const selected = [...document.querySelectorAll('input.table-row-checkbox')].filter(el => el.checked);
+        const target = selected.length === 1 ? selected[0].getAttribute('data-entry-name') : '.';
+
+        // action and target in the query let the server refuse the upload before reading the files
+        let form = createHiddenForm(action + '?' + new URLSearchParams({ action: 'upload', target }), 'post');
         form.setAttribute('enctype', 'multipart/form-data');
 
         form.appendChild(createHiddenInput('action', 'upload'));
-
-        const selected = [...document.querySelectorAll('input.table-row-checkbox')].filter(el => el.checked);
-        const target = selected.length === 1 ? selected[0].getAttribute('data-entry-name') : '.';
         form.appendChild(createHiddenInput('target', target));
 
         let file = document.createElement('input');
         file.setAttribute('type', 'file');
         file.setAttribute('name', 'file');
         file.setAttribute('multiple', '');
-        file.addEventListener('change', function fileChangeListener(e) {
+        file.addEventListener('change', async function fileChangeListener(e) {
             e.target.removeEventListener('change', fileChangeListener);
             if (e.target.files.length > 0) {
+                const size = [...e.target.files].reduce((total, f) => total + f.size, 0);
+                const params = new URLSearchParams({ action: 'preflight', target, size });
+                const response = await fetch(action + '?' + params, { method: 'post' });
+                if (!response.ok) {
+                    const div = document.createElement('div');
+                    div.textContent = 'Upload refused: ' + (await response.json()).detail;
+                    showMessage(div.outerHTML);
+                    return;
+                }
                 submitHiddenForm(form);
                 showMessage(
                     '<div >Uploading ' + e.target.files.length + ' file(s)...</div>' +
@@ -405,15 +474,23 @@ class Constant:
         form.appendChild(createHiddenInput('action', 'delete'));
 
         const selected = [...document.querySelectorAll('input.table-row-checkbox')].filter(el => el.checked);
+        const bulk = bulkSelection();
         if (selected.length > 0) {
-            if (!confirm('Are you sure to delete these entries?')) {
+            if (!confirm(bulk ? `Are you sure to delete all ${selected.length} entries listed here?`
+                              : 'Are you sure to delete these entries?')) {
                 return;
             }
         } else if (selected.length == 0) {
             return;
         }
-        for (const el of selected) {
-            form.appendChild(createHiddenInput('name', el.getAttribute('data-entry-name')));
+        if (bulk) {
+            for (const [name, value] of bulk) {
+                form.appendChild(createHiddenInput(name, value));
+            }
+        } else {
+            for (const el of selected) {
+                form.appendChild(createHiddenInput('name', el.getAttribute('data-entry-name')));
+            }
         }
 
         submitHiddenForm(form);
@@ -429,8 +506,15 @@ class Constant:
             return;
         }
         
-        for (let el of selected) {
-            form.appendChild(createHiddenInput('source', el.getAttribute('data-entry-name')));
+        const bulk = bulkSelection();
+        if (bulk) {
+            for (const [name, value] of bulk) {
+                form.appendChild(createHiddenInput(name, value));
+            }
+        } else {
+            for (let el of selected) {
+                form.appendChild(createHiddenInput('source', el.getAttribute('data-entry-name')));
+            }
         }
 
         const targetName = prompt('Destination:');
@@ -470,6 +554,36 @@ class Constant:
         submitHiddenForm(form);
     }
 
+    async function checksumEntries(action = '') {
+        const selected = [...document.querySelectorAll('input.table-row-checkbox')].filter(el => el.checked);
+        if (!selected.length) {
+            return;
+        }
+        const body = new FormData();
+        body.append('action', 'hash');
+        for (const el of selected) {
+            body.append('name', el.getAttribute('data-entry-name'));
+        }
+        showMessage('<div>Computing checksums...</div><div class="loader"></div>');
+        const response = await fetch(action + '?json', { method: 'post', body });
+        const result = await response.json();
+        const pre = document.createElement('pre');
+        if (result.digests) {
+            pre.textContent = result.algorithm + '\\n\\n' + Object.entries(result.digests)
+                .map(([name, digest]) => `${digest || '-'}  ${name}`).join('\\n');
+        } else {
+            pre.textContent = result.detail;
+        }
+        showMessage(pre.outerHTML);
+    }
+
+    let checksumButton = document.querySelector('button#checksum');
+    if (checksumButton) {
+        checksumButton.addEventListener('click', function (e) {
+            checksumEntries();
+        });
+    }
+
     let deleteButton = document.querySelector('button#delete');
     if (deleteButton) {
         deleteButton.addEventListener('click', function (e) {
@@ -493,52 +607,6 @@ class Constant:
 
     refreshButtons();
 
-    const sortCriteria = {
-        name: row => row.getAttribute('data-sort-name'),
-        type: row => row.getAttribute('data-sort-type'),
-        ctime: row => row.getAttribute('data-sort-ctime'),
-        mtime: row => row.getAttribute('data-sort-mtime'),
-        atime: row => row.getAttribute('data-sort-atime'),
-        size: row => row.getAttribute('data-sort-size'),
-        order: row => row.getAttribute('data-sort-order'),
-    };
-
-    document.querySelectorAll('.table-header-link').forEach(function (link) {
-        link.addEventListener('click', function (e) {
-            e.preventDefault();
-
-            document.querySelectorAll('.table-header-link').forEach(function (otherLink) {
-                if (link != otherLink) {
-                    otherLink.setAttribute('data-order', '');
-                }
-            });
-
-            let criterionKey = link.getAttribute('data-sort-by');
-            let order = link.getAttribute('data-order');
-            let criterion;
-            let sortSign;
-
-            if (!order) {
-                order = 'asc';
-                criterion = sortCriteria[criterionKey] || sortCriteria.order;
-                sortSign = 1;
-            } else if (order === 'asc') {
-                order = 'desc';
-                criterion = sortCriteria[criterionKey] || sortCriteria.order;
-                sortSign = -1;
-            } else if (order === 'desc') {
-                order = '';
-                criterion = sortCriteria.order;
-                sortSign = 1;
-            }
-
-            console.log(criterion);
-
-            link.setAttribute('data-order', order);
-            refreshTableRowOrder(criterion, sortSign);
-        });
-    });
-
     if (location.hash.startsWith('#message=')) {
         const encodedMessage = location.hash.substring(9);
         const decodedMessage = decodeURIComponent(encodedMessage);
@@ -546,7 +614,17 @@ class Constant:
         location.hash = '';
         history.replaceState(null, '', location.pathname + location.search);
     }
-    ''')
+    '''
+
+    @classmethod
+    @functools.cache
+    def style(cls) -> str:
+        return textwrap.dedent(cls.STYLE)
+
+    @classmethod
+    @functools.cache
+    def script(cls) -> str:
+        return textwrap.dedent(cls.SCRIPT)
 
     EL_REGEX_TAG = re.compile(r'^[^.#]*')
     EL_REGEX_IDS = re.compile(r'[#]([^.#]*)')
@@ -605,6 +683,15 @@ class Constant:
     ENTRY_TYPE_FILE = 'file'
     ENTRY_TYPE_UNKNOWN = 'unknown'
 
+    # hidden under the document root, holds server state and routes internal endpoints
+    STATE_DIR_NAME = '.webdir'
+
+    # bounds of the batch actions
+    BATCH_MAX_PATHS = 10000
+    FETCH_MAX_FILES = 1000
+    FETCH_MAX_BYTES = 256 * 1024 * 1024
+    FETCH_READ_AHEAD_SIZE = 1024 * 1024
+
 
 class EntryType(enum.Enum):
     UNKNOWN = 0
@@ -614,7 +701,6 @@ class EntryType(enum.Enum):
 
 class Entry(NamedTuple):
     name: str
-    path: str
     type: EntryType
     readable: bool
     writable: bool
@@ -624,6 +710,89 @@ class Entry(NamedTuple):
     stat_size: int
 
 
+class Listing:
+    # One array per column and all names in a single buffer, so a huge directory costs
+    # a few dozen bytes per entry; rows are only built as Entry tuples while rendering
+    READABLE = 1
+    WRITABLE = 2
+    SORT_KEYS = ('name', 'size', 'perm', 'ctime', 'mtime', 'atime')
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.names = bytearray()
+        self.offsets = array('Q', [0])
+        self.types = array('B')
+        self.perms = array('B')
+        self.sizes = array('q')
+        self.ctimes = array('d')
+        self.mtimes = array('d')
+        self.atimes = array('d')
+        self.order = array('L')
+
+    def append(self, name: str, type: EntryType, readable: bool, writable: bool,
+               size: int, ctime: float, mtime: float, atime: float):
+        self.order.append(len(self.types))
+        self.names += os.fsencode(name)
+        self.offsets.append(len(self.names))
+        self.types.append(type.value)
+        self.perms.append((readable and self.READABLE) | (writable and self.WRITABLE))
+        self.sizes.append(size)
+        self.ctimes.append(ctime)
+        self.mtimes.append(mtime)
+        self.atimes.append(atime)
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __iter__(self):
+        return map(self.entry, self.order)
+
+    def __getitem__(self, index: slice) -> Listing:
+        # a view over the same columns
+        view = object.__new__(Listing)
+        view.__dict__.update(self.__dict__)
+        view.order = self.order[index]
+        return view
+
+    def name(self, i: int) -> str:
+        return os.fsdecode(bytes(self.names[self.offsets[i]:self.offsets[i + 1]]))
+
+    def entry(self, i: int) -> Entry:
+        return Entry(
+            name=self.name(i),
+            type=EntryType(self.types[i]),
+            readable=bool(self.perms[i] & self.READABLE),
+            writable=bool(self.perms[i] & self.WRITABLE),
+            stat_ctime=self.ctimes[i],
+            stat_mtime=self.mtimes[i],
+            stat_atime=self.atimes[i],
+            stat_size=self.sizes[i],
+        )
+
+    def sort(self, key: str = 'name', reverse: bool = False) -> Listing:
+        # directories first, then by the requested column with the name as the tie break
+        names, offsets, types = self.names, self.offsets, self.types
+        order = sorted(self.order, key=lambda i: names[offsets[i]:offsets[i + 1]], reverse=reverse)
+        if key != 'name':
+            column = {'size': self.sizes, 'perm': self.perms,
+                      'ctime': self.ctimes, 'mtime': self.mtimes, 'atime': self.atimes}[key]
+            order.sort(key=column.__getitem__, reverse=reverse)
+        order.sort(key=lambda i: -types[i])
+        self.order = array('L', order)
+        return self
+
+    def filter(self, patterns: list[re.Pattern], type: Optional[EntryType] = None) -> Listing:
+        # keeps the rows of that type whose name matches every pattern, in their current order
+        order = self.order
+        if type is not None:
+            types = self.types
+            order = [i for i in order if types[i] == type.value]
+        if patterns:
+            order = [i for i in order if all(pattern.search(self.name(i)) for pattern in patterns)]
+        self.order = array('L', order)
+        return self
+
+
 class ListDirHTML:
     @classmethod
     def __generate_breakcrumbs(cls, webpath: str, base: str):
@@ -644,12 +813,25 @@ class ListDirHTML:
     def generate(cls,
                  webpath: str,
                  base: str,
-                 entries: list[Entry],
+                 entries: Listing,
                  allow_modify: bool,
-                 folder_writable: bool) -> str:
+                 folder_writable: bool,
+                 query: Optional[dict[str, Optional[str]]] = None) -> str:
+        from urllib.parse import urlencode
+        query = query or {}
+        # what the server filtered by, kept by the sort links and sent instead of names when all is selected
+        filters = {key: query[key] for key in ('filter', 'glob', 'type') if query.get(key)}
+
+        def sort_link(key: str, label: str) -> str:
+            # ascending, descending, then back to the default order
+            order = (query.get('order') or 'asc') if query.get('sort') == key else ''
+            next_order = {'': 'asc', 'asc': 'desc', 'desc': ''}[order]
+            params = {**filters, **({'sort': key, 'order': next_order} if next_order else {})}
+            return el('a.table-header-link', {'href': f'{base}{webpath}/?{urlencode(params)}', 'data-order': order},
+                      label)
 
         table_rows = []
-        for i, entry in enumerate(entries):
+        for entry in entries:
             link_attrs = {}
             if entry.readable:
                 href = f'{base}{webpath}/{entry.name}'
@@ -667,14 +849,7 @@ class ListDirHTML:
             table_rows.append(
                 el('tr.table-row', {
                     'id': display_name,
-                    'data-sort-type': entry.type,
                     'data-sort-name': display_name,
-                    'data-sort-perm': display_perm,
-                    'data-sort-ctime': display_ctime,
-                    'data-sort-mtime': display_mtime,
-                    'data-sort-atime': display_atime,
-                    'data-sort-size': '{:016d}'.format(entry.stat_size),
-                    'data-sort-order': i,
                 }, (
                     el('td.table-cell-checkbox', [
                         el('input.table-row-checkbox', {
@@ -685,7 +860,11 @@ class ListDirHTML:
                         })
                     ]),
                     el('td.table-cell-icon', cls.__generate_icon_by_type(entry.type)),
-                    el('td.table-cell-normal', el('a.name', link_attrs, display_name)),
+                    el('td.table-cell-normal', [
+                        el('a.name', link_attrs, display_name),
+                        el('a.browse', {'href': link_attrs.get('href', '') + '/'}, 'browse',
+                           when=entry.readable and entry.type == EntryType.FILE and Archive.supports(entry.name)),
+                    ]),
                     el('td.table-cell-normal', display_size),
                     el('td.table-cell-normal', display_perm),
                     el('td.table-cell-normal', display_ctime),
@@ -724,7 +903,7 @@ class ListDirHTML:
                 el('meta', {'charset': 'utf-8'}),
                 el('meta', {'name': 'viewport',
                             'content': 'width=device-width, initial-scale=1'}),
-                el('style', Constant.STYLE)
+                el('style', Constant.style())
             ]),
             el('body', [
                 el('dialog#message'),
@@ -737,10 +916,13 @@ class ListDirHTML:
                                       'onclick': onclick_parent_btn}, '..'),
                         el('.h-space'),
                         el('input.name-filter', {'type': 'text',
-                                                 'placeholder': 'RegExp name filter',
+                                                 'placeholder': 'RegExp name filter (Enter: on the server)',
+                                                 'value': query.get('filter') or '',
                                                  'autofocus': 'true',
                                                  'spellcheck': 'false'}),
                         el('.h-space'),
+                        el('button#checksum', {'type': 'button'}, 'Checksum'),
+                        el('.h-space'),
                         *modification_buttons,
                         el('.h-space'),
                     ]),
@@ -751,24 +933,12 @@ class ListDirHTML:
                                     el('td.table-cell-checkbox',
                                         el('input.table-row-checkbox-all', {'type': 'checkbox'})),
                                     el('td.table-cell-normal'),
-                                    el('td.table-cell-normal', el('a.table-header-link',
-                                                                {'href': '#', 'data-sort-by': 'name'},
-                                                                'name')),
-                                    el('td.table-cell-normal', el('a.table-header-link',
-                                                                {'href': '#', 'data-sort-by': 'size'},
-                                                                'size')),
-                                    el('td.table-cell-normal', el('a.table-header-link',
-                                                                {'href': '#', 'data-sort-by': 'perm'},
-                                                                'permission')),
-                                    el('td.table-cell-normal', el('a.table-header-link',
-                                                                {'href': '#', 'data-sort-by': 'ctime'},
-                                                                'created at')),
-                                    el('td.table-cell-normal', el('a.table-header-link',
-                                                                {'href': '#', 'data-sort-by': 'mtime'},
-                                                                'modified at')),
-                                    el('td.table-cell-normal', el('a.table-header-link',
-                                                                {'href': '#', 'data-sort-by': 'atime'},
-                                                                'accessed at')),
+                                    el('td.table-cell-normal', sort_link('name', 'name')),
+                                    el('td.table-cell-normal', sort_link('size', 'size')),
+                                    el('td.table-cell-normal', sort_link('perm', 'permission')),
+                                    el('td.table-cell-normal', sort_link('ctime', 'created at')),
+                                    el('td.table-cell-normal', sort_link('mtime', 'modified at')),
+                                    el('td.table-cell-normal', sort_link('atime', 'accessed at')),
                                 ]),
                             ]),
                             el('tbody', table_rows),
@@ -777,7 +947,8 @@ class ListDirHTML:
                 ]),
                 el('script', f'const modifiable = {j(allow_modify)};'),
                 el('script', f'const writable = {j(folder_writable)};'),
-                el('script', Constant.SCRIPT),
+                el('script', 'const listingQuery = {};'.format(j(filters).replace('<', '\\u003c'))),
+                el('script', Constant.script()),
             ]),
         ])
 
@@ -785,6 +956,10 @@ class ListDirHTML:
 j = json.dumps
 
 
+def escape(value) -> str:
+    return html_escape(str(value), quote=True)
+
+
 def el(name, *args: list[Union[str, list, tuple, dict]], **kwargs) -> str:
     if not kwargs.pop('when', True):
         return ''
@@ -833,6 +1008,15 @@ def el(name, *args: list[Union[str, list, tuple, dict]], **kwargs) -> str:
 
 
 class Format:
+    # ?format= of listings for scripts: raw sizes and epoch timestamps
+    LISTING_FORMATS = {
+        'tsv': 'text/tab-separated-values; charset=utf-8',
+        'csv': 'text/csv; charset=utf-8',
+        'ndjson': 'application/x-ndjson',
+    }
+    LISTING_COLUMNS = ('name', 'type', 'permission', 'size', 'ctime', 'mtime', 'atime')
+    TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
     @classmethod
     def date(cls, timestamp: Union[int, float]):
         assert isinstance(timestamp, (int, float))
@@ -900,10 +1084,11 @@ class Format:
 
     @classmethod
     def table(cls, data) -> str:
-        col_widths = [max(len(str(item)) for item in column) for column in zip(*data)]
+        data = [[str(item) for item in row] for row in data]
+        col_widths = [max(map(len, column)) for column in zip(*data)]
 
         def format_row(row):
-            return ' | '.join(f'{str(item).ljust(col_widths[i])}' for i, item in enumerate(row))
+            return ' | '.join(item.ljust(width) for item, width in zip(row, col_widths))
         lines = []
         lines.append(format_row(data[0]))
         lines.append('-+-'.join('-' * width for width in col_widths))
@@ -911,6 +1096,34 @@ class Format:
             lines.append(format_row(row))
         return '\n'.join(lines)
 
+    @classmethod
+    def listing_rows(cls, format: str, entries, chunk_size: int = 64 * 1024, interval: float = 0.05):
+        # encoded chunks of rows, flushed by size or time so a slow scan still reaches the client as it goes
+        import io
+        import csv
+        buffer = io.StringIO()
+        if format == 'csv':
+            writer = csv.writer(buffer, lineterminator='\n')
+            write = writer.writerow
+        elif format == 'tsv':
+            def write(row):
+                buffer.write('\t'.join(str(item).translate(cls.TSV_ESCAPES) for item in row) + '\n')
+        else:
+            def write(row):
+                buffer.write(json.dumps(dict(zip(cls.LISTING_COLUMNS, row))) + '\n')
+        if format != 'ndjson':
+            write(cls.LISTING_COLUMNS)
+        flushed = time.monotonic()
+        for entry in entries:
+            write((entry.name, cls.entry_type_full(entry), cls.entry_permission(entry), entry.stat_size,
+                   entry.stat_ctime, entry.stat_mtime, entry.stat_atime))
+            if buffer.tell() >= chunk_size or time.monotonic() - flushed >= interval:
+                yield buffer.getvalue().encode('utf-8', 'surrogateescape')
+                buffer.seek(0)
+                buffer.truncate()
+                flushed = time.monotonic()
+        yield buffer.getvalue().encode('utf-8', 'surrogateescape')
+
 
 class Path:
     @classmethod
@@ -947,6 +1160,16 @@ class Path:
             return os.access(path, os.W_OK | os.R_OK | os.X_OK)
         return False
 
+    @classmethod
+    def classify(cls, path: str, stat: os.stat_result) -> tuple[EntryType, bool, bool]:
+        # type, readability and writability from a stat already taken, instead of probing the path again
+        if S_ISREG(stat.st_mode):
+            return EntryType.FILE, os.access(path, os.R_OK), os.access(path, os.W_OK)
+        elif S_ISDIR(stat.st_mode):
+            readable = os.access(path, os.R_OK | os.X_OK)
+            return EntryType.DIRECTORY, readable, readable and os.access(path, os.W_OK)
+        return EntryType.UNKNOWN, False, False
+
 
 def base64_encode(s: str) -> str:
     b = s.encode()
@@ -985,14 +1208,2313 @@ def mkdir_p(path: str, mode: int):
         os.chmod(dir, mode)
 
 
+def parse_size(value: str) -> int:
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*', value, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'invalid size: {value!r}')
+    return int(float(match.group(1)) * units[match.group(2).upper()])
+
+
+class Durability(enum.Enum):
+    NONE = 'none'    # rely on the kernel to flush eventually
+    FILE = 'file'    # fdatasync every file, then fsync its directory after the rename
+    BATCH = 'batch'  # flush all files of a request concurrently, then fsync each directory once
+
+
+def fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PageCache:
+    # fadvise/sync_file_range hints, so one multi-GB transfer streams through the page cache
+    # instead of evicting the small files everyone else is reading
+    WINDOW = 8 * 1024 * 1024
+    SYNC_FILE_RANGE_WAIT_BEFORE = 1
+    SYNC_FILE_RANGE_WRITE = 2
+    SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+    @classmethod
+    def advise(cls, fd: int, offset: int, length: int, advice: str):
+        if hasattr(os, advice) and length >= 0:
+            with suppress(OSError):
+                os.posix_fadvise(fd, offset, length, getattr(os, advice))
+
+    @classmethod
+    @functools.cache
+    def sync_file_range(cls):
+        # Linux only, and not wrapped by the os module
+        with suppress(Exception):
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            function = libc.sync_file_range
+            function.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint)
+            return function
+        return None
+
+    @classmethod
+    def write_behind(cls, fd: int, dropped: int, start: int, end: int):
+        # start writing back [start, end), then wait for [dropped, start) and drop it from the cache;
+        # the first window has nothing before it, and a length of 0 would mean the whole file
+        sync_file_range = cls.sync_file_range()
+        if sync_file_range is not None:
+            sync_file_range(fd, start, end - start, cls.SYNC_FILE_RANGE_WRITE)
+        if start == dropped:
+            return
+        if sync_file_range is not None:
+            sync_file_range(fd, dropped, start - dropped, cls.SYNC_FILE_RANGE_WAIT_BEFORE | cls.SYNC_FILE_RANGE_WRITE |
+                            cls.SYNC_FILE_RANGE_WAIT_AFTER)
+        cls.advise(fd, dropped, start - dropped, 'POSIX_FADV_DONTNEED')
+
+
+class AtomicFile:
+    def __init__(self, path: str, mode: int, hash_algorithms: tuple[str, ...] = (),
+                 write_behind_threshold: Optional[int] = None):
+        self.path = path
+        self.mode = mode
+        self.hashes = {algorithm: hashlib.new(algorithm) for algorithm in hash_algorithms}
+        self.write_behind_threshold = write_behind_threshold
+        self.size = 0
+        self.written_back = 0
+        self.dropped = 0
+        dirname, basename = os.path.split(path)
+        fd, self.temp_path = tempfile.mkstemp(prefix=f'.{basename}.', suffix='.part', dir=dirname)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+        self.size += len(chunk)
+        for hash in self.hashes.values():
+            hash.update(chunk)
+
+    @property
+    def needs_write_behind(self) -> bool:
+        return (self.write_behind_threshold is not None and self.size >= self.write_behind_threshold
+                and self.size - self.written_back >= PageCache.WINDOW)
+
+    def write_behind(self):
+        # may block on the disk, so it runs off the event loop
+        self.file.flush()
+        PageCache.write_behind(self.file.fileno(), self.dropped, self.written_back, self.size)
+        self.dropped, self.written_back = self.written_back, self.size
+
+    def flush(self, sync: bool):
+        if self.file.closed:
+            return
+        self.file.flush()
+        if sync:
+            getattr(os, 'fdatasync', os.fsync)(self.file.fileno())
+            if self.written_back:
+                PageCache.advise(self.file.fileno(), self.dropped, 0, 'POSIX_FADV_DONTNEED')
+        self.file.close()
+
+    def commit(self):
+        os.chmod(self.temp_path, self.mode)
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        with suppress(OSError):
+            os.remove(self.temp_path)
+
+    @classmethod
+    def commit_all(cls, files: list['AtomicFile'], durability: Durability, store: Optional['ContentStore'] = None):
+        from concurrent.futures import ThreadPoolExecutor
+        if durability == Durability.BATCH and len(files) > 1:
+            with ThreadPoolExecutor(min(len(files), 16)) as executor:
+                list(executor.map(lambda file: file.flush(sync=True), files))
+        dirs = {}
+        for file in files:
+            file.flush(sync=durability != Durability.NONE)
+            if store is not None:
+                store.commit(file)
+            else:
+                file.commit()
+            dirname = os.path.dirname(file.path)
+            if durability == Durability.FILE:
+                fsync_dir(dirname)
+            dirs[dirname] = None
+        if durability == Durability.BATCH:
+            for dirname in dirs:
+                fsync_dir(dirname)
+
+
+class ContentStore:
+    HASH_ALGORITHM = 'sha256'
+    FICLONE = 0x40049409  # linux/fs.h, supported by btrfs, xfs and others
+
+    def __init__(self, path: str, reflink: bool = False):
+        import sqlite3
+        self.path = path
+        self.reflink = reflink
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'index.db'), check_same_thread=False, isolation_level=None)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER, refs INTEGER);
+            CREATE TABLE IF NOT EXISTS links (ino INTEGER PRIMARY KEY, digest TEXT);
+        ''')
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest[2:4], digest)
+
+    def __clone(self, src: str, dst: str) -> bool:
+        if not self.reflink:
+            return False
+        try:
+            import fcntl
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), self.FICLONE, fsrc.fileno())
+            return True
+        except (ImportError, OSError):
+            with suppress(OSError):
+                os.remove(dst)
+            return False
+
+    def __place(self, obj: str, dst: str, mode: int) -> Optional[int]:
+        # None when the object cannot stand in for dst: a hardlink shares the object's permissions
+        temp = f'{dst}.{secrets.token_hex(4)}.link'
+        if self.__clone(obj, temp):
+            os.chmod(temp, mode)
+        elif S_IMODE(os.lstat(obj).st_mode) == mode:
+            os.link(obj, temp)
+        else:
+            return None
+        try:
+            os.replace(temp, dst)
+        except OSError:
+            os.remove(temp)
+            raise
+        return os.lstat(dst).st_ino
+
+    def commit(self, file: 'AtomicFile'):
+        digest = file.hashes[self.HASH_ALGORITHM].hexdigest()
+        obj = self.object_path(digest)
+        replaced = None
+        with suppress(FileNotFoundError):
+            replaced = os.lstat(file.path)
+        with self.lock:
+            known = self.db.execute('SELECT 1 FROM objects WHERE digest = ?', (digest,)).fetchone()
+            try:
+                if known and os.path.isfile(obj):
+                    ino = self.__place(obj, file.path, file.mode)
+                    if ino is None:
+                        file.commit()
+                        return
+                    file.abort()
+                else:
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    os.chmod(file.temp_path, file.mode)
+                    if not self.__clone(file.temp_path, obj):
+                        os.link(file.temp_path, obj)
+                    size = os.lstat(obj).st_size
+                    self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, 0)', (digest, size))
+                    file.commit()
+                    ino = os.lstat(file.path).st_ino
+            except OSError:
+                # e.g. the store is on another filesystem, keep the upload as a plain file
+                file.commit()
+                return
+            self.db.execute('UPDATE objects SET refs = refs + 1 WHERE digest = ?', (digest,))
+            self.db.execute('INSERT OR REPLACE INTO links VALUES (?, ?)', (ino, digest))
+        if replaced is not None:
+            self.release(replaced)
+
+    def release(self, stat: os.stat_result):
+        # Called after a file with this stat result has been removed from the tree
+        with self.lock:
+            row = self.db.execute('SELECT digest FROM links WHERE ino = ?', (stat.st_ino,)).fetchone()
+            if row is None:
+                return
+            digest, = row
+            try:
+                obj_stat = os.lstat(self.object_path(digest))
+            except FileNotFoundError:
+                self.__drop(digest)
+                return
+            if obj_stat.st_ino != stat.st_ino:
+                self.db.execute('DELETE FROM links WHERE ino = ?', (stat.st_ino,))
+                if not self.reflink:
+                    return  # stale row, the inode number was reused
+            self.db.execute('UPDATE objects SET refs = refs - 1 WHERE digest = ?', (digest,))
+            refs, = self.db.execute('SELECT refs FROM objects WHERE digest = ?', (digest,)).fetchone()
+            if obj_stat.st_nlink == 1 and (refs <= 0 or not self.reflink):
+                self.__drop(digest)
+
+    def __drop(self, digest: str):
+        with suppress(FileNotFoundError):
+            os.remove(self.object_path(digest))
+        self.db.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+        self.db.execute('DELETE FROM links WHERE digest = ?', (digest,))
+
+    def sweep(self) -> int:
+        # Drops objects whose hardlinks were all removed behind our back
+        dropped = 0
+        with self.lock:
+            for digest, refs in self.db.execute('SELECT digest, refs FROM objects').fetchall():
+                obj = self.object_path(digest)
+                nlink = os.lstat(obj).st_nlink if os.path.exists(obj) else 0
+                if nlink == 0 or (nlink == 1 and (refs <= 0 or not self.reflink)):
+                    self.__drop(digest)
+                    dropped += 1
+        return dropped
+
+    def stats(self) -> dict:
+        objects = stored = logical = 0
+        with self.lock:
+            rows = self.db.execute('SELECT digest, size, refs FROM objects').fetchall()
+        for digest, size, refs in rows:
+            with suppress(FileNotFoundError):
+                nlink = os.lstat(self.object_path(digest)).st_nlink
+                links = max(refs, nlink - 1)
+                objects += 1
+                stored += size
+                logical += size * links
+        return {
+            'mode': 'reflink' if self.reflink else 'hardlink',
+            'objects': objects,
+            'stored_bytes': stored,
+            'logical_bytes': logical,
+            'saved_bytes': max(0, logical - stored),
+        }
+
+
+class Checksum:
+    ALGORITHMS = ('sha256', 'md5', 'blake2b')
+    XATTR_PREFIX = 'user.webdir.'
+    BUFFER_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, db_path: Optional[str], workers: Optional[int] = None, xattrs: bool = True):
+        from concurrent.futures import ThreadPoolExecutor
+        self.db_path = db_path
+        # off for a read-only share, where setting one would still change the file's ctime
+        self.xattrs = xattrs
+        self.executor = ThreadPoolExecutor(workers or os.cpu_count() or 4, thread_name_prefix='checksum')
+        self.lock = threading.Lock()
+        self.db = None
+
+    def __get_db(self) -> sqlite3.Connection:
+        # The sidecar database is only needed where xattrs are unavailable, so create it on demand
+        import sqlite3
+        if self.db is None:
+            try:
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+                self.db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            except (TypeError, OSError, sqlite3.Error):
+                self.db = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None)
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS digests (
+                    path TEXT, algorithm TEXT, ino INTEGER, mtime_ns INTEGER, size INTEGER, digest TEXT,
+                    PRIMARY KEY (path, algorithm)
+                )
+            ''')
+        return self.db
+
+    @classmethod
+    def __validator(cls, stat: os.stat_result) -> str:
+        return f'{stat.st_ino}:{stat.st_mtime_ns}:{stat.st_size}'
+
+    def cached(self, path: str, algorithm: str, stat: os.stat_result) -> Optional[str]:
+        validator = self.__validator(stat)
+        with suppress(OSError, AttributeError):
+            value = os.getxattr(path, self.XATTR_PREFIX + algorithm).decode()
+            cached_validator, _, digest = value.rpartition(':')
+            if cached_validator == validator:
+                return digest
+        with self.lock:
+            if self.db is None and not os.path.exists(self.db_path or ''):
+                return None
+            row = self.__get_db().execute('SELECT ino, mtime_ns, size, digest FROM digests WHERE path = ? AND algorithm = ?',
+                                  (path, algorithm)).fetchone()
+        if row is not None and '{}:{}:{}'.format(*row[:3]) == validator:
+            return row[3]
+        return None
+
+    def remember(self, path: str, algorithm: str, digest: str, stat: os.stat_result):
+        if self.xattrs:
+            with suppress(OSError, AttributeError):
+                os.setxattr(path, self.XATTR_PREFIX + algorithm, f'{self.__validator(stat)}:{digest}'.encode())
+                return
+        with self.lock:
+            self.__get_db().execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                            (path, algorithm, stat.st_ino, stat.st_mtime_ns, stat.st_size, digest))
+
+    @classmethod
+    def compute(cls, path: str, algorithm: str) -> str:
+        hash = hashlib.new(algorithm)
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            mapped = None
+            if size > 0:
+                with suppress(ValueError, OSError):
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if mapped is not None:
+                # hashlib releases the GIL while hashing large buffers, so this scales across threads
+                with mapped, memoryview(mapped) as view:
+                    for offset in range(0, size, cls.BUFFER_SIZE):
+                        hash.update(view[offset:offset + cls.BUFFER_SIZE])
+                return hash.hexdigest()
+            buffer = bytearray(cls.BUFFER_SIZE)
+            view = memoryview(buffer)
+            while n := f.readinto(buffer):
+                hash.update(view[:n])
+        return hash.hexdigest()
+
+    def digest(self, path: str, algorithm: str) -> Optional[str]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        digest = self.cached(path, algorithm, stat)
+        if digest is None:
+            try:
+                digest = self.compute(path, algorithm)
+            except OSError:
+                return None
+            with suppress(OSError):
+                if self.__validator(os.stat(path)) == self.__validator(stat):
+                    self.remember(path, algorithm, digest, stat)
+        return digest
+
+    async def digest_many(self, paths: list[str], algorithm: str) -> list[Optional[str]]:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[loop.run_in_executor(self.executor, self.digest, path, algorithm)
+                                      for path in paths])
+
+
+class Quota:
+    # Bytes under each directory with a limit, and bytes uploaded by each user, kept current from the handler's own
+    # changes instead of walking the tree per upload. A directory is walked once, when it is first checked.
+    def __init__(self, db_path: str, skip: str, directories: dict[str, int], users: dict[str, int]):
+        self.db_path = db_path
+        self.skip = skip
+        self.directories = directories
+        self.users = users
+        self.usage: dict[str, int] = {}
+        self.user_usage: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.db = None
+
+    def __get_db(self) -> sqlite3.Connection:
+        import sqlite3
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            self.db.execute('CREATE TABLE IF NOT EXISTS owners (path TEXT PRIMARY KEY, user TEXT, size INTEGER)')
+            self.user_usage = dict(self.db.execute('SELECT user, SUM(size) FROM owners GROUP BY user'))
+        return self.db
+
+    def walk(self, path: str) -> int:
+        total = 0
+        for prefix, dirnames, filenames in os.walk(path):
+            dirnames[:] = [name for name in dirnames if os.path.join(prefix, name) != self.skip]
+            for name in filenames:
+                with suppress(OSError):
+                    stat = os.lstat(os.path.join(prefix, name))
+                    if S_ISREG(stat.st_mode):
+                        total += stat.st_size
+        return total
+
+    def __scopes(self, path: str) -> list[str]:
+        if path == self.skip or path.startswith(self.skip + os.sep):
+            return []
+        return [directory for directory in self.directories
+                if path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)]
+
+    def __user_limit(self, user: Optional[str]) -> Optional[int]:
+        if user is None:
+            return None
+        return self.users.get(user, self.users.get('*'))
+
+    def check(self, path: str, user: Optional[str], size: int) -> Optional[str]:
+        # the reason size more bytes at path would go over a quota, if they would
+        if not self.directories and not self.users:
+            return None
+        with self.lock:
+            for directory in self.__scopes(path):
+                if directory not in self.usage:
+                    self.usage[directory] = self.walk(directory)
+                used, limit = self.usage[directory], self.directories[directory]
+                if used + size > limit:
+                    return (f'directory quota of {Format.size(limit)} exceeded: '
+                            f'{Format.size(used)} used, {Format.size(size)} more requested')
+            limit = self.__user_limit(user)
+            if limit is not None:
+                self.__get_db()
+                used = self.user_usage.get(user, 0)
+                if used + size > limit:
+                    return (f'quota of {Format.size(limit)} for {user} exceeded: '
+                            f'{Format.size(used)} used, {Format.size(size)} more requested')
+        return None
+
+    def add(self, path: str, delta: int, user: Optional[str] = None, size: int = 0):
+        # a file at path was written with size bytes (delta more than before), by user
+        if not self.directories and not self.users:
+            return
+        with self.lock:
+            for directory in self.__scopes(path):
+                if directory in self.usage:
+                    self.usage[directory] += delta
+            if self.users:
+                db = self.__get_db()
+                row = db.execute('SELECT user, size FROM owners WHERE path = ?', (path,)).fetchone()
+                if row is not None:
+                    self.user_usage[row[0]] -= row[1]
+                if user is None:
+                    db.execute('DELETE FROM owners WHERE path = ?', (path,))
+                else:
+                    db.execute('INSERT OR REPLACE INTO owners VALUES (?, ?, ?)', (path, user, size))
+                    self.user_usage[user] = self.user_usage.get(user, 0) + size
+
+    def remove(self, path: str, freed: int):
+        # a file or tree at path was removed, freeing freed bytes
+        if not self.directories and not self.users:
+            return
+        with self.lock:
+            for directory in self.__scopes(path):
+                if directory in self.usage:
+                    self.usage[directory] -= freed
+            if self.users:
+                db = self.__get_db()
+                prefix = path.rstrip(os.sep) + os.sep
+                where = 'path = ? OR substr(path, 1, ?) = ?'
+                for user, size in db.execute(f'SELECT user, SUM(size) FROM owners WHERE {where} GROUP BY user',
+                                             (path, len(prefix), prefix)).fetchall():
+                    self.user_usage[user] -= size
+                db.execute(f'DELETE FROM owners WHERE {where}', (path, len(prefix), prefix))
+
+    def move(self, src: str, dst: str):
+        # src was renamed to dst, only walked when it crossed a directory quota
+        if not self.directories and not self.users:
+            return
+        with self.lock:
+            before, after = self.__scopes(src), self.__scopes(dst)
+            if before != after:
+                size = self.walk(dst) if os.path.isdir(dst) else os.lstat(dst).st_size
+                for directory in set(before) - set(after):
+                    if directory in self.usage:
+                        self.usage[directory] -= size
+                for directory in set(after) - set(before):
+                    if directory in self.usage:
+                        self.usage[directory] += size
+            if self.users:
+                prefix = src.rstrip(os.sep) + os.sep
+                self.__get_db().execute('UPDATE OR REPLACE owners SET path = ? || substr(path, ?) '
+                                        'WHERE path = ? OR substr(path, 1, ?) = ?',
+                                        (dst, len(src) + 1, src, len(prefix), prefix))
+
+    def rescan(self):
+        with self.lock:
+            self.usage.clear()
+
+    def status(self, root: str) -> dict:
+        with self.lock:
+            if self.users:
+                self.__get_db()
+            return {
+                'directories': {os.path.relpath(directory, root): {'limit': limit, 'used': self.usage.get(directory)}
+                                for directory, limit in self.directories.items()},
+                'users': {user: {'limit': self.__user_limit(user), 'used': used}
+                          for user, used in self.user_usage.items()},
+                'limits': self.users,
+            }
+
+
+class Trash:
+    # Deleted entries are renamed under .webdir/trash, which takes no time whatever their size. A background thread
+    # purges them once retention expires, or the trash outgrows its limit, at idle priority and a bounded file rate.
+    IOPRIO_SET = {'x86_64': 251, 'aarch64': 30}
+
+    def __init__(self, path: str, retention: float, max_size: Optional[int], rate: float, remove_file, on_purged):
+        self.path = path
+        self.retention = retention
+        self.max_size = max_size
+        self.bucket = TokenBucket(rate, rate)
+        self.remove_file = remove_file
+        self.on_purged = on_purged
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.items: dict[str, dict] = {}
+        self.purged = 0
+        with suppress(OSError):
+            for name in os.listdir(path):
+                if name.endswith('.json'):
+                    with suppress(OSError, ValueError), open(os.path.join(path, name)) as f:
+                        item = json.load(f)
+                        self.items[item['id']] = item
+        threading.Thread(target=self.__run, name='trash', daemon=True).start()
+
+    def entry_path(self, id: str) -> str:
+        return os.path.join(self.path, id)
+
+    def put(self, local_path: str, relative_path: str, user: Optional[str]) -> Optional[str]:
+        # None if it cannot be renamed into the trash, e.g. it is on another filesystem
+        os.makedirs(self.path, exist_ok=True)
+        id = '{:x}-{}'.format(time.time_ns() // 1000000, secrets.token_hex(4))
+        item = {'id': id, 'path': relative_path, 'user': user, 'deleted_at': time.time(), 'size': None,
+                'type': Constant.ENTRY_TYPE_DIRECTORY if os.path.isdir(local_path) else Constant.ENTRY_TYPE_FILE}
+        # the metadata goes first, so a crash never leaves an entry nobody knows the origin of
+        meta_path = self.entry_path(id) + '.json'
+        with open(meta_path, 'w') as f:
+            json.dump(item, f)
+        try:
+            os.rename(local_path, self.entry_path(id))
+        except OSError:
+            os.remove(meta_path)
+            return None
+        with self.lock:
+            self.items[id] = item
+            self.changed.notify_all()
+        return id
+
+    def restore(self, id: str, root: str) -> str:
+        with self.lock:
+            item = self.items.get(id)
+            if item is None or item.get('purging'):
+                raise KeyError(id)
+            local_path = os.path.join(root, *item['path'].split('/'))
+            if os.path.lexists(local_path):
+                raise FileExistsError(f'{item["path"]} exists again')
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            os.rename(self.entry_path(id), local_path)
+            del self.items[id]
+        with suppress(OSError):
+            os.remove(self.entry_path(id) + '.json')
+        return local_path
+
+    def purge(self, id: Optional[str] = None):
+        # purges one item, or everything, without waiting for retention
+        with self.lock:
+            for item in self.items.values():
+                if id is None or item['id'] == id:
+                    item['expired'] = True
+            self.changed.notify_all()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'retention': self.retention,
+                'max_size': self.max_size,
+                'size': sum(item['size'] or 0 for item in self.items.values()),
+                'purged': self.purged,
+                'items': sorted(({**item, 'expires_at': item['deleted_at'] + self.retention}
+                                 for item in self.items.values()), key=lambda item: item['deleted_at']),
+            }
+
+    def __next_victim(self) -> tuple[Optional[dict], Optional[float]]:
+        # the item to purge now, or how long until one expires
+        items = sorted((item for item in self.items.values() if not item.get('purging')),
+                       key=lambda item: item['deleted_at'])
+        if not items:
+            return None, None
+        now = time.time()
+        for item in items:
+            if item.get('expired') or item['deleted_at'] + self.retention <= now:
+                return item, None
+        if self.max_size is not None and sum(item['size'] or 0 for item in items) > self.max_size:
+            return items[0], None
+        return None, items[0]['deleted_at'] + self.retention - now
+
+    def __run(self):
+        with suppress(Exception):
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        with suppress(Exception):
+            import ctypes
+            import platform
+            # IOPRIO_WHO_PROCESS of this thread, IOPRIO_CLASS_IDLE
+            ctypes.CDLL(None, use_errno=True).syscall(self.IOPRIO_SET[platform.machine()], 1,
+                                                      threading.get_native_id(), 3 << 13)
+        while True:
+            with self.lock:
+                while True:
+                    victim, timeout = self.__next_victim()
+                    unsized = [item for item in self.items.values()
+                               if item['size'] is None and self.max_size is not None]
+                    if victim is not None or unsized:
+                        break
+                    self.changed.wait(timeout)
+                if victim is not None:
+                    victim['purging'] = True
+            if victim is not None:
+                self.__purge(victim)
+                continue
+            # sizes only matter for the size limit, and are worked out here rather than at delete time
+            for item in unsized:
+                try:
+                    size = self.__size(self.entry_path(item['id']))
+                except OSError:
+                    size = 0
+                with self.lock:
+                    item['size'] = size
+                    if item['id'] in self.items:
+                        with suppress(OSError), open(self.entry_path(item['id']) + '.json', 'w') as f:
+                            json.dump({key: value for key, value in item.items() if key not in ('purging', 'expired')}, f)
+
+    @classmethod
+    def __size(cls, path: str) -> int:
+        if not os.path.isdir(path) or os.path.islink(path):
+            return os.lstat(path).st_size
+        return sum(os.lstat(os.path.join(prefix, name)).st_size
+                   for prefix, _, names in os.walk(path) for name in names)
+
+    def __purge(self, item: dict):
+        path = self.entry_path(item['id'])
+        freed = 0
+        if os.path.isdir(path) and not os.path.islink(path):
+            for prefix, _, names in os.walk(path, topdown=False):
+                for name in names:
+                    time.sleep(self.bucket.consume(1))
+                    freed += self.remove_file(os.path.join(prefix, name))
+                with suppress(OSError):
+                    os.rmdir(prefix)
+        elif os.path.lexists(path):
+            freed += self.remove_file(path)
+        with suppress(OSError):
+            os.remove(path + '.json')
+        self.on_purged(path, freed)
+        with self.lock:
+            del self.items[item['id']]
+            self.purged += 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, amount: float = 1) -> bool:
+        self.__refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def consume(self, amount: float) -> float:
+        # Takes the tokens unconditionally and returns how long the caller should wait to pay off the debt
+        self.__refill()
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    def retry_after(self, amount: float = 1) -> float:
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def refund(self, amount: float = 1):
+        self.tokens = min(self.burst, self.tokens + amount)
+
+    def is_idle(self) -> bool:
+        self.__refill()
+        return self.tokens >= self.burst
+
+
+class ThrottledResponse:
+    def __init__(self, response: Response, bucket: Optional[TokenBucket], on_close):
+        self.response = response
+        self.bucket = bucket
+        self.on_close = on_close
+        self.status_code = response.status_code
+        # shared with the wrapped response, so headers added later (e.g. the session cookie) still apply
+        self.raw_headers = response.raw_headers
+
+    async def __call__(self, scope, receive, send):
+        import asyncio
+
+        async def throttled_send(message):
+            if message['type'] == 'http.response.body' and self.bucket is not None:
+                delay = self.bucket.consume(len(message.get('body', b'')))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await send(message)
+
+        if self.bucket is not None and 'extensions' in scope:
+            # the server must not bypass us with zero-copy sends
+            extensions = {k: v for k, v in scope['extensions'].items() if k != 'http.response.pathsend'}
+            scope = dict(scope, extensions=extensions)
+        try:
+            await self.response(scope, receive, throttled_send)
+        finally:
+            self.on_close()
+
+
+class ReadaheadResponse:
+    # Starlette reads the file through its own descriptor, so rather than fadvise that one, this follows the
+    # bytes going out: the next windows are prefetched with WILLNEED and the pages already sent are dropped
+    def __init__(self, response: Response, path: str):
+        self.response = response
+        self.path = path
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+
+    async def __call__(self, scope, receive, send):
+        fd = os.open(self.path, os.O_RDONLY)
+        offset = prefetched = dropped = 0
+
+        async def hinted_send(message):
+            nonlocal offset, prefetched, dropped
+            if message['type'] == 'http.response.start':
+                headers = dict(message.get('headers', ()))
+                content_range = re.match(rb'bytes (\d+)-', headers.get(b'content-range', b''))
+                offset = prefetched = dropped = int(content_range.group(1)) if content_range else 0
+            elif message['type'] == 'http.response.body':
+                offset += len(message.get('body', b''))
+                if prefetched - offset < PageCache.WINDOW:
+                    PageCache.advise(fd, prefetched, 2 * PageCache.WINDOW, 'POSIX_FADV_WILLNEED')
+                    prefetched += 2 * PageCache.WINDOW
+                if offset - dropped >= 2 * PageCache.WINDOW:
+                    PageCache.advise(fd, dropped, offset - PageCache.WINDOW - dropped, 'POSIX_FADV_DONTNEED')
+                    dropped = offset - PageCache.WINDOW
+            await send(message)
+
+        try:
+            await self.response(scope, receive, hinted_send)
+        finally:
+            os.close(fd)
+
+
+class CachedFile(NamedTuple):
+    key: tuple
+    body: bytes
+    gzip_body: Optional[bytes]
+    etag: str
+    media_type: str
+    last_modified: str
+    trusted: bool  # invalidated by inotify, so lookups skip the stat
+
+
+class FileCache:
+    # Small, hot files served from memory: LRU bounded by total bytes, validated by a stat
+    # (inode, size, mtime, mode) or, with inotify, by events on the watched directories
+    COMPRESSIBLE = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self, capacity: int, max_file_size: int = 256 * 1024, inotify: bool = False):
+        self.capacity = capacity
+        self.max_file_size = max_file_size
+        self.entries: OrderedDict[str, CachedFile] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0, 'gzip_hits': 0}
+        self.inotify_fd = None
+        self.watches: dict[str, int] = {}  # directory -> watch descriptor
+        self.watched: dict[int, str] = {}
+        if inotify:
+            self.__start_inotify()
+
+    @staticmethod
+    def stat_key(stat: os.stat_result) -> tuple:
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_mode, stat.st_uid, stat.st_gid)
+
+    def get(self, path: str) -> Optional[CachedFile]:
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+        if entry is not None and not entry.trusted:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is None or self.stat_key(stat) != entry.key:
+                self.stats['stale'] += 1
+                self.discard(path)
+                entry = None
+        self.stats['hits' if entry is not None else 'misses'] += 1
+        return entry
+
+    def put(self, path: str) -> Optional[CachedFile]:
+        import gzip
+        import mimetypes
+        from email.utils import formatdate
+        trusted = self.__watch(os.path.dirname(path))  # before reading, so no change slips in between
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if not S_ISREG(stat.st_mode) or stat.st_size > self.max_file_size:
+                return None
+            body = f.read(self.max_file_size + 1)
+        if len(body) != stat.st_size or self.stat_key(os.stat(path)) != self.stat_key(stat):
+            return None  # changed while reading
+        media_type = guess_mimetype(path) or mimetypes.guess_type(path)[0] or 'text/plain'
+        gzip_body = None
+        if media_type.startswith(self.COMPRESSIBLE) and len(body) >= 256:
+            gzip_body = gzip.compress(body, 6, mtime=0)
+            if len(gzip_body) >= len(body) * 0.9:
+                gzip_body = None
+        entry = CachedFile(
+            key=self.stat_key(stat),
+            body=body,
+            gzip_body=gzip_body,
+            etag='"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest()),
+            media_type=media_type,
+            last_modified=formatdate(stat.st_mtime, usegmt=True),
+            trusted=trusted,
+        )
+        cost = len(body) + len(gzip_body or b'')
+        if cost > self.capacity:
+            return entry
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old.body) + len(old.gzip_body or b'')
+            self.entries[path] = entry
+            self.size += cost
+            while self.size > self.capacity:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body) + len(evicted.gzip_body or b'')
+                self.stats['evictions'] += 1
+        return entry
+
+    def has_room(self, path: str, size: int) -> bool:
+        # whether a file of this size, not cached yet, fits without evicting anything
+        with self.lock:
+            return size <= self.max_file_size and self.size + size <= self.capacity and path not in self.entries
+
+    def discard(self, path: str):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.size -= len(entry.body) + len(entry.gzip_body or b'')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def respond(self, request: Request, entry: CachedFile) -> Response:
+        body, etag = entry.body, entry.etag
+        headers = {'ETag': etag, 'Last-Modified': entry.last_modified}
+        if entry.gzip_body is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            if 'gzip' in request.headers.get('Accept-Encoding', ''):
+                body, etag = entry.gzip_body, etag[:-1] + '-gzip"'
+                self.stats['gzip_hits'] += 1
+                headers.update({'ETag': etag, 'Content-Encoding': 'gzip'})
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None and etag in (tag.strip() for tag in if_none_match.split(',')):
+            return Response(status_code=304, headers=headers)
+        response = Response(body, media_type=entry.media_type, headers=headers)
+        if request.method == 'HEAD':
+            response.body = b''  # keeps the content-length of the full body
+        return response
+
+    def metrics(self) -> dict:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return {
+            **self.stats,
+            'hit_rate': round(self.stats['hits'] / lookups, 4) if lookups else None,
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'capacity': self.capacity,
+            'max_file_size': self.max_file_size,
+            'inotify': self.inotify_fd is not None,
+            'watches': len(self.watches),
+        }
+
+    def __start_inotify(self):
+        import ctypes
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            self.add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except AttributeError:
+            fd = -1
+        if fd < 0:
+            print('warning: inotify is unavailable, cached files are validated with stat')
+            return
+        self.inotify_fd = fd
+        threading.Thread(target=self.__read_events, name='webdir-inotify', daemon=True).start()
+
+    def __watch(self, directory: str) -> bool:
+        # the directory and its ancestors, so renaming any of them is noticed too
+        if self.inotify_fd is None:
+            return False
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE |
+                self.IN_DELETE | self.IN_DELETE_SELF | self.IN_MOVE_SELF)
+        while directory not in self.watches:
+            wd = self.add_watch(self.inotify_fd, os.fsencode(directory), mask)
+            if wd < 0:
+                return False  # e.g. out of watches (fs.inotify.max_user_watches)
+            with self.lock:
+                self.watches[directory] = wd
+                self.watched[wd] = directory
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+        return True
+
+    def __read_events(self):
+        import struct
+        header = struct.Struct('iIII')
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 64 * 1024)
+            except OSError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = header.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + header.size:offset + header.size + length].rstrip(b'\0'))
+                offset += header.size + length
+                if mask & (self.IN_Q_OVERFLOW | self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF) \
+                        or mask & self.IN_ISDIR and mask & (self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE |
+                                                            self.IN_ATTRIB):
+                    # events were lost, or a directory moved or changed permissions, which can affect any cached path
+                    self.clear()
+                    if mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                        with self.lock:
+                            self.watches.pop(self.watched.pop(wd, None), None)
+                    continue
+                directory = self.watched.get(wd)
+                if directory is not None and name:
+                    self.discard(os.path.join(directory, name))
+
+
+class Prewarm:
+    # Walks the hot paths in the background, at startup and then every interval, making the same scandir, stat and
+    # access calls a listing makes, so the first users after a deploy find dentries and attributes cached (NFS
+    # included). Small files also go into the file cache while it has room. Readiness never waits for it.
+    def __init__(self, root: str, skip: str, paths: list[str], depth: int, jobs: int, interval: float,
+                 file_cache: Optional[FileCache]):
+        self.root = root
+        self.skip = skip
+        self.paths = paths
+        self.depth = depth
+        self.jobs = jobs
+        self.interval = interval
+        self.file_cache = file_cache
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.runs = 0
+        self.current: Optional[dict] = None
+        self.last: Optional[dict] = None
+        threading.Thread(target=self.__run, name='prewarm', daemon=True).start()
+
+    def trigger(self):
+        self.wakeup.set()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'paths': [os.path.relpath(path, self.root) for path in self.paths],
+                'depth': self.depth,
+                'jobs': self.jobs,
+                'interval': self.interval,
+                'runs': self.runs,
+                'running': self.current is not None,
+                'current': self.current and {**self.current,
+                                             'paths': {path: dict(coverage)
+                                                       for path, coverage in self.current['paths'].items()}},
+                'last': self.last,
+            }
+
+    def __run(self):
+        while True:
+            self.wakeup.clear()
+            report = self.crawl()
+            print('PREWARM: {directories} directories, {entries} entries, {files_cached} files cached, '
+                  '{unvisited} directories past --prewarm-depth, {errors} errors in {seconds}s'.format(**report))
+            self.wakeup.wait(self.interval or None)
+
+    def crawl(self) -> dict:
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        started = time.perf_counter()
+        report = {'started_at': time.time(), 'seconds': None, 'directories': 0, 'entries': 0, 'files_cached': 0,
+                  'bytes_cached': 0, 'unvisited': 0, 'errors': 0,
+                  'paths': {os.path.relpath(path, self.root): {'directories': 0, 'entries': 0, 'unvisited': 0}
+                            for path in self.paths}}
+        with self.lock:
+            self.current = report
+        # at most jobs directories in flight, breadth first
+        pending = deque((path, os.path.relpath(path, self.root), 0) for path in self.paths)
+        running = {}
+        with ThreadPoolExecutor(self.jobs, thread_name_prefix='prewarm') as executor:
+            while pending or running:
+                while pending and len(running) < self.jobs:
+                    path, hot_path, depth = pending.popleft()
+                    running[executor.submit(self.__scan, path)] = (hot_path, depth)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    hot_path, depth = running.pop(future)
+                    coverage = report['paths'][hot_path]
+                    try:
+                        subdirectories, entries, cached, cached_bytes = future.result()
+                    except OSError:
+                        with self.lock:
+                            report['errors'] += 1
+                        continue
+                    with self.lock:
+                        report['directories'] += 1
+                        report['entries'] += entries
+                        report['files_cached'] += cached
+                        report['bytes_cached'] += cached_bytes
+                        coverage['directories'] += 1
+                        coverage['entries'] += entries
+                        if depth < self.depth:
+                            pending.extend((path, hot_path, depth + 1) for path in subdirectories)
+                        else:
+                            report['unvisited'] += len(subdirectories)
+                            coverage['unvisited'] += len(subdirectories)
+        report['seconds'] = round(time.perf_counter() - started, 3)
+        with self.lock:
+            self.current = None
+            self.last = report
+            self.runs += 1
+        return report
+
+    def __scan(self, path: str) -> tuple[list[str], int, int, int]:
+        subdirectories, entries, cached, cached_bytes = [], 0, 0, 0
+        with os.scandir(path) as items:
+            for item in items:
+                if item.path == self.skip:
+                    continue
+                entries += 1
+                with suppress(OSError):
+                    stat = item.stat()
+                    type, readable, _ = Path.classify(item.path, stat)
+                    if type is EntryType.DIRECTORY and readable and not item.is_symlink():
+                        subdirectories.append(item.path)
+                    elif (type is EntryType.FILE and readable and self.file_cache is not None
+                          and self.file_cache.has_room(item.path, stat.st_size)
+                          and self.file_cache.put(item.path) is not None):
+                        cached += 1
+                        cached_bytes += stat.st_size
+        return subdirectories, entries, cached, cached_bytes
+
+
+class ArchiveMember(NamedTuple):
+    name: str
+    is_dir: bool
+    size: int
+    mtime: float
+    offset: int  # zip: position in the central directory, tar: offset of the data
+
+
+class Archive:
+    # Member index of a zip (its central directory) or tar file (offsets found by one scan and kept on
+    # disk), so a path inside the archive can be listed like a directory and one member read on its own
+    EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+    INDEX_VERSION = 1
+    MAX_INDEX_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, path: str, key: tuple, members: list[ArchiveMember], zip=None):
+        self.path = path
+        self.key = key
+        self.zip = zip
+        self.members: dict[str, ArchiveMember] = {}
+        self.children: dict[str, dict[str, ArchiveMember]] = {'': {}}
+        for member in members:
+            name = '/'.join(part for part in member.name.split('/') if part not in ('', '.', '..'))
+            if not name:
+                continue
+            member = member._replace(name=name)
+            self.members[name] = member
+            if member.is_dir:
+                self.children.setdefault(name, {})
+            # archives may omit directory entries, the parents are implied by the member names
+            while True:
+                parent, _, basename = name.rpartition('/')
+                self.children.setdefault(parent, {})[basename] = self.members[name]
+                if not parent or parent in self.members:
+                    break
+                self.members[parent] = ArchiveMember(parent, True, 0, member.mtime, -1)
+                name = parent
+
+    @classmethod
+    def supports(cls, path: str) -> bool:
+        return path.lower().endswith(cls.EXTENSIONS)
+
+    @classmethod
+    def stat_key(cls, stat: os.stat_result) -> tuple:
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    @classmethod
+    def load(cls, path: str, index_dir: str) -> Archive:
+        import zipfile
+        import tarfile
+        key = cls.stat_key(os.stat(path))
+        try:
+            if path.lower().endswith('.zip'):
+                archive = zipfile.ZipFile(path)
+                return cls(path, key, [
+                    ArchiveMember(info.filename, info.is_dir(), info.file_size,
+                                  time.mktime(info.date_time + (0, 0, -1)), i)
+                    for i, info in enumerate(archive.infolist())
+                ], zip=archive)
+            index_path = os.path.join(index_dir, hashlib.sha256(os.fsencode(path)).hexdigest() + '.json')
+            with suppress(OSError, ValueError, KeyError, TypeError):
+                with open(index_path) as f:
+                    if os.fstat(f.fileno()).st_size > cls.MAX_INDEX_SIZE:
+                        raise ValueError('index too large')
+                    index = json.load(f)
+                if index['version'] == cls.INDEX_VERSION and tuple(index['key']) == key:
+                    members = [ArchiveMember(*member) for member in index['members']]
+                    if all(cls.__valid_member(member, key[2], compressed=not path.lower().endswith('.tar'))
+                           for member in members):
+                        return cls(path, key, members)
+            with tarfile.open(path, 'r:*') as archive:
+                members = [
+                    ArchiveMember(info.name, info.isdir(), info.size, info.mtime, info.offset_data)
+                    for info in archive if info.isreg() or info.isdir()
+                ]
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+            raise ValueError(f'not a readable archive: {e}') from e
+        with suppress(OSError):
+            os.makedirs(index_dir, exist_ok=True)
+            file = AtomicFile(index_path, 0o600)
+            try:
+                file.write(json.dumps({'version': cls.INDEX_VERSION, 'key': key, 'members': members}).encode())
+                file.flush(sync=False)
+                file.commit()
+            except BaseException:
+                file.abort()
+                raise
+        return cls(path, key, members)
+
+    @classmethod
+    def __valid_member(cls, member: ArchiveMember, archive_size: int, compressed: bool) -> bool:
+        # a stale or damaged index is scanned again rather than trusted; offsets into a compressed
+        # tar count decompressed bytes, so only a plain tar bounds them by its own size
+        return (isinstance(member.name, str) and isinstance(member.is_dir, bool)
+                and isinstance(member.size, int) and isinstance(member.offset, int)
+                and isinstance(member.mtime, (int, float)) and member.size >= 0 and member.offset >= 0
+                and (compressed or member.offset + member.size <= archive_size))
+
+    def listing(self, directory: str) -> Listing:
+        listing = Listing(f'{self.path}/{directory}')
+        for name, member in self.children[directory].items():
+            listing.append(name, EntryType.DIRECTORY if member.is_dir else EntryType.FILE, True, False,
+                           member.size, member.mtime, member.mtime, member.mtime)
+        return listing.sort()
+
+    def read(self, member: ArchiveMember, start: int = 0, length: Optional[int] = None, chunk_size: int = 1024 * 1024):
+        # decompresses as it goes; zip members and plain tars start at the member (a stored zip member or
+        # a plain tar even at start), compressed ones must decompress everything before it
+        length = member.size - start if length is None else length
+        if self.zip is not None:
+            with self.zip.open(self.zip.infolist()[member.offset]) as f:
+                f.seek(start)
+                while length > 0 and (chunk := f.read(min(chunk_size, length))):
+                    length -= len(chunk)
+                    yield chunk
+            return
+        import tarfile
+        info = tarfile.TarInfo(member.name)
+        info.size, info.offset_data = member.size, member.offset
+        with tarfile.open(self.path, 'r:*') as archive, archive.extractfile(info) as f:
+            f.seek(start)
+            while length > 0 and (chunk := f.read(min(chunk_size, length))):
+                length -= len(chunk)
+                yield chunk
+
+
+class ArchiveCache:
+    def __init__(self, index_dir: str, capacity: int = 16):
+        self.index_dir = index_dir
+        self.capacity = capacity
+        self.archives: OrderedDict[str, Archive] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path: str, load: bool = True) -> Optional[Archive]:
+        key = Archive.stat_key(os.stat(path))
+        with self.lock:
+            archive = self.archives.get(path)
+            if archive is not None and archive.key == key:
+                self.archives.move_to_end(path)
+                return archive
+        if not load:
+            return None
+        archive = Archive.load(path, self.index_dir)
+        with self.lock:
+            self.archives[path] = archive
+            while len(self.archives) > self.capacity:
+                self.archives.popitem(last=False)
+        return archive
+
+
+class ChunkReader:
+    # A file-like reader over a next_chunk() callable, with push back for bytes read ahead
+    def __init__(self, next_chunk):
+        self.next_chunk = next_chunk
+        self.buffer = b''
+        self.eof = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.buffer and not self.eof:
+            self.buffer = self.next_chunk()
+            self.eof = not self.buffer
+        if size < 0:
+            chunks = [self.buffer]
+            while chunk := self.next_chunk():
+                chunks.append(chunk)
+            self.buffer, self.eof = b'', True
+            return b''.join(chunks)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    def read_exact(self, size: int) -> bytes:
+        chunks = []
+        while size > 0 and (chunk := self.read(size)):
+            chunks.append(chunk)
+            size -= len(chunk)
+        if size > 0:
+            raise ValueError('unexpected end of archive')
+        return b''.join(chunks)
+
+    def readline(self, limit: int = 64 * 1024) -> bytes:
+        line = b''
+        while len(line) < limit and (chunk := self.read(limit - len(line))):
+            head, newline, rest = chunk.partition(b'\n')
+            line += head + newline
+            if newline:
+                self.unread(rest)
+                break
+        return line
+
+    def unread(self, data: bytes):
+        self.buffer = data + self.buffer
+
+
+class ZipStreamEntry:
+    # One member read from its local header onwards, so the central directory at the end is never needed
+    def __init__(self, source: ChunkReader, method: int, compressed_size: Optional[int], descriptor: bool,
+                 zip64: bool, crc: int):
+        import zlib
+        self.source = source
+        self.method = method
+        self.remaining = compressed_size
+        self.descriptor = descriptor
+        self.zip64 = zip64
+        self.expected_crc = crc
+        self.crc = 0
+        self.size = 0
+        self.done = False
+        self.decompressor = zlib.decompressobj(-15) if method == 8 else None
+
+    def read(self, size: int = 1024 * 1024) -> bytes:
+        import zlib
+        if self.done:
+            return b''
+        if self.decompressor is None:
+            chunk = self.source.read(min(size, self.remaining))
+            if not chunk and self.remaining:
+                raise ValueError('unexpected end of archive')
+            self.remaining -= len(chunk)
+            finished = self.remaining == 0
+        else:
+            chunk = b''
+            while not chunk and not self.decompressor.eof:
+                data = self.decompressor.unconsumed_tail
+                if not data:
+                    data = self.source.read(65536 if self.remaining is None else min(65536, self.remaining))
+                    if not data:
+                        raise ValueError('unexpected end of archive')
+                    if self.remaining is not None:
+                        self.remaining -= len(data)
+                chunk = self.decompressor.decompress(data, size)
+            finished = self.decompressor.eof
+        self.crc = zlib.crc32(chunk, self.crc)
+        self.size += len(chunk)
+        if finished:
+            self.__finish()
+        return chunk
+
+    def __finish(self):
+        import struct
+        self.done = True
+        if self.decompressor is not None:
+            self.source.unread(self.decompressor.unused_data)
+            if self.remaining:
+                self.source.read_exact(self.remaining)
+        if self.descriptor:
+            crc = self.source.read_exact(4)
+            if crc == b'PK\x07\x08':
+                crc = self.source.read_exact(4)
+            self.source.read_exact(16 if self.zip64 else 8)
+            self.expected_crc, = struct.unpack('<I', crc)
+        if self.crc != self.expected_crc:
+            raise ValueError('checksum mismatch, the archive is corrupted')
+
+    def drain(self):
+        while self.read():
+            pass
+
+
+class ArchiveStream:
+    # Entries of a zip or (compressed) tar as its bytes arrive: (name, kind, reader), where kind is
+    # 'file', 'directory' or 'other' and a file's reader must be consumed before the next entry
+    @classmethod
+    def entries(cls, source: ChunkReader):
+        magic = source.read_exact(4)
+        source.unread(magic)
+        if magic == b'PK\x03\x04':
+            yield from cls.__zip_entries(source)
+            return
+        import tarfile
+        stream = source
+        if magic == b'\x28\xb5\x2f\xfd':
+            # zstandard is not in tarfile's stream mode (before 3.14), and is an optional package
+            try:
+                from compression import zstd
+                stream = zstd.ZstdFile(source)
+            except ImportError:
+                try:
+                    import zstandard
+                except ImportError:
+                    raise ValueError('zstd archives need the zstandard package') from None
+                stream = zstandard.ZstdDecompressor().stream_reader(source)
+        try:
+            with tarfile.open(fileobj=stream, mode='r|*') as archive:
+                for info in archive:
+                    if info.isreg():
+                        yield info.name, 'file', archive.extractfile(info)
+                    else:
+                        yield info.name, 'directory' if info.isdir() else 'other', None
+        except (tarfile.TarError, EOFError, OSError) as e:
+            raise ValueError(f'not a readable archive: {e}') from e
+
+    @classmethod
+    def __zip_entries(cls, source: ChunkReader):
+        import struct
+        while source.read_exact(4) == b'PK\x03\x04':
+            (_, flags, method, _, _, crc, compressed_size, size,
+             name_length, extra_length) = struct.unpack('<HHHHHIIIHH', source.read_exact(26))
+            name = source.read_exact(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+            extra = source.read_exact(extra_length)
+            zip64 = False
+            offset = 0
+            while offset + 4 <= len(extra):
+                tag, length = struct.unpack_from('<HH', extra, offset)
+                if tag == 0x0001:
+                    # zip64 sizes, only those that overflowed, in this order
+                    zip64, fields = True, extra[offset + 4:offset + 4 + length]
+                    if size == 0xFFFFFFFF:
+                        size, = struct.unpack_from('<Q', fields)
+                        fields = fields[8:]
+                    if compressed_size == 0xFFFFFFFF:
+                        compressed_size, = struct.unpack_from('<Q', fields)
+                offset += 4 + length
+            if flags & 0x1:
+                raise ValueError(f'{name}: encrypted entries are not supported')
+            if method not in (0, 8):
+                raise ValueError(f'{name}: unsupported compression method {method}')
+            descriptor = bool(flags & 0x8)
+            if descriptor and method == 0:
+                if not name.endswith('/'):
+                    raise ValueError(f'{name}: stored entries with a data descriptor cannot be streamed')
+                compressed_size = 0  # a directory has no data, its size is known after all
+            entry = ZipStreamEntry(source, method, None if descriptor and method == 8 else compressed_size,
+                                   descriptor, zip64, crc)
+            if name.endswith('/'):
+                yield name, 'directory', None
+            else:
+                yield name, 'file', entry
+            entry.drain()
+        # the central directory follows the last entry, nothing in it is needed
+
+
+class Replication:
+    # Mutations are appended to a journal and shipped in batches to every peer, which applies them idempotently.
+    # An anti-entropy pass compares directory digests with each peer and pushes what the journal missed.
+    BATCH_OPS = 1000
+    BATCH_BYTES = 64 * 1024 * 1024
+    BATCH_DELAY = 0.2
+    RETRY_MAX = 60
+
+    def __init__(self, root: str, state_dir: str, checksum: Checksum, peers: tuple[str, ...] = (),
+                 auth: Optional[str] = None, interval: float = 300):
+        self.root = root
+        self.state_dir = state_dir
+        self.checksum = checksum
+        self.interval = interval
+        self.journal_path = os.path.join(state_dir, 'replication', 'journal')
+        self.state_path = os.path.join(state_dir, 'replication', 'state.json')
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.state = {'node': secrets.token_hex(6), 'seq': 0, 'peers': {}, 'applied': {}}
+        with suppress(OSError, ValueError), open(self.state_path) as f:
+            self.state.update(json.load(f))
+        self.seq = self.state['seq']
+        self.size = 0
+        self.fd = None
+        self.peers = [{
+            'url': url, 'client': Client(url, auth, connections=2), 'offset': self.state['peers'].get(url, 0),
+            'sync': False, 'shipped': 0, 'errors': 0, 'last_error': None, 'last_shipped': None, 'last_sync': None,
+        } for url in peers]
+        if self.peers:
+            self.__open_journal()
+            for peer in self.peers:
+                threading.Thread(target=self.__run, args=(peer,), name='replication', daemon=True).start()
+
+    def __open_journal(self):
+        # drops a line torn by a crash, and continues the sequence after the last one written
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        self.fd = os.open(self.journal_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        size = os.lseek(self.fd, 0, os.SEEK_END)
+        start = max(0, size - 64 * 1024)
+        tail = os.pread(self.fd, size - start, start)
+        self.size = start + tail.rfind(b'\n') + 1
+        if self.size != size:
+            os.ftruncate(self.fd, self.size)
+        lines = tail[:self.size - start].splitlines()
+        if lines:
+            self.seq = max(self.seq, json.loads(lines[-1])['seq'])
+        for peer in self.peers:
+            peer['offset'] = min(peer['offset'], self.size)
+        self.__save_state()
+
+    def __save_state(self):
+        self.state['seq'] = self.seq
+        self.state['peers'] = {peer['url']: peer['offset'] for peer in self.peers}
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        temp_path = f'{self.state_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fdatasync(f.fileno())
+        os.replace(temp_path, self.state_path)
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.root, *path.split('/'))
+
+    def record(self, ops: list[dict]):
+        # ops are {'op': 'put'|'mkdir'|'delete'|'move', 'path': ..., 'target': ...} relative to the root
+        if not self.peers or not ops:
+            return
+        with self.lock:
+            lines = []
+            for op in ops:
+                self.seq += 1
+                lines.append(json.dumps({'seq': self.seq, 'time': time.time(), **op}) + '\n')
+            data = ''.join(lines).encode()
+            os.write(self.fd, data)
+            os.fdatasync(self.fd)
+            self.size += len(data)
+            self.changed.notify_all()
+
+    def applied(self, origin: str) -> int:
+        with self.lock:
+            return self.state['applied'].get(origin, 0)
+
+    def mark_applied(self, origin: str, seq: int):
+        with self.lock:
+            self.state['applied'][origin] = max(seq, self.state['applied'].get(origin, 0))
+            self.__save_state()
+
+    def sync(self):
+        with self.lock:
+            for peer in self.peers:
+                peer['sync'] = True
+            self.changed.notify_all()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'node': self.state['node'],
+                'seq': self.seq,
+                'journal_bytes': self.size,
+                'peers': [{
+                    'url': peer['url'],
+                    'pending_bytes': self.size - peer['offset'],
+                    **{key: peer[key] for key in ('shipped', 'errors', 'last_error', 'last_shipped', 'last_sync')},
+                } for peer in self.peers],
+            }
+
+    def entries(self, directory: str, memo: Optional[dict] = None) -> dict[str, dict]:
+        # files by size and content digest, directories by a digest of their own entries; symlinks are not replicated
+        memo = {} if memo is None else memo
+        result = {}
+        with suppress(OSError), os.scandir(directory) as items:
+            for item in items:
+                if item.path == self.state_dir:
+                    continue
+                with suppress(OSError):
+                    if item.is_dir(follow_symlinks=False):
+                        result[item.name] = {'type': 'directory', 'digest': self.digest(item.path, memo)}
+                    elif item.is_file(follow_symlinks=False):
+                        result[item.name] = {'type': 'file', 'size': item.stat(follow_symlinks=False).st_size,
+                                             'sha256': self.checksum.digest(item.path, 'sha256')}
+        return result
+
+    def digest(self, directory: str, memo: dict) -> str:
+        if directory not in memo:
+            entries = json.dumps(self.entries(directory, memo), sort_keys=True)
+            memo[directory] = hashlib.sha256(entries.encode()).hexdigest()
+        return memo[directory]
+
+    def __run(self, peer: dict):
+        delay = 1
+        next_sync = time.monotonic() if self.interval else None
+        while True:
+            with self.lock:
+                while peer['offset'] >= self.size and not peer['sync'] \
+                        and (next_sync is None or time.monotonic() < next_sync):
+                    self.changed.wait(None if next_sync is None else next_sync - time.monotonic())
+            # let a burst of mutations share a batch
+            time.sleep(self.BATCH_DELAY)
+            try:
+                while self.__ship(peer):
+                    pass
+                if peer['sync'] or next_sync is not None and time.monotonic() >= next_sync:
+                    peer['sync'] = False
+                    self.__sync(peer)
+                    peer['last_sync'] = time.time()
+                    next_sync = time.monotonic() + self.interval if self.interval else None
+                peer['last_error'] = None
+                delay = 1
+            except (OSError, ValueError) as e:
+                peer['last_error'] = str(e)
+                time.sleep(delay)
+                delay = min(delay * 2, self.RETRY_MAX)
+
+    def __ship(self, peer: dict) -> bool:
+        with self.lock:
+            offset, size = peer['offset'], self.size
+        if offset >= size:
+            return False
+        ops, end, total = [], offset, 0
+        with open(self.journal_path, 'rb') as f:
+            f.seek(offset)
+            while end < size and len(ops) < self.BATCH_OPS and total < self.BATCH_BYTES:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                op = json.loads(line)
+                ops.append(op)
+                end += len(line)
+                with suppress(OSError):
+                    if op['op'] in ('put', 'move'):
+                        total += os.stat(self.local_path(op.get('target', op['path']))).st_size
+        self.__send(peer, ops)
+        with self.lock:
+            peer['offset'] = end
+            peer['last_shipped'] = time.time()
+            if all(other['offset'] == self.size for other in self.peers):
+                # every peer has the whole journal, start it over
+                for other in self.peers:
+                    other['offset'] = 0
+                self.__save_state()
+                os.ftruncate(self.fd, 0)
+                self.size = 0
+            else:
+                self.__save_state()
+        return True
+
+    def __sync(self, peer: dict):
+        # walks down only where the peer's directory digest differs; the peer keeps its copy if that is newer
+        client = peer['client']
+        memo = {}
+        pending = ['']
+        ops = []
+        while pending:
+            directory = pending.pop()
+            local = self.entries(self.local_path(directory) if directory else self.root, memo)
+            response, data = client.request('GET', client.url(Constant.STATE_DIR_NAME, 'replicate') + '?path=' +
+                                            urlquote(directory, safe=''))
+            if response.status != 200:
+                raise OSError(f'digest of {directory or "/"}: {response.status}')
+            remote = json.loads(data)
+            for name, entry in local.items():
+                if remote.get(name) == entry:
+                    continue
+                path = f'{directory}/{name}'.lstrip('/')
+                if entry['type'] == 'directory':
+                    if name not in remote:
+                        ops.append({'op': 'mkdir', 'path': path})
+                    pending.append(path)
+                else:
+                    ops.append({'op': 'put', 'path': path})
+        for start in range(0, len(ops), self.BATCH_OPS):
+            self.__send(peer, ops[start:start + self.BATCH_OPS])
+
+    def __send(self, peer: dict, ops: list[dict]):
+        client = peer['client']
+        response, data = client.request('POST', client.url(Constant.STATE_DIR_NAME, 'replicate'),
+                                        {'Content-Type': 'application/x-webdir-replication'},
+                                        lambda: self.__batch(ops))
+        if response.status != 200:
+            raise OSError(f'{response.status} {data[:200].decode(errors="replace")}')
+        errors = json.loads(data).get('errors', {})
+        with self.lock:
+            peer['shipped'] += len(ops)
+            peer['errors'] += len(errors)
+            if errors:
+                peer['last_error'] = '{}: {}'.format(*next(iter(errors.items())))
+
+    def __batch(self, ops: list[dict]):
+        # a JSON line per op; file contents follow their line, read when the batch is sent rather than when recorded
+        yield json.dumps({'origin': self.state['node']}).encode() + b'\n'
+        for op in ops:
+            if op['op'] not in ('put', 'move'):
+                yield json.dumps(op).encode() + b'\n'
+                continue
+            path = self.local_path(op.get('target', op['path']))
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                stat = None
+            if stat is None or not S_ISREG(stat.st_mode):
+                if op['op'] == 'move':
+                    yield json.dumps(op).encode() + b'\n'
+                elif stat is not None and S_ISDIR(stat.st_mode):
+                    yield json.dumps({**op, 'op': 'mkdir'}).encode() + b'\n'
+                # otherwise it is gone, a later delete or move in the journal tells where
+                continue
+            with open(path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                yield json.dumps({**op, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}).encode() + b'\n'
+                remaining = stat.st_size
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        raise OSError(f'{path} was truncated while it was sent')
+                    remaining -= len(chunk)
+                    yield chunk
+
+
+class Limiter:
+    MAX_IDLE_BUCKETS = 4096
+
+    def __init__(self,
+                 request_rate: Optional[float] = None,
+                 request_burst: Optional[float] = None,
+                 max_downloads: Optional[int] = None,
+                 bandwidth: Optional[int] = None,
+                 max_expensive: Optional[int] = None,
+                 expensive_timeout: float = 30.0):
+        import asyncio
+        self.request_rate = request_rate
+        self.request_burst = request_burst or max(1.0, request_rate or 1.0)
+        self.max_downloads = max_downloads
+        self.bandwidth = bandwidth
+        self.expensive_timeout = expensive_timeout
+        self.expensive = asyncio.Semaphore(max_expensive) if max_expensive else None
+        self.request_buckets: dict[str, TokenBucket] = {}
+        self.bandwidth_buckets: dict[str, TokenBucket] = {}
+        self.downloads: dict[str, int] = {}
+        self.rejected = 0
+
+    @classmethod
+    def client_key(cls, request: Request) -> str:
+        user = getattr(request.state, 'user', None)
+        if user is not None:
+            return f'user:{user}'
+        return 'ip:{}'.format(request.client.host if request.client else '')
+
+    def __bucket(self, buckets: dict[str, TokenBucket], key: str, rate: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.MAX_IDLE_BUCKETS:
+                for idle_key in [k for k, b in buckets.items() if b.is_idle()]:
+                    del buckets[idle_key]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def admit_request(self, key: str) -> Optional[float]:
+        # Returns None if admitted, otherwise the number of seconds to wait
+        if not self.request_rate:
+            return None
+        bucket = self.__bucket(self.request_buckets, key, self.request_rate, self.request_burst)
+        if bucket.try_consume():
+            return None
+        self.rejected += 1
+        return bucket.retry_after()
+
+    def open_download(self, key: str) -> bool:
+        count = self.downloads.get(key, 0)
+        if self.max_downloads and count >= self.max_downloads:
+            self.rejected += 1
+            return False
+        self.downloads[key] = count + 1
+        return True
+
+    def close_download(self, key: str):
+        count = self.downloads.pop(key, 1) - 1
+        if count > 0:
+            self.downloads[key] = count
+
+    def shape(self, key: str, response: Response) -> Response:
+        # The caller must have called open_download(key) successfully
+        bucket = None
+        if self.bandwidth:
+            # one second worth of burst, but never less than a few chunks
+            bucket = self.__bucket(self.bandwidth_buckets, key, self.bandwidth, max(self.bandwidth, 256 * 1024))
+        return ThrottledResponse(response, bucket, lambda: self.close_download(key))
+
+    @asynccontextmanager
+    async def expensive_action(self):
+        import asyncio
+        if self.expensive is None:
+            yield True
+            return
+        try:
+            await asyncio.wait_for(self.expensive.acquire(), self.expensive_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.expensive.release()
+
+
+class Auth:
+    SESSION_COOKIE = 'webdir_session'
+    HASH_SCHEME = 'pbkdf2_sha256'
+    HASH_ITERATIONS = 200000
+    # password checks per client IP that did not end in a cached login, as a token bucket
+    ATTEMPT_RATE = 1
+    ATTEMPT_BURST = 10
+    MAX_ATTEMPT_BUCKETS = 4096
+
+    def __init__(self, users: dict[str, str], session_ttl: int = 12 * 3600, cache_size: int = 1024, cache_ttl: int = 300):
+        # users maps username to an encoded password hash (see hash_password)
+        self.users = dict(users)
+        self.session_ttl = session_ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.secret = secrets.token_bytes(32)
+        # (client host, keyed digest of the Authorization header) -> (username, expiry)
+        self.cache: OrderedDict[tuple[str, bytes], tuple[str, float]] = OrderedDict()
+        self.attempts: dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+        # verified against when the username is unknown, so both paths cost the same
+        self.dummy_hash = self.hash_password(secrets.token_hex(8))
+
+    @classmethod
+    def hash_password(cls, password: str, salt: Optional[bytes] = None, iterations: Optional[int] = None) -> str:
+        salt = salt or secrets.token_bytes(16)
+        iterations = iterations or cls.HASH_ITERATIONS
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+        return '{}${}${}${}'.format(cls.HASH_SCHEME, iterations, base64.b64encode(salt).decode(), base64.b64encode(digest).decode())
+
+    @classmethod
+    def verify_password(cls, password: str, encoded: str) -> bool:
+        try:
+            scheme, iterations, salt, expected = encoded.split('$')
+            assert scheme == cls.HASH_SCHEME
+            salt, expected = base64.b64decode(salt), base64.b64decode(expected)
+            iterations = int(iterations)
+        except (ValueError, AssertionError):
+            return False
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+        return hmac.compare_digest(digest, expected)
+
+    @classmethod
+    def load_users(cls, path: str) -> dict[str, str]:
+        users = {}
+        with open(path) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                username, sep, encoded = line.partition(':')
+                if not sep or not username or not encoded.startswith(cls.HASH_SCHEME + '$'):
+                    raise ValueError(f'{path}:{lineno}: expected <USER>:{cls.HASH_SCHEME}$...')
+                users[username] = encoded
+        return users
+
+    def update(self, users: dict[str, str], session_ttl: int):
+        # sessions stay valid for users that still exist with the same password, cached credentials are checked again
+        self.users = dict(users)
+        self.session_ttl = session_ttl
+        with self.lock:
+            self.cache.clear()
+
+    def __sign(self, payload: bytes, key: bytes = b'') -> bytes:
+        return hmac.new(self.secret, payload + b'\0' + key, hashlib.sha256).digest()
+
+    def issue_session(self, username: str) -> str:
+        # the stored hash is part of the signature, so a new password (on reload) ends the user's sessions
+        expiry = int(time.time()) + self.session_ttl
+        payload = f'{expiry}:{username}'.encode()
+        signature = self.__sign(payload, self.users[username].encode())
+        return '{}.{}'.format(base64.urlsafe_b64encode(payload).decode().rstrip('='),
+                              base64.urlsafe_b64encode(signature).decode().rstrip('='))
+
+    def verify_session(self, token: str) -> Optional[str]:
+        with suppress(ValueError, UnicodeDecodeError):
+            payload, signature = (base64.urlsafe_b64decode(part + '=' * (-len(part) % 4))
+                                  for part in token.split('.'))
+            expiry, username = payload.decode().split(':', 1)
+            encoded = self.users.get(username)
+            if encoded is None or not hmac.compare_digest(self.__sign(payload, encoded.encode()), signature):
+                return None
+            if int(expiry) > time.time():
+                return username
+        return None
+
+    def session_cookie(self, username: str, path: str, secure: bool) -> str:
+        cookie = SimpleCookie()
+        cookie[self.SESSION_COOKIE] = self.issue_session(username)
+        morsel = cookie[self.SESSION_COOKIE]
+        morsel.update({'max-age': self.session_ttl, 'path': path, 'httponly': True, 'samesite': 'Lax', 'secure': secure})
+        return morsel.OutputString()
+
+    def cached_basic(self, client: str, authorization: str) -> Optional[str]:
+        key = (client, self.__sign(authorization.encode()))
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                username, expiry = cached
+                if expiry > time.monotonic() and username in self.users:
+                    self.cache.move_to_end(key)
+                    return username
+                del self.cache[key]
+        return None
+
+    def __attempt(self, client: str) -> TokenBucket:
+        # a client out of attempts is refused before any hashing, which is what a guessing flood would cost
+        with self.lock:
+            bucket = self.attempts.get(client)
+            if bucket is None:
+                if len(self.attempts) >= self.MAX_ATTEMPT_BUCKETS:
+                    for idle_client in [k for k, b in self.attempts.items() if b.is_idle()]:
+                        del self.attempts[idle_client]
+                bucket = self.attempts[client] = TokenBucket(self.ATTEMPT_RATE, self.ATTEMPT_BURST)
+            if not bucket.try_consume():
+                raise HTTPException(status_code=429, detail='too many login attempts',
+                                    headers={'Retry-After': str(max(1, round(bucket.retry_after())))})
+        return bucket
+
+    def verify_basic(self, client: str, authorization: str) -> Optional[str]:
+        # about a tenth of a second of hashing, so it runs off the event loop once cached_basic missed
+        scheme, _, param = authorization.partition(' ')
+        if scheme.lower() != 'basic':
+            return None
+        try:
+            username, sep, password = base64.b64decode(param).decode().partition(':')
+        except (ValueError, UnicodeDecodeError):
+            return None
+        if not sep:
+            return None
+        bucket = self.__attempt(client)
+        encoded = self.users.get(username)
+        if not self.verify_password(password, encoded or self.dummy_hash) or encoded is None:
+            return None
+
+        key = (client, self.__sign(authorization.encode()))
+        with self.lock:
+            bucket.refund()
+            self.cache[key] = (username, time.monotonic() + self.cache_ttl)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return username
+
+    async def authenticate(self, request: Request) -> tuple[Optional[str], bool]:
+        # Returns (username, whether a new session cookie should be issued)
+        token = request.cookies.get(self.SESSION_COOKIE)
+        if token:
+            username = self.verify_session(token)
+            if username is not None:
+                return username, False
+        authorization = request.headers.get('Authorization')
+        if authorization:
+            client = request.client.host if request.client else ''
+            username = self.cached_basic(client, authorization)
+            if username is None:
+                username = await run_in_threadpool(self.verify_basic, client, authorization)
+            if username is not None:
+                return username, True
+        return None, False
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, thread_id: int):
+        self.method = method
+        self.path = path
+        self.thread_id = thread_id
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.samples: dict[str, int] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+
+class Profiler:
+    # Samples the event loop thread and keeps the stacks that run under a request, so the cost is a
+    # few frame walks per interval rather than a tracing hook on every call
+    def __init__(self, output_dir: str, enabled: bool = False, threshold: float = 0.5, interval: float = 0.005,
+                 keep: int = 100):
+        self.output_dir = output_dir
+        self.enabled = enabled
+        self.threshold = threshold
+        self.interval = interval
+        self.keep = keep
+        self.active: dict[int, RequestProfile] = {}  # id of the request's root frame -> profile
+        self.captured = 0
+        self.sampler = None
+
+    @staticmethod
+    def phase(request: Request, name: str):
+        profile = getattr(request.state, 'profile', None)
+        return nullcontext() if profile is None else profile.phase(name)
+
+    def start(self, method: str, path: str, root_frame) -> Optional[RequestProfile]:
+        if not self.enabled:
+            return None
+        if self.sampler is None or not self.sampler.is_alive():
+            self.sampler = threading.Thread(target=self.__sample, name='webdir-profiler', daemon=True)
+            self.sampler.start()
+        profile = RequestProfile(method, path, threading.get_ident())
+        self.active[id(root_frame)] = profile
+        return profile
+
+    def finish(self, root_frame, status: Optional[int]):
+        profile = self.active.pop(id(root_frame), None)
+        if profile is None:
+            return
+        elapsed = time.perf_counter() - profile.started
+        if elapsed >= self.threshold:
+            self.captured += 1
+            profile.samples = dict(profile.samples)  # the sampler may still hold the old one
+            threading.Thread(target=self.__write, args=(profile, elapsed, status), daemon=True).start()
+
+    def __sample(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            thread_ids = {profile.thread_id for profile in tuple(self.active.values())}
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame, stack = frames.get(thread_id), []
+                while frame is not None and id(frame) not in self.active:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                profile = frame is not None and self.active.get(id(frame))
+                if profile:
+                    folded = ';'.join([f'{profile.method} request', *reversed(stack)])
+                    profile.samples[folded] = profile.samples.get(folded, 0) + 1
+
+    def __write(self, profile: RequestProfile, elapsed: float, status: Optional[int]):
+        slug = re.sub(r'[^A-Za-z0-9._-]+', '_', profile.path).strip('_')[:64] or 'root'
+        name = '{}-{}-{}-{}ms'.format(datetime.now().strftime('%Y%m%d-%H%M%S-%f'), profile.method, slug,
+                                      round(elapsed * 1000))
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            # folded stacks, one "frame;frame;frame count" line each, for flamegraph.pl, inferno or speedscope
+            with open(os.path.join(self.output_dir, name + '.folded'), 'w') as f:
+                for stack, count in sorted(profile.samples.items()):
+                    f.write(f'{stack} {count}\n')
+            with open(os.path.join(self.output_dir, name + '.json'), 'w') as f:
+                json.dump({
+                    'method': profile.method,
+                    'path': profile.path,
+                    'status': status,
+                    'elapsed_ms': round(elapsed * 1000, 3),
+                    'phases_ms': {phase: round(seconds * 1000, 3) for phase, seconds in profile.phases.items()},
+                    'samples': sum(profile.samples.values()),
+                    'interval_ms': self.interval * 1000,
+                }, f, indent=2)
+            for stale in self.captures()[self.keep:]:
+                for suffix in ('.json', '.folded'):
+                    with suppress(FileNotFoundError):
+                        os.remove(os.path.join(self.output_dir, stale + suffix))
+        except OSError:
+            traceback.print_exc()
+
+    def captures(self) -> list[str]:
+        # newest first, the timestamp prefix sorts chronologically
+        with suppress(FileNotFoundError):
+            return sorted((entry[:-len('.json')] for entry in os.listdir(self.output_dir) if entry.endswith('.json')),
+                          reverse=True)
+        return []
+
+    def status(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'threshold_ms': self.threshold * 1000,
+            'interval_ms': self.interval * 1000,
+            'output_dir': self.output_dir,
+            'active': len(self.active),
+            'captured': self.captured,
+            'recent': self.captures()[:20],
+        }
+
+
+class ProfileMiddleware:
+    # Plain ASGI, so it wraps both the built-in core and FastAPI
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.profiler.enabled:
+            return await self.app(scope, receive, send)
+        root_frame = sys._getframe()
+        profile = self.profiler.start(scope['method'], scope['path'], root_frame)
+        status = None
+
+        async def timed_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            with profile.phase('send'):
+                await send(message)
+
+        scope.setdefault('state', {})['profile'] = profile
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            self.profiler.finish(root_frame, status)
+
+
+class LogWriter:
+    # JSON lines, formatted and written in batches by a background thread. When the queue is full records are
+    # dropped and counted, a request never waits for the disk.
+    FLUSH_INTERVAL = 1.0
+    BATCH_SIZE = 1000
+
+    def __init__(self, path: str, max_size: Optional[int] = 64 * 1024 * 1024, max_age: Optional[float] = 86400,
+                 keep: int = 5, queue_size: int = 10000):
+        import queue
+        import atexit
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.keep = keep
+        self.queue = queue.Queue(queue_size)
+        self.file = None
+        self.size = 0
+        self.opened = 0.0
+        self.written = 0
+        self.dropped = 0
+        self.rotated = 0
+        self.thread = threading.Thread(target=self.__run, name='log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, record: dict):
+        import queue
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        import queue
+        with suppress(queue.Full):
+            self.queue.put(None, timeout=1)
+        self.thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        return {
+            'path': self.path,
+            'written': self.written,
+            'dropped': self.dropped,
+            'queued': self.queue.qsize(),
+            'rotated': self.rotated,
+        }
+
+    def __run(self):
+        import queue
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.FLUSH_INTERVAL
+            while batch[-1] is not None and len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            try:
+                self.__write(records)
+                self.written += len(records)
+            except (OSError, ValueError, TypeError):
+                self.dropped += len(records)
+                traceback.print_exc()
+            if batch[-1] is None:
+                return
+
+    def __write(self, records: list[dict]):
+        if not records:
+            return
+        for record in records:
+            record['time'] = datetime.fromtimestamp(record['time'], timezone.utc).isoformat(timespec='milliseconds')
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        if self.path == '-':
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+        if self.file is None:
+            self.__open()
+        if self.size and (self.max_size and self.size + len(data) > self.max_size
+                          or self.max_age and time.time() - self.opened > self.max_age):
+            self.__rotate()
+            self.__open()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def __open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+        self.opened = time.time()
+
+    def __rotate(self):
+        # path.1 is the newest, path.<keep> the oldest kept
+        self.file.close()
+        self.file = None
+        for i in range(self.keep - 1, 0, -1):
+            with suppress(FileNotFoundError):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.keep > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.rotated += 1
+
+
+class AccessLogMiddleware:
+    # Plain ASGI like ProfileMiddleware, the record is only queued here
+    def __init__(self, app, log: LogWriter):
+        self.app = app
+        self.log = log
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = None
+        sent = 0
+
+        async def counted_send(message):
+            nonlocal status, sent
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                sent += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, counted_send)
+        finally:
+            headers = {}
+            for name, value in scope['headers']:
+                if name in (b'user-agent', b'content-length', b'referer'):
+                    headers[name.decode()] = value.decode('latin-1')
+            self.log.write({
+                'time': time.time(),
+                'client': scope['client'][0] if scope.get('client') else None,
+                'user': scope.get('state', {}).get('user'),
+                'method': scope['method'],
+                'path': scope['path'],
+                'query': scope['query_string'].decode('latin-1'),
+                'status': status,
+                'request_bytes': int(headers['content-length']) if headers.get('content-length', '').isdigit() else None,
+                'bytes': sent,
+                'latency_ms': round((time.perf_counter() - started) * 1000, 3),
+                'user_agent': headers.get('user-agent'),
+                'referer': headers.get('referer'),
+            })
+
+
 class Handler:
-    def __init__(self, root: str, base_path: str, no_list: bool, no_modify: bool, create_writable: bool, index_file: str):
+    def __init__(self, root: str, base_path: str, no_list: bool, no_modify: bool, create_writable: bool, index_file: str,
+                 limiter: Optional[Limiter] = None, durability: Durability = Durability.NONE,
+                 dedup: Optional[str] = None, upload_hash: Optional[str] = None,
+                 offload: Optional[str] = None, offload_prefix: str = '/', admins: Optional[set[str]] = None,
+                 profile: bool = False, profile_dir: Optional[str] = None, profile_threshold: float = 500,
+                 profile_interval: float = 5, large_transfer: Optional[int] = 64 * 1024 * 1024,
+                 file_cache: Optional[FileCache] = None, replicate_to: tuple[str, ...] = (),
+                 replicate_auth: Optional[str] = None, replicate_interval: float = 300,
+                 replicate_peers: Optional[set[str]] = None, quotas: Optional[dict[str, int]] = None, user_quotas: Optional[dict[str, int]] = None,
+                 min_free: int = 0, trash: bool = False, trash_retention: float = 86400,
+                 trash_max: Optional[int] = None, trash_rate: float = 1000,
+                 access_log: Optional[LogWriter] = None, audit_log: Optional[LogWriter] = None,
+                 prewarm: tuple[str, ...] = (), prewarm_depth: int = 2, prewarm_jobs: int = 8,
+                 prewarm_interval: float = 3600):
         self.abs_root = os.path.abspath(root)
         self.base_path = self.__base_path(base_path)
         self.no_list = no_list
         self.no_modify = no_modify
         self.create_writable = create_writable
         self.index_file = index_file
+        self.limiter = limiter
+        self.durability = durability
+        self.state_dir = os.path.join(self.abs_root, Constant.STATE_DIR_NAME)
+        self.store = None
+        if dedup is not None:
+            self.store = ContentStore(os.path.join(self.state_dir, 'store'), reflink=dedup == 'reflink')
+        self.checksum = Checksum(os.path.join(self.state_dir, 'checksums.db'), xattrs=not no_modify)
+        self.offload = offload
+        self.offload_prefix = '/' + offload_prefix.strip('/')
+        self.upload_hash_algorithms = tuple(sorted({
+            *((upload_hash,) if upload_hash else ()),
+            *((ContentStore.HASH_ALGORITHM,) if self.store is not None else ()),
+        }))
+        self.admins = admins
+        self.large_transfer = large_transfer or None
+        self.file_cache = file_cache
+        self.archives = ArchiveCache(os.path.join(self.state_dir, 'archives'))
+        self.extractions: dict[int, dict] = {}
+        self.profiler = Profiler(profile_dir or os.path.join(self.state_dir, 'profiles'), enabled=profile,
+                                 threshold=profile_threshold / 1000, interval=profile_interval / 1000)
+        self.replication = Replication(self.abs_root, self.state_dir, self.checksum, tuple(replicate_to),
+                                       replicate_auth, replicate_interval)
+        self.replicate_peers = replicate_peers or set()
+        self.quota = Quota(os.path.join(self.state_dir, 'quota.db'), self.state_dir,
+                           {os.path.abspath(os.path.join(self.abs_root, path.strip('/'))): limit
+                            for path, limit in (quotas or {}).items()}, user_quotas or {})
+        self.min_free = min_free
+        self.access_log = access_log
+        self.audit_log = audit_log
+        self.trash = None
+        if trash:
+            self.trash = Trash(os.path.join(self.state_dir, 'trash'), trash_retention, trash_max, trash_rate,
+                               self.__remove_file, self.quota.remove)
+        self.prewarm = None
+        if prewarm:
+            paths = []
+            for path in prewarm:
+                abs_path = os.path.abspath(os.path.join(self.abs_root, path.strip('/')))
+                if abs_path == self.abs_root or abs_path.startswith(self.abs_root + os.sep):
+                    paths.append(abs_path)
+                else:
+                    print(f'warning: --prewarm {path} is outside the root, ignored')
+            self.prewarm = Prewarm(self.abs_root, self.state_dir, paths, prewarm_depth, prewarm_jobs,
+                                   prewarm_interval, self.file_cache)
+
+    def reconfigure(self, no_list: bool, no_modify: bool, create_writable: bool, index_file: str):
+        self.no_list = no_list
+        self.no_modify = no_modify
+        self.checksum.xattrs = not no_modify
+        self.create_writable = create_writable
+        self.index_file = index_file
 
     def __base_path(self, base_path: str) -> str:
         base_path = base_path.strip('/')
@@ -1006,16 +3528,63 @@ class Handler:
     def __should_respond_json(self, request: Request) -> bool:
         return request.query_params.get('json') is not None
 
-    def __abort(self, status: int, message: str):
-        raise HTTPException(status_code=status, detail=message)
+    def __abort(self, status: int, message: str, headers: Optional[dict[str, str]] = None):
+        raise HTTPException(status_code=status, detail=message, headers=headers)
+
+    def __send_file(self, request: Request, local_path: str, media_type: Optional[str] = None) -> Response:
+        if self.offload == 'nginx':
+            # nginx maps this URI to the document root through an `internal` location
+            relpath = os.path.relpath(local_path, self.abs_root)
+            uri = '{}/{}'.format(self.offload_prefix.rstrip('/'), urlquote(os.fsencode(relpath)))
+            return Response(headers={'X-Accel-Redirect': uri}, media_type=media_type)
+        elif self.offload == 'sendfile':
+            # header values are latin-1, mod_xsendfile unescapes the path
+            return Response(headers={'X-Sendfile': urlquote(os.fsencode(local_path))}, media_type=media_type)
+        stat = os.stat(local_path)
+        response = FileResponse(local_path, media_type=media_type, stat_result=stat)
+        if self.large_transfer is not None and stat.st_size >= self.large_transfer:
+            response.chunk_size = 1024 * 1024
+            response = ReadaheadResponse(response, local_path)
+        return self.__shape_download(request, response)
+
+    def __shape_download(self, request: Request, response: Response) -> Response:
+        if self.limiter is None:
+            return response
+        key = Limiter.client_key(request)
+        if not self.limiter.open_download(key):
+            self.__abort(429, 'too many concurrent downloads', {'Retry-After': '1'})
+        return self.limiter.shape(key, response)
 
     async def handle(self, request: Request):
+        if self.limiter is not None:
+            retry_after = self.limiter.admit_request(Limiter.client_key(request))
+            if retry_after is not None:
+                self.__abort(429, 'too many requests', {'Retry-After': str(max(1, round(retry_after)))})
         if not request.url.path.startswith(self.base_path + '/'):
             return RedirectResponse(f'{self.base_path}{request.url.path}', status_code=302)
-        if request.method == 'GET':
+        internal_prefix = f'{self.base_path}/{Constant.STATE_DIR_NAME}/'
+        if request.url.path.startswith(internal_prefix):
+            return await self.__handle_internal(request, request.url.path[len(internal_prefix):])
+        if request.method in ('GET', 'HEAD'):
             return await self.__handle_view(request)
         elif request.method == 'POST':
-            form = await request.form()
+            action = request.query_params.get('action')
+            if action in ('upload', 'extract', 'preflight'):
+                # before any of the body is read, so an Expect: 100-continue request is refused without sending it
+                size = request.query_params.get('size') if action == 'preflight' else request.headers.get('content-length')
+                with Profiler.phase(request, 'preflight'):
+                    free = await run_in_threadpool(self.__preflight_upload, request, size)
+                if action == 'preflight':
+                    return JSONResponse({'preflight': True, 'free': free})
+            if action == 'extract':
+                return await self.__handle_extract(request)
+            with Profiler.phase(request, 'form'):
+                from starlette.formparsers import MultiPartException
+                try:
+                    # parsed once here, the handlers get it back from the request; room for a full batch of names
+                    form = await request.form(max_fields=Constant.BATCH_MAX_PATHS + 16)
+                except MultiPartException as e:
+                    self.__abort(400, e.message)
             action = form.get('action')
             if action == 'upload':
                 return await self.__handle_upload(request)
@@ -1025,16 +3594,96 @@ class Handler:
                 return await self.__handle_mkdir(request)
             elif action == 'move':
                 return await self.__handle_move(request)
+            elif action == 'hash':
+                return await self.__handle_hash(request)
+            elif action == 'stat':
+                return await self.__handle_stat(request)
+            elif action == 'fetch':
+                return await self.__handle_fetch(request)
         self.__abort(400, 'unknown action')
 
+    async def __handle_internal(self, request: Request, name: str):
+        if name == 'replicate' and self.replicate_peers:
+            # only for the users peers authenticate as, whatever --admin says
+            if request.state.user not in self.replicate_peers:
+                self.__abort(403, 'replication peers only')
+            return await self.__handle_replicate(request)
+        # closed unless --admin names the caller
+        if not self.admins or request.state.user not in self.admins:
+            self.__abort(403, 'administrators only')
+        if name == 'metrics':
+            return JSONResponse({
+                'file_cache': self.file_cache.metrics() if self.file_cache is not None else None,
+                'profiler': self.profiler.status(),
+                'access_log': self.access_log.stats() if self.access_log is not None else None,
+                'audit_log': self.audit_log.stats() if self.audit_log is not None else None,
+            })
+        if name == 'extractions':
+            return JSONResponse(list(self.extractions.values()))
+        if name == 'profile':
+            if request.method == 'POST':
+                form = await request.form()
+                try:
+                    if form.get('enable') is not None:
+                        self.profiler.enabled = form.get('enable').lower() in ('1', 'true', 'on', 'yes')
+                    if form.get('threshold') is not None:
+                        self.profiler.threshold = float(form.get('threshold')) / 1000
+                except ValueError:
+                    self.__abort(400, 'invalid threshold')
+                self.__audit(request, 'profile', enabled=self.profiler.enabled, threshold_ms=self.profiler.threshold * 1000)
+            return JSONResponse(self.profiler.status())
+        if name == 'dedup':
+            if self.store is None:
+                self.__abort(404, 'deduplication is disabled')
+            if request.method == 'POST':
+                if self.no_modify:
+                    self.__abort(403, 'modification is forbidden')
+                dropped = await run_in_threadpool(self.store.sweep)
+                self.__audit(request, 'dedup_sweep', dropped=dropped)
+                return JSONResponse({'dropped': dropped})
+            return JSONResponse(await run_in_threadpool(self.store.stats))
+        if name == 'replication':
+            if request.method == 'POST':
+                self.replication.sync()
+                self.__audit(request, 'replication_sync')
+            return JSONResponse(self.replication.status())
+        if name == 'trash':
+            return await self.__handle_trash(request)
+        if name == 'prewarm':
+            if self.prewarm is None:
+                self.__abort(404, 'prewarm is disabled')
+            if request.method == 'POST':
+                self.prewarm.trigger()
+                self.__audit(request, 'prewarm')
+            return JSONResponse(self.prewarm.status())
+        if name == 'quota':
+            if request.method == 'POST':
+                self.quota.rescan()
+                self.__audit(request, 'quota_rescan')
+            return JSONResponse(await run_in_threadpool(self.quota.status, self.abs_root))
+        self.__abort(404, 'unknown endpoint')
+
     async def __handle_view(self, request: Request):
         local_path = self.__get_local_path(request.url.path)
 
+        if self.file_cache is not None and not request.query_params and 'range' not in request.headers:
+            cached = self.file_cache.get(local_path)
+            if cached is not None:
+                return self.__shape_download(request, self.file_cache.respond(request, cached))
+
+        if not os.path.exists(local_path) or request.url.path.endswith('/') and os.path.isfile(local_path):
+            archive_path = self.__find_archive(local_path)
+            if archive_path is not None:
+                return await self.__handle_view_archive(request, archive_path, local_path[len(archive_path) + 1:])
+
         if not os.path.exists(local_path):
             self.__abort(404, 'file or directory does not exist')
         if not Path.get_readibility(local_path):
             self.__abort(403, 'no permission to access this location')
 
+        if request.query_params.get('hash') is not None:
+            return await self.__handle_view_hash(request, local_path)
+
         if os.path.isfile(local_path):
             return await self.__handle_view_file(request, local_path)
         elif os.path.isdir(local_path):
@@ -1046,24 +3695,164 @@ class Handler:
         if self.__should_respond_json(request):
             with open(local_path, 'rb') as f:
                 content = base64.b64encode(f.read()).decode()
-            return JSONResponse(content={
+            return self.__shape_download(request, JSONResponse(content={
                 'type': Constant.ENTRY_TYPE_FILE,
                 'content': content,
-            })
+            }))
+
+        if self.file_cache is not None and not request.query_params and 'range' not in request.headers \
+                and os.path.getsize(local_path) <= self.file_cache.max_file_size:
+            with suppress(OSError):
+                cached = self.file_cache.put(local_path)
+                if cached is not None:
+                    return self.__shape_download(request, self.file_cache.respond(request, cached))
 
-        return FileResponse(local_path, media_type=guess_mimetype(local_path))
+        return self.__send_file(request, local_path, guess_mimetype(local_path))
 
     async def __handle_view_dir(self, request: Request, local_path: str):
         if self.index_file:
             index_path = os.path.join(local_path, self.index_file)
             if os.path.exists(index_path):
-                return FileResponse(index_path)
+                return self.__send_file(request, index_path)
 
         if self.no_list:
             self.__abort(403, 'directory listing is forbidden')
 
-        entries = self.__list_dir(local_path)
-
+        query = self.__listing_query(request.query_params)
+        if query['format'] is not None and query['sort'] is None:
+            # nothing to sort: rows go out while the directory is still being read
+            patterns, type = self.__listing_filter(query)
+            entries = (entry for entry in self.__scan_dir(local_path)
+                       if (type is None or entry.type is type) and all(pattern.search(entry.name) for pattern in patterns))
+            return self.__stream_listing(query['format'], entries)
+
+        with Profiler.phase(request, 'fs_scan'):
+            listing = self.__list_dir(local_path)
+
+        with Profiler.phase(request, 'render'):
+            return self.__render_dir(request, local_path, listing)
+
+    def __find_archive(self, local_path: str) -> Optional[str]:
+        # the closest existing ancestor, if it is an archive the rest of the path names a member
+        path = local_path
+        while not os.path.exists(path) and path != self.abs_root:
+            path = os.path.dirname(path)
+        if os.path.isfile(path) and Archive.supports(path):
+            return path
+        return None
+
+    async def __handle_view_archive(self, request: Request, archive_path: str, member_path: str):
+        if not Path.get_readibility(archive_path):
+            self.__abort(403, 'no permission to access this location')
+        archive = self.archives.get(archive_path, load=False)
+        if archive is None:
+            try:
+                if self.limiter is not None:
+                    # indexing reads the central directory, or scans (and decompresses) a whole tar
+                    async with self.limiter.expensive_action() as admitted:
+                        if not admitted:
+                            self.__abort(503, 'server is busy, try again later', {'Retry-After': '5'})
+                        archive = await run_in_threadpool(self.archives.get, archive_path)
+                else:
+                    archive = await run_in_threadpool(self.archives.get, archive_path)
+            except ValueError as e:
+                self.__abort(400, str(e))
+
+        if member_path in archive.children:
+            if self.no_list:
+                self.__abort(403, 'directory listing is forbidden')
+            with Profiler.phase(request, 'render'):
+                return self.__render_dir(request, os.path.join(archive_path, member_path), archive.listing(member_path),
+                                         modifiable=False)
+
+        member = archive.members.get(member_path)
+        if member is None:
+            self.__abort(404, 'file or directory does not exist')
+        headers = {'Accept-Ranges': 'bytes', 'Content-Length': str(member.size)}
+        status_code = 200
+        start, length = 0, member.size
+        byte_range = self.__single_range(request, member.size)
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            status_code = 206
+            headers.update({'Content-Length': str(length), 'Content-Range': f'bytes {start}-{end}/{member.size}'})
+        return self.__shape_download(request, StreamingResponse(
+            archive.read(member, start, length),
+            status_code=status_code,
+            media_type=guess_mimetype(member.name) or 'application/octet-stream',
+            headers=headers,
+        ))
+
+    def __single_range(self, request: Request, size: int) -> Optional[tuple[int, int]]:
+        # the first and last byte of a single-range request; several ranges get the whole body instead
+        match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', request.headers.get('range', ''))
+        if match is None or match.group(1) == match.group(2) == '':
+            return None
+        if match.group(1) == '':
+            start, end = max(0, size - int(match.group(2))), size - 1
+        else:
+            start = int(match.group(1))
+            end = min(size - 1, int(match.group(2))) if match.group(2) else size - 1
+        if start > end or start >= size:
+            self.__abort(416, 'range not satisfiable', {'Content-Range': f'bytes */{size}'})
+        return start, end
+
+    def __listing_query(self, params) -> dict[str, Optional[str]]:
+        # sort and order, then filter (a regular expression searched in names, ignoring case like the page's
+        # filter box), glob (a shell pattern of whole names) and type, from the query string or a bulk action's form
+        query = {key: params.get(key) or None for key in ('sort', 'order', 'filter', 'glob', 'type', 'format')}
+        if query['format'] is not None and query['format'] not in Format.LISTING_FORMATS:
+            self.__abort(400, 'format must be one of: {}'.format(', '.join(Format.LISTING_FORMATS)))
+        if query['sort'] is not None and query['sort'] not in Listing.SORT_KEYS:
+            self.__abort(400, 'sort must be one of: {}'.format(', '.join(Listing.SORT_KEYS)))
+        if query['order'] not in (None, 'asc', 'desc'):
+            self.__abort(400, 'order must be asc or desc')
+        if query['type'] not in (None, Constant.ENTRY_TYPE_FILE, Constant.ENTRY_TYPE_DIRECTORY):
+            self.__abort(400, f'type must be {Constant.ENTRY_TYPE_FILE} or {Constant.ENTRY_TYPE_DIRECTORY}')
+        return query
+
+    def __listing_filter(self, query: dict[str, Optional[str]]) -> tuple[list[re.Pattern], Optional[EntryType]]:
+        import fnmatch
+        patterns = []
+        if query['filter'] is not None:
+            try:
+                patterns.append(re.compile(query['filter'], re.IGNORECASE))
+            except re.error as e:
+                self.__abort(400, f'invalid filter: {e}')
+        if query['glob'] is not None:
+            patterns.append(re.compile(fnmatch.translate(query['glob'])))
+        return patterns, {Constant.ENTRY_TYPE_FILE: EntryType.FILE,
+                          Constant.ENTRY_TYPE_DIRECTORY: EntryType.DIRECTORY}.get(query['type'])
+
+    def __query_listing(self, listing: Listing, query: dict[str, Optional[str]]) -> Listing:
+        patterns, type = self.__listing_filter(query)
+        if patterns or type is not None:
+            listing.filter(patterns, type)
+        if query['sort'] is not None:
+            listing.sort(query['sort'], reverse=query['order'] == 'desc')
+        return listing
+
+    def __stream_listing(self, format: str, entries) -> StreamingResponse:
+        # the generator runs in the thread pool, so does the scan behind it
+        return StreamingResponse(Format.listing_rows(format, entries), media_type=Format.LISTING_FORMATS[format])
+
+    async def __matching_names(self, request: Request, form) -> Optional[list[str]]:
+        # names of the request directory that a bulk action's filter, glob or type selects, None without them
+        query = self.__listing_query(form)
+        if query['filter'] is None and query['glob'] is None and query['type'] is None:
+            return None
+        local_path = self.__get_local_path(request.url.path)
+        if not os.path.isdir(local_path):
+            self.__abort(400, 'location is not a directory')
+        listing = await run_in_threadpool(self.__list_dir, local_path)
+        return [entry.name for entry in self.__query_listing(listing, query)]
+
+    def __render_dir(self, request: Request, local_path: str, listing: Listing, modifiable: bool = True):
+        query = self.__listing_query(request.query_params)
+        listing = self.__query_listing(listing, query)
+        if query['format'] is not None:
+            return self.__stream_listing(query['format'], listing)
         if self.__should_respond_json(request):
             return JSONResponse(content={
                 'type': Constant.ENTRY_TYPE_DIRECTORY,
@@ -1073,16 +3862,17 @@ class Handler:
                         'type': Format.entry_type_full(entry),
                         'permission': Format.entry_permission(entry),
                         'size': entry.stat_size,
-                    } for entry in entries
+                        'mtime': entry.stat_mtime,
+                    } for entry in listing
                 ]
             })
 
         if self.__is_browser(request):
             relpath = os.path.relpath(local_path, self.abs_root)
             webpath = os.path.abspath(os.path.join('/', relpath)).rstrip('/')
-            allow_modify = not self.no_modify
-            folder_writable = os.access(local_path, os.W_OK)
-            html = ListDirHTML.generate(webpath, self.base_path, entries, allow_modify, folder_writable)
+            allow_modify = modifiable and not self.no_modify
+            folder_writable = modifiable and os.access(local_path, os.W_OK)
+            html = ListDirHTML.generate(webpath, self.base_path, listing, allow_modify, folder_writable, query)
             return HTMLResponse(content=html)
 
         return PlainTextResponse(content=Format.table([
@@ -1092,14 +3882,190 @@ class Handler:
                Format.entry_permission(entry),
                Format.date(entry.stat_ctime),
                Format.date(entry.stat_mtime),
-               Format.date(entry.stat_atime)] for entry in entries]
+               Format.date(entry.stat_atime)] for entry in listing]
         ]))
 
+    def __hash_algorithm(self, algorithm: Optional[str]) -> str:
+        algorithm = (algorithm or Checksum.ALGORITHMS[0]).lower()
+        if algorithm not in Checksum.ALGORITHMS:
+            self.__abort(400, 'hash must be one of: {}'.format(', '.join(Checksum.ALGORITHMS)))
+        return algorithm
+
+    def __respond_digests(self, request: Request, algorithm: str, digests: dict[str, Optional[str]]):
+        if self.__should_respond_json(request):
+            return JSONResponse({'algorithm': algorithm, 'digests': digests})
+        # same layout as sha256sum(1), so the output can be verified with `sha256sum -c`
+        return PlainTextResponse(''.join(f'{digest}  {name}\n' for name, digest in digests.items() if digest))
+
+    async def __handle_view_hash(self, request: Request, local_path: str):
+        algorithm = self.__hash_algorithm(request.query_params.get('hash'))
+        if os.path.isfile(local_path):
+            names = [os.path.basename(local_path)]
+            local_paths = [local_path]
+        elif self.no_list:
+            self.__abort(403, 'directory listing is forbidden')
+        else:
+            names = [entry.name for entry in await run_in_threadpool(self.__list_dir, local_path)
+                     if entry.type == EntryType.FILE and entry.readable]
+            local_paths = [os.path.join(local_path, name) for name in names]
+        digests = await self.__digest_many(local_paths, algorithm)
+        return self.__respond_digests(request, algorithm, dict(zip(names, digests)))
+
+    async def __handle_hash(self, request: Request):
+        form = await request.form()
+        algorithm = self.__hash_algorithm(form.get('algorithm'))
+
+        entry_names = form.getlist('name')
+        if not entry_names:
+            self.__abort(400, 'name is not provided')
+        if len(entry_names) > Constant.BATCH_MAX_PATHS:
+            self.__abort(413, f'too many names, at most {Constant.BATCH_MAX_PATHS} per request')
+
+        local_paths = [self.__get_local_path(f'{request.url.path}/{name}') for name in entry_names]
+        for entry_name, local_path in zip(entry_names, local_paths):
+            if not Path.get_readibility(local_path):
+                self.__abort(403, f'no permission to read {entry_name}')
+
+        digests = await self.__digest_many(local_paths, algorithm)
+        return self.__respond_digests(request, algorithm, dict(zip(entry_names, digests)))
+
+    async def __digest_many(self, local_paths: list[str], algorithm: str) -> list[Optional[str]]:
+        # reads whole files, so it shares the expensive action cap with a stat that hashes
+        if self.limiter is None:
+            return await self.checksum.digest_many(local_paths, algorithm)
+        async with self.limiter.expensive_action() as admitted:
+            if not admitted:
+                self.__abort(503, 'server is busy, try again later', {'Retry-After': '5'})
+            return await self.checksum.digest_many(local_paths, algorithm)
+
+    async def __batch_paths(self, request: Request, limit: int) -> list[str]:
+        paths = (await request.form()).getlist('path')
+        if not paths:
+            self.__abort(400, 'path is not provided')
+        if len(paths) > limit:
+            self.__abort(413, f'too many paths, at most {limit} per request')
+        return paths
+
+    async def __handle_stat(self, request: Request):
+        import asyncio
+        form = await request.form()
+        paths = await self.__batch_paths(request, Constant.BATCH_MAX_PATHS)
+        algorithm = self.__hash_algorithm(form.get('hash')) if form.get('hash') else None
+
+        def stat_one(name: str) -> dict:
+            try:
+                local_path = self.__get_local_path(f'{request.url.path}/{name}')
+                stat = os.stat(local_path)
+            except HTTPException as e:
+                return {'error': e.detail}
+            except OSError:
+                return {'error': 'file or directory does not exist'}
+            type, readable, writable = Path.classify(local_path, stat)
+            entry = Entry(os.path.basename(local_path), type, readable, writable,
+                          stat.st_ctime, stat.st_mtime, stat.st_atime, stat.st_size)
+            info = {
+                'type': Format.entry_type_full(entry),
+                'permission': Format.entry_permission(entry),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+            }
+            if algorithm is not None and type == EntryType.FILE and readable:
+                info[algorithm] = self.checksum.digest(local_path, algorithm)
+            return info
+
+        async def stat_all():
+            # on the checksum pool, which is sized for file I/O
+            loop = asyncio.get_running_loop()
+            return await asyncio.gather(*[loop.run_in_executor(self.checksum.executor, stat_one, path) for path in paths])
+
+        if self.limiter is not None and algorithm is not None:
+            async with self.limiter.expensive_action() as admitted:
+                if not admitted:
+                    self.__abort(503, 'server is busy, try again later', {'Retry-After': '5'})
+                results = await stat_all()
+        else:
+            results = await stat_all()
+        return JSONResponse({'entries': dict(zip(paths, results))})
+
+    async def __handle_fetch(self, request: Request):
+        paths = await self.__batch_paths(request, Constant.FETCH_MAX_FILES)
+
+        base_path = self.__get_local_path(request.url.path)
+        files, errors = [], {}
+        for name in paths:
+            try:
+                local_path = self.__get_local_path(f'{request.url.path}/{name}')
+            except HTTPException as e:
+                errors[name] = e.detail
+                continue
+            if not local_path.startswith(base_path.rstrip(os.sep) + os.sep):
+                errors[name] = 'outside of the requested directory'
+            elif not os.path.exists(local_path):
+                errors[name] = 'file does not exist'
+            elif not os.path.isfile(local_path):
+                errors[name] = 'not a file'
+            elif not os.access(local_path, os.R_OK):
+                errors[name] = 'no permission to read'
+            else:
+                files.append((os.path.relpath(local_path, base_path), local_path))
+        if errors:
+            return JSONResponse({'detail': 'some paths cannot be fetched', 'errors': errors}, status_code=400)
+        if sum(os.path.getsize(local_path) for _, local_path in files) > Constant.FETCH_MAX_BYTES:
+            self.__abort(413, f'files are larger than {Format.size(Constant.FETCH_MAX_BYTES)} in total')
+
+        return self.__shape_download(request, StreamingResponse(
+            self.__tar_stream(files),
+            media_type='application/x-tar',
+            headers={'Content-Disposition': 'attachment; filename="files.tar"'},
+        ))
+
+    def __tar_stream(self, files: list[tuple[str, str]]):
+        # a plain tar written by hand, small files are read ahead on the checksum pool while earlier ones go out
+        import tarfile
+        from collections import deque
+
+        def read(local_path: str):
+            with open(local_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size > Constant.FETCH_READ_AHEAD_SIZE:
+                    return stat, None
+                return stat, f.read()
+
+        pending = deque()
+        files = iter(files)
+        while True:
+            while len(pending) < 16 and (item := next(files, None)) is not None:
+                pending.append((item, self.checksum.executor.submit(read, item[1])))
+            if not pending:
+                break
+            (name, local_path), future = pending.popleft()
+            stat, data = future.result()
+            info = tarfile.TarInfo(name)
+            info.mode, info.mtime = stat.st_mode & 0o777, int(stat.st_mtime)
+            if data is not None:
+                info.size = len(data)
+                yield info.tobuf(tarfile.PAX_FORMAT) + data + bytes(-len(data) % tarfile.BLOCKSIZE)
+                continue
+            with open(local_path, 'rb') as f:
+                info.size = remaining = os.fstat(f.fileno()).st_size
+                yield info.tobuf(tarfile.PAX_FORMAT)
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        raise OSError(f'{name} was truncated while it was sent')
+                    remaining -= len(chunk)
+                    yield chunk
+            yield bytes(-info.size % tarfile.BLOCKSIZE)
+        yield bytes(2 * tarfile.BLOCKSIZE)
+
     async def __handle_delete(self, request: Request):
         if self.no_modify:
             self.__abort(403, 'modification is forbidden')
 
-        entry_names = (await request.form()).getlist('name')
+        form = await request.form()
+        entry_names = form.getlist('name')
+        if not entry_names:
+            entry_names = await self.__matching_names(request, form) or []
         local_paths = [self.__get_local_path(f'{request.url.path}/{name}') for name in entry_names]
 
         for entry_name, local_path in zip(entry_names, local_paths):
@@ -1111,30 +4077,69 @@ class Handler:
             if not Path.get_writability(local_path):
                 self.__abort(403, f'no permission to delete {entry_name}')
 
-        result = {}
-        for local_path in local_paths:
-            if not local_path:
-                continue
-            if os.path.islink(local_path) or os.path.isfile(local_path):
-                with suppress(OSError):
-                    os.remove(local_path)
-            elif os.path.isdir(local_path):
-                for prefix, _, files in os.walk(local_path, topdown=False):
-                    for name in files:
-                        file = os.path.join(prefix, name)
-                        with suppress(OSError):
-                            os.remove(file)
-                    with suppress(OSError):
-                        os.rmdir(prefix)
+        trashed = {}
+
+        def remove():
+            for entry_name, local_path in zip(entry_names, local_paths):
+                if local_path:
+                    trash_id = self.__delete(local_path, request.state.user)
+                    if trash_id is not None:
+                        trashed[entry_name] = trash_id
 
+        if self.limiter is not None and self.trash is None and any(map(os.path.isdir, local_paths)):
+            async with self.limiter.expensive_action() as admitted:
+                if not admitted:
+                    self.__abort(503, 'server is busy, try again later', {'Retry-After': '5'})
+                await run_in_threadpool(remove)
+        else:
+            await run_in_threadpool(remove)
+
+        result = {}
         for entry_name, local_path in zip(entry_names, local_paths):
             result[entry_name] = not os.path.exists(local_path)
+        deleted = [self.__relative_path(local_path)
+                   for entry_name, local_path in zip(entry_names, local_paths) if result[entry_name]]
+        await self.__replicate([{'op': 'delete', 'path': path} for path in deleted])
+        self.__audit(request, 'delete', paths=deleted, trash=trashed if self.trash is not None else None)
 
         if self.__is_browser(request):
             message = urlquote(f'Deleted {len(result)} file(s)')
             return RedirectResponse(f'{request.url.path}#message={message}', status_code=302)
+        if self.trash is not None:
+            return JSONResponse({'deleted': result, 'trash': trashed})
         return JSONResponse({'deleted': result})
 
+    def __preflight_upload(self, request: Request, size: Optional[str]) -> int:
+        # permission, free space and quota checks of an upload, from the URL and headers alone
+        if self.no_modify:
+            self.__abort(403, 'modification is forbidden')
+        local_path = self.__get_local_path(request.url.path)
+        if not os.path.isdir(local_path):
+            self.__abort(403, 'location is not a directory')
+        directory = local_path
+        target = request.query_params.get('target')
+        if target:
+            target_path = self.__get_local_path(f'{request.url.path}/{target}')
+            directory = target_path if os.path.isdir(target_path) else os.path.dirname(target_path)
+            if not os.path.isdir(directory):
+                self.__abort(400, 'target directory does not exist')
+        if not os.access(directory, os.W_OK):
+            self.__abort(403, 'no permission to upload to this location')
+        stat = os.statvfs(directory)
+        free = max(0, stat.f_bavail * stat.f_frsize - self.min_free)
+        if size is None:
+            return free
+        try:
+            size = int(size)
+        except ValueError:
+            self.__abort(400, 'invalid size')
+        if size > free:
+            self.__abort(507, f'not enough disk space: {Format.size(size)} requested, {Format.size(free)} available')
+        error = self.quota.check(directory, request.state.user, size)
+        if error is not None:
+            self.__abort(413, error)
+        return free
+
     async def __handle_upload(self, request: Request):
         if self.no_modify:
             self.__abort(403, 'modification is forbidden')
@@ -1154,35 +4159,371 @@ class Handler:
             self.__abort(400, 'target name is not provided')
 
         result = {}
+        pending: list[AtomicFile] = []
 
         async def save(file, filepath):
             assert not isinstance(file, str)
             assert os.path.abspath(filepath).startswith(local_path)
             try:
-                chunk_size = 1024 * 1024
-                with open(filepath, 'wb') as dst:
-                    while chunk := await file.read(chunk_size):
-                        dst.write(chunk)
-                os.chmod(filepath, (0o644, 0o666)[self.create_writable])
+                dst = AtomicFile(filepath, (0o644, 0o666)[self.create_writable], self.upload_hash_algorithms,
+                                 self.large_transfer)
             except PermissionError:
                 self.__abort(403, 'no permission to upload to this location')
+            pending.append(dst)
+            chunk_size = 1024 * 1024
+            try:
+                while chunk := await file.read(chunk_size):
+                    dst.write(chunk)
+                    if dst.needs_write_behind:
+                        await run_in_threadpool(dst.write_behind)
+            except OSError as e:
+                if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                    self.__abort(507, 'not enough disk space')
+                raise
             result[file.filename] = True
 
+        def commit():
+            # the real sizes are known now, this also covers uploads without a preflight
+            existing = {}
+            for dst in pending:
+                with suppress(OSError):
+                    stat = os.lstat(dst.path)
+                    existing[dst.path] = stat.st_size if S_ISREG(stat.st_mode) else 0
+            growth = sum(dst.size - existing.get(dst.path, 0) for dst in pending)
+            error = self.quota.check(os.path.dirname(pending[0].path), request.state.user, growth)
+            if error is not None:
+                self.__abort(413, error)
+            AtomicFile.commit_all(pending, self.durability, self.store)
+            for dst in pending:
+                self.quota.add(dst.path, dst.size - existing.get(dst.path, 0), request.state.user, dst.size)
+                with suppress(OSError):
+                    stat = os.stat(dst.path)
+                    for algorithm, hash in dst.hashes.items():
+                        self.checksum.remember(dst.path, algorithm, hash.hexdigest(), stat)
+
         target_path = self.__get_local_path(f'{request.url.path}/{target}')
-        if os.path.isdir(target_path):
-            for file in files:
-                await save(file, os.path.join(target_path, file.filename))
-        elif len(files) > 1:
-            self.__abort(400, 'target is not a directory')
-        else:
-            await save(files[0], target_path)
+        try:
+            if os.path.isdir(target_path):
+                for file in files:
+                    await save(file, os.path.join(target_path, file.filename))
+            elif len(files) > 1:
+                self.__abort(400, 'target is not a directory')
+            else:
+                await save(files[0], target_path)
+            await run_in_threadpool(commit)
+        except BaseException:
+            for dst in pending:
+                dst.abort()
+            raise
+        await self.__replicate([{'op': 'put', 'path': self.__relative_path(dst.path)} for dst in pending])
+        self.__audit(request, 'upload', files={self.__relative_path(dst.path): dst.size for dst in pending},
+                     bytes=sum(dst.size for dst in pending))
 
         if self.__is_browser(request):
             message = urlquote(f'Uploaded {len(result)} file(s)')
             return RedirectResponse(f'{request.url.path}#message={message}', status_code=302)
 
+        if self.upload_hash_algorithms:
+            digests = {os.path.basename(dst.path): {algorithm: hash.hexdigest() for algorithm, hash in dst.hashes.items()}
+                       for dst in pending}
+            return JSONResponse({'uploaded': result, 'digests': digests})
         return JSONResponse({'uploaded': result})
 
+    async def __handle_extract(self, request: Request):
+        # the request body is the archive itself, unpacked while it arrives instead of being spooled first
+        if self.no_modify:
+            self.__abort(403, 'modification is forbidden')
+
+        local_path = self.__get_local_path(request.url.path)
+        if not os.path.isdir(local_path):
+            self.__abort(403, 'location is not a directory')
+        if not os.access(local_path, os.W_OK):
+            self.__abort(403, 'no permission to upload to this location')
+
+        source = self.__body_reader(request)
+        dir_mode, file_mode = ((0o755, 0o644), (0o777, 0o666))[self.create_writable]
+        real_root = os.path.realpath(self.abs_root)
+        result = {}
+        ops = []
+        progress = {'path': request.url.path, 'entries': 0, 'bytes': 0, 'started': time.time()}
+
+        def target_of(name: str) -> str:
+            path = self.__get_local_path('{}/{}'.format(request.url.path.rstrip('/'), name.replace('\\', '/')))
+            if not path.startswith(local_path + os.sep):
+                self.__abort(400, 'outside of the target directory')
+            parent = os.path.realpath(os.path.dirname(path))
+            if parent != real_root and not parent.startswith(real_root + os.sep):
+                self.__abort(400, 'outside of the document root')
+            return path
+
+        def extract():
+            for name, kind, reader in ArchiveStream.entries(source):
+                progress['entries'] += 1
+                try:
+                    if kind == 'other':
+                        result[name] = 'skipped, only files and directories are extracted'
+                        continue
+                    path = target_of(name)
+                    if kind == 'directory':
+                        mkdir_p(path, dir_mode)
+                        result[name] = True
+                        ops.append({'op': 'mkdir', 'path': self.__relative_path(path)})
+                        continue
+                    mkdir_p(os.path.dirname(path), dir_mode)
+                    existing = os.path.getsize(path) if os.path.isfile(path) else 0
+                    dst = AtomicFile(path, file_mode, self.upload_hash_algorithms, self.large_transfer)
+                    try:
+                        while chunk := reader.read(1024 * 1024):
+                            dst.write(chunk)
+                            progress['bytes'] += len(chunk)
+                        error = self.quota.check(path, request.state.user, dst.size - existing)
+                        if error is not None:
+                            self.__abort(413, error)
+                        AtomicFile.commit_all([dst], self.durability, self.store)
+                    except BaseException:
+                        dst.abort()
+                        raise
+                    self.quota.add(path, dst.size - existing, request.state.user, dst.size)
+                    with suppress(OSError):
+                        stat = os.stat(path)
+                        for algorithm, hash in dst.hashes.items():
+                            self.checksum.remember(path, algorithm, hash.hexdigest(), stat)
+                    result[name] = True
+                    ops.append({'op': 'put', 'path': self.__relative_path(path)})
+                except HTTPException as e:
+                    result[name] = e.detail
+                except OSError as e:
+                    result[name] = e.strerror or str(e)
+            while source.read(1024 * 1024):
+                pass  # e.g. the zip central directory
+
+        self.extractions[id(progress)] = progress
+        try:
+            if self.limiter is not None:
+                async with self.limiter.expensive_action() as admitted:
+                    if not admitted:
+                        self.__abort(503, 'server is busy, try again later', {'Retry-After': '5'})
+                    await run_in_threadpool(extract)
+            else:
+                await run_in_threadpool(extract)
+        except ValueError as e:
+            return JSONResponse({'detail': str(e), 'extracted': result}, status_code=400)
+        finally:
+            del self.extractions[id(progress)]
+            await self.__replicate(ops)
+            self.__audit(request, 'extract', paths=[op['path'] for op in ops], bytes=progress['bytes'],
+                         errors=sum(value is not True for value in result.values()))
+
+        return JSONResponse({
+            'extracted': result,
+            'entries': progress['entries'],
+            'bytes': progress['bytes'],
+            'errors': sum(value is not True for value in result.values()),
+        })
+
+    async def __handle_trash(self, request: Request):
+        # GET lists the trash, POST restores (undo) or purges items by id, or empties it
+        if self.trash is None:
+            self.__abort(404, 'trash is disabled')
+        if request.method != 'POST':
+            if self.no_list:
+                self.__abort(403, 'directory listing is forbidden')
+            return JSONResponse(await run_in_threadpool(self.__trash_status))
+        if self.no_modify:
+            self.__abort(403, 'modification is forbidden')
+        form = await request.form()
+        restored = {}
+        ops = []
+        for trash_id in form.getlist('restore'):
+            try:
+                local_path = await run_in_threadpool(self.trash.restore, trash_id, self.abs_root)
+            except KeyError:
+                restored[trash_id] = 'not in the trash'
+                continue
+            except OSError as e:
+                restored[trash_id] = e.strerror or str(e)
+                continue
+            self.quota.move(self.trash.entry_path(trash_id), local_path)
+            restored[trash_id] = self.__relative_path(local_path)
+            if os.path.isdir(local_path):
+                for prefix, _, names in os.walk(local_path):
+                    ops.append({'op': 'mkdir', 'path': self.__relative_path(prefix)})
+                    ops.extend({'op': 'put', 'path': self.__relative_path(os.path.join(prefix, name))} for name in names)
+            else:
+                ops.append({'op': 'put', 'path': self.__relative_path(local_path)})
+        await self.__replicate(ops)
+        for trash_id in form.getlist('purge'):
+            self.trash.purge(trash_id)
+        if form.get('empty') is not None:
+            self.trash.purge()
+        self.__audit(request, 'trash', restored=restored, purged=form.getlist('purge'),
+                     emptied=form.get('empty') is not None)
+        return JSONResponse({'restored': restored, **await run_in_threadpool(self.__trash_status)})
+
+    def __trash_status(self) -> dict:
+        # the trash lists what was deleted, so it shows what a listing of where it was would
+        status = self.trash.status()
+        items = []
+        for item in status['items'] if not self.no_list else ():
+            directory = os.path.dirname(os.path.join(self.abs_root, *item['path'].split('/')))
+            while not os.path.isdir(directory) and directory != self.abs_root:
+                directory = os.path.dirname(directory)
+            if Path.get_readibility(directory):
+                items.append(item)
+        status['items'] = items
+        return status
+
+    async def __handle_replicate(self, request: Request):
+        # GET: digests of a directory's entries for anti-entropy, POST: a batch of ops from a peer
+        if request.method != 'POST':
+            if self.no_list:
+                self.__abort(403, 'directory listing is forbidden')
+            local_path = self.__get_local_path('{}/{}'.format(self.base_path, request.query_params.get('path', '')))
+            if os.path.exists(local_path) and not Path.get_readibility(local_path):
+                self.__abort(403, 'no permission to list this directory')
+            if self.limiter is not None:
+                async with self.limiter.expensive_action() as admitted:
+                    if not admitted:
+                        self.__abort(503, 'server is busy, try again later', {'Retry-After': '5'})
+                    return JSONResponse(await run_in_threadpool(self.replication.entries, local_path))
+            return JSONResponse(await run_in_threadpool(self.replication.entries, local_path))
+
+        if self.no_modify:
+            self.__abort(403, 'modification is forbidden')
+
+        source = self.__body_reader(request)
+        dir_mode, file_mode = ((0o755, 0o644), (0o777, 0o666))[self.create_writable]
+        real_root = os.path.realpath(self.abs_root)
+        result = {'origin': None, 'applied': 0, 'skipped': 0, 'errors': {}}
+
+        def local_path_of(path: str) -> str:
+            local_path = self.__get_local_path('{}/{}'.format(self.base_path, path))
+            parent = os.path.realpath(os.path.dirname(local_path))
+            if local_path == self.abs_root or parent != real_root and not parent.startswith(real_root + os.sep):
+                self.__abort(400, 'outside of the document root')
+            return local_path
+
+        def check_writable(local_path: str) -> str:
+            # the same permission checks as a delete or an upload from a client; returns the nearest existing directory
+            if os.path.lexists(local_path) and not Path.get_writability(local_path):
+                self.__abort(403, 'no permission to modify')
+            directory = os.path.dirname(local_path)
+            while not os.path.isdir(directory):
+                directory = os.path.dirname(directory)
+            if not Path.get_writability(directory):
+                self.__abort(403, 'no permission to modify the parent directory')
+            return directory
+
+        def data(size: int):
+            while size > 0:
+                chunk = source.read(min(size, 1024 * 1024))
+                if not chunk:
+                    raise ValueError('unexpected end of batch')
+                size -= len(chunk)
+                yield chunk
+
+        def put(local_path: str, op: dict, chunks) -> bool:
+            # the newer copy wins, so a batch delivered twice or late does not roll a file back
+            existing, replaced = 0, None
+            with suppress(OSError):
+                replaced = stat = os.lstat(local_path)
+                if stat.st_mtime_ns > op['mtime'] or stat.st_mtime_ns == op['mtime'] and stat.st_size == op['size']:
+                    return False
+                existing = stat.st_size if S_ISREG(stat.st_mode) else 0
+            stat = os.statvfs(check_writable(local_path))
+            free = max(0, stat.f_bavail * stat.f_frsize - self.min_free)
+            if op['size'] > free:
+                self.__abort(507, f'not enough disk space: {Format.size(op["size"])} requested, {Format.size(free)} available')
+            error = self.quota.check(local_path, None, op['size'] - existing)
+            if error is not None:
+                self.__abort(413, error)
+            mkdir_p(os.path.dirname(local_path), dir_mode)
+            dst = AtomicFile(local_path, file_mode, self.upload_hash_algorithms, self.large_transfer)
+            try:
+                for chunk in chunks:
+                    dst.write(chunk)
+                # not through the content store: the peer's mtime is set below, and on a shared inode
+                # it would change the store object and every other file linked to it
+                AtomicFile.commit_all([dst], self.durability)
+            except BaseException:
+                dst.abort()
+                raise
+            os.utime(local_path, ns=(op['mtime'], op['mtime']))
+            if self.store is not None and replaced is not None and (replaced.st_nlink > 1 or self.store.reflink):
+                self.store.release(replaced)
+            self.quota.add(local_path, dst.size - existing, None, dst.size)
+            with suppress(OSError):
+                stat = os.stat(local_path)
+                for algorithm, hash in dst.hashes.items():
+                    self.checksum.remember(local_path, algorithm, hash.hexdigest(), stat)
+            return True
+
+        def apply(op: dict, chunks) -> bool:
+            local_path = local_path_of(op['path'])
+            if op['op'] == 'mkdir':
+                if os.path.isdir(local_path):
+                    return False
+                check_writable(local_path)
+                mkdir_p(local_path, dir_mode)
+                return True
+            if op['op'] == 'delete':
+                if not os.path.lexists(local_path):
+                    return False
+                check_writable(local_path)
+                self.__delete(local_path, None)
+                return True
+            if op['op'] == 'move':
+                target_path = local_path_of(op['target'])
+                moved = os.path.lexists(local_path)
+                if moved:
+                    check_writable(local_path)
+                    check_writable(target_path)
+                    mkdir_p(os.path.dirname(target_path), dir_mode)
+                    replaced = os.lstat(target_path) if os.path.isfile(target_path) else None
+                    os.rename(local_path, target_path)
+                    if replaced is not None:
+                        self.quota.remove(target_path, replaced.st_size)
+                    self.quota.move(local_path, target_path)
+                if 'size' in op:
+                    return put(target_path, op, chunks) or moved
+                return moved
+            if op['op'] == 'put':
+                return put(local_path, op, chunks)
+            self.__abort(400, f'unknown op: {op["op"]}')
+
+        def receive():
+            origin = result['origin'] = json.loads(source.readline() or b'{}').get('origin')
+            applied = self.replication.applied(origin) if origin else 0
+            last = applied
+            while line := source.readline():
+                op = json.loads(line)
+                chunks = data(op.get('size', 0))
+                try:
+                    if op.get('seq', 0) and op['seq'] <= applied:
+                        result['skipped'] += 1
+                    elif apply(op, chunks):
+                        result['applied'] += 1
+                    else:
+                        result['skipped'] += 1
+                except HTTPException as e:
+                    result['errors'][op['path']] = e.detail
+                except OSError as e:
+                    result['errors'][op['path']] = e.strerror or str(e)
+                for _ in chunks:
+                    pass
+                last = max(last, op.get('seq', 0))
+            if origin and last > applied:
+                self.replication.mark_applied(origin, last)
+
+        try:
+            await run_in_threadpool(receive)
+        except (ValueError, KeyError, TypeError) as e:
+            return JSONResponse({'detail': f'malformed batch: {e}', **result}, status_code=400)
+        finally:
+            self.__audit(request, 'replicate', origin=result['origin'], applied=result['applied'],
+                         skipped=result['skipped'], errors=len(result['errors']))
+        return JSONResponse(result)
+
     async def __handle_mkdir(self, request: Request):
         if self.no_modify:
             self.__abort(403, 'modification is forbidden')
@@ -1203,6 +4544,8 @@ class Handler:
 
         if not os.path.isdir(folder_path):
             self.__abort(500, 'failed to create folder')
+        await self.__replicate([{'op': 'mkdir', 'path': self.__relative_path(folder_path)}])
+        self.__audit(request, 'new_folder', paths=[self.__relative_path(folder_path)])
 
         if self.__is_browser(request):
             message = urlquote(f'Created new folder {name}'.encode())
@@ -1214,13 +4557,23 @@ class Handler:
         if self.no_modify:
             self.__abort(403, 'modification is forbidden')
 
-        sources = (await request.form()).getlist('source')
-        if not sources:
-            self.__abort(400, 'source name is not provided')
-
-        target = (await request.form()).get('target')
+        form = await request.form()
+        target = form.get('target')
         if not target:
             self.__abort(400, 'target name is not provided')
+        target_path = self.__get_local_path(f'{request.url.path}/{target}')
+
+        sources = form.getlist('source')
+        if not sources:
+            matching = await self.__matching_names(request, form)
+            if matching is None:
+                self.__abort(400, 'source name is not provided')
+            # a target among the matches stays where it is, everything else moves into it
+            directory = self.__get_local_path(request.url.path)
+            sources = [name for name in matching
+                       if not (target_path + os.sep).startswith(os.path.join(directory, name) + os.sep)]
+            if not sources:
+                self.__abort(400, 'nothing matches')
 
         source_paths = []
         for source in sources:
@@ -1232,13 +4585,16 @@ class Handler:
         result = {}
 
         def move(src, dst):
+            replaced = os.lstat(dst) if os.path.isfile(dst) and not os.path.isdir(src) else None
             try:
                 os.rename(src, dst)
             except:
                 self.__abort(500, 'failed to move')
+            if replaced is not None:
+                self.quota.remove(dst, replaced.st_size)
+            self.quota.move(src, dst)
             result[src] = dst
 
-        target_path = self.__get_local_path(f'{request.url.path}/{target}')
         if os.path.isdir(target_path):
             for source_path in source_paths:
                 move(source_path, os.path.join(target_path, os.path.basename(source_path)))
@@ -1246,6 +4602,9 @@ class Handler:
             self.__abort(400, 'target is not a directory')
         else:
             move(source_paths[0], target_path)
+        moved = {self.__relative_path(src): self.__relative_path(dst) for src, dst in result.items()}
+        await self.__replicate([{'op': 'move', 'path': src, 'target': dst} for src, dst in moved.items()])
+        self.__audit(request, 'move', moved=moved)
 
         if self.__is_browser(request):
             message = urlquote(f'Moved {len(result)} item(s)'.encode())
@@ -1253,251 +4612,829 @@ class Handler:
 
         return JSONResponse({'moved': result})
 
+    def __remove_file(self, path: str) -> int:
+        # returns the bytes freed
+        with suppress(OSError):
+            stat = os.lstat(path)
+            os.remove(path)
+            if self.store is not None and (stat.st_nlink > 1 or self.store.reflink):
+                self.store.release(stat)
+            return stat.st_size if S_ISREG(stat.st_mode) else 0
+        return 0
+
+    def __remove(self, local_path: str) -> int:
+        freed = 0
+        if os.path.islink(local_path) or os.path.isfile(local_path):
+            freed += self.__remove_file(local_path)
+        elif os.path.isdir(local_path):
+            for prefix, _, files in os.walk(local_path, topdown=False):
+                for name in files:
+                    freed += self.__remove_file(os.path.join(prefix, name))
+                with suppress(OSError):
+                    os.rmdir(prefix)
+        self.quota.remove(local_path, freed)
+        return freed
+
+    def __delete(self, local_path: str, user: Optional[str]) -> Optional[str]:
+        # into the trash when it is enabled and on the same filesystem, returning the trash id; removed otherwise
+        if self.trash is not None:
+            trash_id = self.trash.put(local_path, self.__relative_path(local_path), user)
+            if trash_id is not None:
+                self.quota.move(local_path, self.trash.entry_path(trash_id))
+                return trash_id
+        self.__remove(local_path)
+        return None
+
+    def __body_reader(self, request: Request) -> ChunkReader:
+        # the request body as a blocking reader, for code running in the thread pool
+        from anyio.from_thread import run as run_from_thread
+        chunks = request.stream()
+
+        async def next_chunk():
+            # an empty chunk can be sent before the end of the body
+            async for chunk in chunks:
+                if chunk:
+                    return chunk
+            return b''
+
+        return ChunkReader(lambda: run_from_thread(next_chunk))
+
+    def __relative_path(self, local_path: str) -> str:
+        return os.path.relpath(local_path, self.abs_root).replace(os.sep, '/')
+
+    def __audit(self, request: Request, action: str, **fields):
+        if self.audit_log is not None:
+            self.audit_log.write({
+                'time': time.time(),
+                'user': request.state.user,
+                'client': request.client.host if request.client else None,
+                'action': action,
+                'path': request.url.path,
+                **fields,
+            })
+
+    async def __replicate(self, ops: list[dict]):
+        if self.replication.peers and ops:
+            await run_in_threadpool(self.replication.record, ops)
+
     def __get_local_path(self, path: str):
         path = path.replace('//', '/')
         prefix = self.base_path or '/'
         assert path.startswith(prefix), str((path, prefix))
         abs_path = os.path.abspath(os.path.join(self.abs_root, path[len(prefix):].strip('/')))
+        if abs_path == self.state_dir or abs_path.startswith(self.state_dir + os.sep):
+            self.__abort(404, 'file or directory does not exist')
         if abs_path.startswith(self.abs_root):
             return abs_path
         self.__abort(400, 'invalid path: {}'.format(path))
 
-    def __list_dir(self, abs_dir_path: str) -> list[Entry]:
-        entries: list[Entry] = []
-        for item_name in os.listdir(abs_dir_path):
-            item_path = os.path.join(abs_dir_path, item_name)
-            with suppress(Exception):
-                stat = os.stat(item_path)
-                entry = Entry(
-                    name=item_name,
-                    path=item_path,
-                    type=Path.get_type(item_path),
-                    readable=Path.get_readibility(item_path),
-                    writable=Path.get_writability(item_path),
-                    stat_ctime=stat.st_ctime,
-                    stat_mtime=stat.st_mtime,
-                    stat_atime=stat.st_atime,
-                    stat_size=stat.st_size,
-                )
-                entries.append(entry)
-        entries.sort(key=(lambda entry: (-entry.type.value, entry.name)))
-        return entries
-
-
-def create_fastapi_app(root: str,
-                       base_path: str,
-                       basic_auth: Optional[str],
-                       no_list: bool,
-                       no_modify: bool,
-                       create_writable: bool,
-                       index_file: str,
-                       ) -> FastAPI:
-    app = FastAPI()
-    handler = Handler(root, base_path, no_list, no_modify, create_writable, index_file)
-
-    route_options = {
-        'methods': ['GET', 'POST'],
-        'endpoint': handler.handle,
-    }
-
-    if basic_auth:
-        async def auth(credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
-            if not f"{credentials.username}:{credentials.password}" == basic_auth:
-                raise HTTPException(status_code=401, detail="Unauthorized")
-            return credentials
-        route_options['dependencies'] = [Depends(auth)]
+    def __scan_dir(self, abs_dir_path: str):
+        # entries in directory order as they are read, for output streamed as they come (__list_dir for everything
+        # else); the directory is opened now, so errors come before any output
+        items = os.scandir(abs_dir_path)
+
+        def entries():
+            with items:
+                for item in items:
+                    if item.path == self.state_dir:
+                        continue
+                    try:
+                        stat = item.stat()
+                        type, readable, writable = Path.classify(item.path, stat)
+                    except Exception:
+                        continue
+                    yield Entry(item.name, type, readable, writable,
+                                stat.st_ctime, stat.st_mtime, stat.st_atime, stat.st_size)
+        return entries()
+
+    def __list_dir(self, abs_dir_path: str) -> Listing:
+        # straight into the listing's columns, no object per entry
+        listing = Listing(abs_dir_path)
+        with os.scandir(abs_dir_path) as items:
+            for item in items:
+                if item.path == self.state_dir:
+                    continue
+                with suppress(Exception):
+                    stat = item.stat()
+                    type, readable, writable = Path.classify(item.path, stat)
+                    listing.append(item.name, type, readable, writable,
+                                   stat.st_size, stat.st_ctime, stat.st_mtime, stat.st_atime)
+        return listing.sort()
+
+
+class WebApp:
+    # A minimal ASGI application that sends every request to the handler, without a routing framework
+    def __init__(self, handler: Handler, auth: Optional[Auth]):
+        self.handler = handler
+        self.auth = auth
+        self.serve = ProfileMiddleware(self.__serve, handler.profiler)
+        if handler.access_log is not None:
+            self.serve = AccessLogMiddleware(self.serve, handler.access_log)
+
+    def reconfigure(self, users: dict[str, str], session_ttl: int, **settings):
+        # run as an event loop callback, so a request never sees half of the old and half of the new config
+        if not users:
+            self.auth = None
+        elif self.auth is None:
+            self.auth = Auth(users, session_ttl=session_ttl)
+        else:
+            self.auth.update(users, session_ttl)
+        self.handler.reconfigure(**settings)
+
+    async def endpoint(self, request: Request):
+        request.state.user = None
+        new_session = False
+        if self.auth is not None:
+            with Profiler.phase(request, 'auth'):
+                request.state.user, new_session = await self.auth.authenticate(request)
+            if request.state.user is None:
+                raise HTTPException(status_code=401, detail='Unauthorized', headers={'WWW-Authenticate': 'Basic'})
+        response = await self.handler.handle(request)
+        if new_session:
+            cookie = self.auth.session_cookie(request.state.user, self.handler.base_path or '/',
+                                              request.url.scheme == 'https')
+            response.raw_headers.append((b'set-cookie', cookie.encode('latin-1')))
+        return response
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] == 'http':
+            await self.serve(scope, receive, send)
+
+    async def __serve(self, scope, receive, send):
+        request = Request(scope, receive)
+        try:
+            if request.method not in ('GET', 'HEAD', 'POST'):
+                raise HTTPException(status_code=405, headers={'Allow': 'GET, HEAD, POST'})
+            response = await self.endpoint(request)
+        except HTTPException as e:
+            response = JSONResponse({'detail': e.detail}, status_code=e.status_code, headers=e.headers)
+        await response(scope, receive, send)
+
+
+def create_asgi_app(root: str,
+                    base_path: str,
+                    auth: Optional[Auth],
+                    no_list: bool,
+                    no_modify: bool,
+                    create_writable: bool,
+                    index_file: str,
+                    **options,
+                    ) -> WebApp:
+    import_web_packages()
+    handler = Handler(root, base_path, no_list, no_modify, create_writable, index_file, **options)
+    return WebApp(handler, auth)
+
+
+def create_fastapi_app(*args, **kwargs) -> FastAPI:
+    web_app = create_asgi_app(*args, **kwargs)
+    try:
+        from fastapi import FastAPI
+    except ImportError as e:
+        exit_with_package_import_error(e)
 
-    for path in ('/', '{path:path}'):
-        app.add_api_route(path, **route_options)
+    # no docs routes, they would shadow files named docs or openapi.json
+    app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+    app.add_route('/{path:path}', web_app.endpoint, methods=['GET', 'POST'])
+    app.add_middleware(ProfileMiddleware, profiler=web_app.handler.profiler)
+    if web_app.handler.access_log is not None:
+        app.add_middleware(AccessLogMiddleware, log=web_app.handler.access_log)
+    app.state.web_app = web_app
 
     return app
 
 
-def generate_certificates(host: str, common_name: Optional[str] = None) -> tuple[str, str]:
-    from os.path import isfile, join, expanduser
-    try:
-        from cryptography.hazmat.primitives import serialization, hashes
-        from cryptography.hazmat.primitives.asymmetric import ec
-        from cryptography import x509, __version__ as version
-        from cryptography.x509.oid import NameOID
-    except ImportError as e:
-        exit_with_package_import_error(e)
+class CertificateManager:
+    # A local root CA under ~/.webdir signs one leaf certificate for every server name. What was verified
+    # is recorded in cert.json, so a restart or reload with unchanged files does not even import cryptography
+    CA_VALID_DAYS = 9487
+    LEAF_VALID_DAYS = 397
+    RENEW_BEFORE = timedelta(days=365)
+
+    def __init__(self, names: list[str]):
+        from os.path import join, expanduser
+        # the first name is the CN and names the directory, the SANs cover them all
+        self.names = list(OrderedDict.fromkeys(names))
+        self.common_name = self.names[0]
+        config_dir = expanduser('~/.webdir')
+        self.root_ca_cert_path = join(config_dir, 'root_ca', 'cert.pem')
+        self.root_ca_key_path = join(config_dir, 'root_ca', 'key.pem')
+        self.cert_dir = join(config_dir, 'certs', self.common_name)
+        self.cert_path = join(self.cert_dir, 'cert.pem')
+        self.key_path = join(self.cert_dir, 'key.pem')
+        self.fullchain_path = join(self.cert_dir, 'fullchain.pem')
+        self.meta_path = join(self.cert_dir, 'cert.json')
 
-    current_major = int(version.split('.')[0])
-    lowest_major = 36
-    if current_major < lowest_major:
-        print(f'TLS: warning: package cryptography v{current_major} is lower than v{lowest_major}')
+    @classmethod
+    def server_names(cls, host: str, https_hosts: Optional[list[str]]) -> list[str]:
+        names = list(https_hosts or ())
+        if not names:
+            print("TLS: warning: you are using default CN 'localhost'")
+            print('TLS: warning: you can change CN by adding --https-host HOSTNAME')
+        if host not in ('0.0.0.0', '::', ''):
+            names.append(host)
+        return [*names, 'localhost', '127.0.0.1', '::1']
+
+    def __fingerprint(self) -> Optional[dict[str, list[int]]]:
+        fingerprint = {}
+        for path in (self.root_ca_cert_path, self.root_ca_key_path, self.key_path, self.cert_path, self.fullchain_path):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            fingerprint[path] = [stat.st_size, stat.st_mtime_ns]
+        return fingerprint
+
+    def __cached(self) -> bool:
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            return (meta['names'] == self.names and meta['files'] == self.__fingerprint()
+                    and meta['not_after'] - time.time() > self.RENEW_BEFORE.total_seconds())
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def issue(self) -> tuple[str, str]:
+        if not self.__cached():
+            self.__issue()
+        print(f'TLS: using fullchain: {self.fullchain_path}')
+        print(f'TLS: using key: {self.key_path}')
+        return self.fullchain_path, self.key_path
+
+    def __issue(self):
+        from os.path import isfile
+        import ipaddress
+        try:
+            from cryptography.hazmat.primitives import serialization, hashes
+            from cryptography.hazmat.primitives.asymmetric import ec
+            from cryptography import x509, __version__ as version
+            from cryptography.x509.oid import NameOID
+        except ImportError as e:
+            exit_with_package_import_error(e)
+
+        current_major = int(version.split('.')[0])
+        lowest_major = 36
+        if current_major < lowest_major:
+            print(f'TLS: warning: package cryptography v{current_major} is lower than v{lowest_major}')
+
+        def generate_key():
+            return ec.generate_private_key(ec.SECP256R1())
+
+        def import_key(path):
+            with open(path, 'rb') as f:
+                return serialization.load_pem_private_key(f.read(), None)
+
+        def export_key(key, path):
+            with open(path, 'wb') as f:
+                f.write(key.private_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PrivateFormat.TraditionalOpenSSL,
+                    encryption_algorithm=serialization.NoEncryption(),
+                ))
+            os.chmod(path, 0o600)
 
-    def generate_key():
-        return ec.generate_private_key(ec.SECP256R1())
+        def x509_name(common_name):
+            return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
 
-    def import_key(path):
-        with open(path, 'rb') as f:
-            return serialization.load_pem_private_key(f.read(), None)
+        def random_id(prefix, length=8):
+            possible_bytes = string.ascii_letters + string.digits
+            suffix = ''.join(random.choices(possible_bytes, k=length))
+            return f'{prefix}{suffix}'
 
-    def export_key(key, path, passphrase=None):
-        if passphrase is None:
-            encryption = serialization.NoEncryption()
+        def general_name(name):
+            try:
+                return x509.IPAddress(ipaddress.ip_address(name))
+            except ValueError:
+                return x509.DNSName(name)
+
+        def certificate_builder(subject_CN, subject_key, issuer_CN, valid_days):
+            # https://www.phildev.net/ssl/creating_ca.html
+            return (x509.CertificateBuilder()
+                    .subject_name(x509_name(subject_CN))
+                    .issuer_name(x509_name(issuer_CN))
+                    .public_key(subject_key.public_key())
+                    .serial_number(x509.random_serial_number())
+                    .not_valid_before(datetime.now(timezone.utc))
+                    .not_valid_after(datetime.now(timezone.utc) + timedelta(days=valid_days)))
+
+        def sign_usr_cert_has_san(builder: x509.CertificateBuilder, subject_key, issuer_key, san):
+            return (builder
+                    .add_extension(x509.SubjectAlternativeName(san), critical=False)
+                    .add_extension(x509.BasicConstraints(False, None), critical=False)
+                    .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
+                    .add_extension(x509.SubjectKeyIdentifier.from_public_key(subject_key.public_key()), critical=False)
+                    .sign(issuer_key, hashes.SHA256()))
+
+        def sign_v3_ca(builder: x509.CertificateBuilder, subject_key, issuer_key):
+            return (builder
+                    .add_extension(x509.BasicConstraints(True, None), critical=False)
+                    .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
+                    .add_extension(x509.SubjectKeyIdentifier.from_public_key(subject_key.public_key()), critical=False)
+                    .sign(issuer_key, hashes.SHA256()))
+
+        def import_certificate(path):
+            with open(path, 'rb') as f:
+                return x509.load_pem_x509_certificate(f.read())
+
+        def export_certificate(certificate, path):
+            with open(path, 'wb') as f:
+                f.write(certificate.public_bytes(serialization.Encoding.PEM))
+
+        is_cert_dirty = False
+        os.makedirs(os.path.dirname(self.root_ca_key_path), exist_ok=True)
+        os.makedirs(self.cert_dir, exist_ok=True)
+
+        if isfile(self.root_ca_key_path):
+            root_ca_key = import_key(self.root_ca_key_path)
         else:
-            encryption = serialization.BestAvailableEncryption(
-                passphrase.encode())
-        with open(path, 'wb') as f:
-            f.write(key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.TraditionalOpenSSL,
-                encryption_algorithm=encryption,
-            ))
-
-    def x509_name(common_name):
-        return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
-
-    def random_id(prefix, length=8):
-        possible_bytes = string.ascii_letters + string.digits
-        suffix = ''.join(random.choices(possible_bytes, k=length))
-        return f'{prefix}{suffix}'
-
-    def certificate_builder(subject_CN, subject_key, issuer_CN, issuer_key, valid_days):
-        # https://www.phildev.net/ssl/creating_ca.html
-        return (x509.CertificateBuilder()
-                .subject_name(x509_name(subject_CN))
-                .issuer_name(x509_name(issuer_CN))
-                .public_key(subject_key.public_key())
-                .serial_number(x509.random_serial_number())
-                .not_valid_before(datetime.now(timezone.utc))
-                .not_valid_after(datetime.now(timezone.utc) + timedelta(days=valid_days)))
-
-    def sign_usr_cert_has_san(builder: x509.CertificateBuilder, subject_key, issuer_key, san):
-        return (builder
-                .add_extension(x509.SubjectAlternativeName(san), critical=False)
-                .add_extension(x509.BasicConstraints(False, None), critical=False)
-                .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
-                .add_extension(x509.SubjectKeyIdentifier.from_public_key(subject_key.public_key()), critical=False)
-                .sign(issuer_key, hashes.SHA256()))
-
-    def sign_v3_ca(builder: x509.CertificateBuilder, subject_key, issuer_key):
-        return (builder
-                .add_extension(x509.BasicConstraints(True, None), critical=False)
-                .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
-                .add_extension(x509.SubjectKeyIdentifier.from_public_key(subject_key.public_key()), critical=False)
-                .sign(issuer_key, hashes.SHA256()))
-
-    def import_certificate(path):
-        with open(path, 'rb') as f:
-            return x509.load_pem_x509_certificate(f.read())
+            print(f'TLS: generating {self.root_ca_key_path}')
+            root_ca_key = generate_key()
+            export_key(root_ca_key, self.root_ca_key_path)
+            is_cert_dirty = True
+
+        if not isfile(self.root_ca_cert_path) or is_cert_dirty:
+            print(f'TLS: generating {self.root_ca_cert_path}')
+            root_ca_name = random_id('WebDir Root CA - ')
+            root_ca_cert = sign_v3_ca(
+                certificate_builder(root_ca_name, root_ca_key, root_ca_name, self.CA_VALID_DAYS),
+                subject_key=root_ca_key, issuer_key=root_ca_key
+            )
+            export_certificate(root_ca_cert, self.root_ca_cert_path)
+            is_cert_dirty = True
+        else:
+            root_ca_cert = import_certificate(self.root_ca_cert_path)
+            root_ca_cn_attrs = root_ca_cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+            assert len(root_ca_cn_attrs) == 1, repr(root_ca_cn_attrs)
+            root_ca_name = root_ca_cn_attrs[0].value
 
-    def export_certificate(certificate, path):
-        with open(path, 'wb') as f:
-            f.write(certificate.public_bytes(serialization.Encoding.PEM))
+        if isfile(self.key_path):
+            key = import_key(self.key_path)
+        else:
+            print(f'TLS: generating {self.key_path}')
+            key = generate_key()
+            export_key(key, self.key_path)
+            is_cert_dirty = True
 
-    cert_cn = 'localhost'
-    if common_name is None:
-        print(f'TLS: warning: you are using default CN {cert_cn!r}')
-        print('TLS: warning: you can change CN by adding --https-host HOSTNAME')
-    else:
-        cert_cn = common_name
-
-    webdir_cfg_dir = expanduser('~/.webdir')
-    root_ca_dir = join(webdir_cfg_dir, 'root_ca')
-    root_ca_cert_path = join(root_ca_dir, 'cert.pem')
-    root_ca_key_path = join(root_ca_dir, 'key.pem')
-    cert_dir = join(webdir_cfg_dir, 'certs', cert_cn)
-    cert_path = join(cert_dir, 'cert.pem')
-    key_path = join(cert_dir, 'key.pem')
-    fullchain_path = join(cert_dir, 'fullchain.pem')
-    is_cert_dirty = False
-    os.makedirs(webdir_cfg_dir, exist_ok=True)
-    os.makedirs(root_ca_dir, exist_ok=True)
-    os.makedirs(cert_dir, exist_ok=True)
-
-    if isfile(root_ca_key_path):
-        root_ca_key = import_key(root_ca_key_path)
-    else:
-        print(f'TLS: generating {root_ca_key_path}')
-        root_ca_key = generate_key()
-        export_key(root_ca_key, root_ca_key_path)
-        assert isfile(root_ca_key_path), repr(root_ca_key_path)
-        os.chmod(root_ca_key_path, 0o600)
-        is_cert_dirty = True
-
-    if not isfile(root_ca_cert_path) or is_cert_dirty:
-        print(f'TLS: generating {root_ca_cert_path}')
-        root_ca_name = random_id('WebDir Root CA - ')
-        root_ca_cert = sign_v3_ca(
-            certificate_builder(root_ca_name, root_ca_key, root_ca_name, root_ca_key, 9487),
-            subject_key=root_ca_key, issuer_key=root_ca_key
-        )
-        export_certificate(root_ca_cert, root_ca_cert_path)
-        assert isfile(root_ca_cert_path), repr(root_ca_cert_path)
-        is_cert_dirty = True
-    else:
-        root_ca_cert = import_certificate(root_ca_cert_path)
-        root_ca_cn_attrs = root_ca_cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
-        assert len(root_ca_cn_attrs) == 1, repr(root_ca_cn_attrs)
-        root_ca_name = root_ca_cn_attrs[0].value
+        if isfile(self.cert_path) and not is_cert_dirty:
+            cert = import_certificate(self.cert_path)
+            try:
+                names = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+            except x509.ExtensionNotFound:
+                names = []
+            if cert.not_valid_after_utc - datetime.now(timezone.utc) < self.RENEW_BEFORE:
+                print(f'TLS: renewing {self.cert_path}')
+                is_cert_dirty = True
+            elif list(names) != [general_name(name) for name in self.names]:
+                print(f'TLS: reissuing {self.cert_path} for {", ".join(self.names)}')
+                is_cert_dirty = True
+            elif cert.public_key() != key.public_key() or cert.issuer != root_ca_cert.subject:
+                print(f'TLS: reissuing {self.cert_path}, it does not match its key or CA')
+                is_cert_dirty = True
+
+        if not isfile(self.cert_path) or is_cert_dirty:
+            print(f'TLS: generating {self.cert_path}')
+            cert = sign_usr_cert_has_san(
+                certificate_builder(self.common_name, key, root_ca_name, self.LEAF_VALID_DAYS),
+                subject_key=key, issuer_key=root_ca_key, san=[general_name(name) for name in self.names],
+            )
+            export_certificate(cert, self.cert_path)
+            is_cert_dirty = True
+
+        if not isfile(self.fullchain_path) or is_cert_dirty:
+            print(f'TLS: generating {self.fullchain_path}')
+            with open(self.cert_path) as in1, open(self.root_ca_cert_path) as in2, open(self.fullchain_path, 'w') as out:
+                out.write(in1.read())
+                out.write(in2.read())
+
+        meta = {'names': self.names, 'not_after': cert.not_valid_after_utc.timestamp(), 'files': self.__fingerprint()}
+        with tempfile.NamedTemporaryFile('w', dir=self.cert_dir, prefix='.cert.json.', delete=False) as f:
+            json.dump(meta, f)
+        os.replace(f.name, self.meta_path)
+
+
+class TLSContext:
+    # uvicorn's ssl_context_factory: it runs wherever the server loads, the main process or every worker,
+    # so each new worker also renews the certificate when it is due
+    def __init__(self, certificates: CertificateManager, min_version: str = '1.2'):
+        self.certificates = certificates
+        self.min_version = min_version
+        self.config = None
+        self.default_factory = None
+        self.current = None
+
+    def __call__(self, config, default_factory):
+        self.config, self.default_factory = config, default_factory
+        self.current = self.__load()
+        # the listening context only hands each handshake over to the current one; session tickets are
+        # encrypted with its keys, so they stay valid across reloads (but not across workers)
+        context = self.__configure(self.default_factory())
+        context.sni_callback = self.__select
+        return context
+
+    def __configure(self, context):
+        import ssl
+        context.minimum_version = ssl.TLSVersion.TLSv1_3 if self.min_version == '1.3' else ssl.TLSVersion.TLSv1_2
+        # TLS 1.2 suites only, with forward secrecy; TLS 1.3 suites are not affected
+        context.set_ciphers('ECDHE+AESGCM:ECDHE+CHACHA20')
+        context.options |= ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE
+        # resumption: tickets in TLS 1.3 and 1.2, and the session cache of TLS 1.2
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = 2
+        return context
+
+    def __load(self):
+        self.config.ssl_certfile, self.config.ssl_keyfile = self.certificates.issue()
+        return self.__configure(self.default_factory())
+
+    def __select(self, ssl_object, server_name, context):
+        ssl_object.context = self.current
+
+    def reload(self):
+        # new handshakes use the new certificate, established connections keep theirs;
+        # on an error the current context stays untouched
+        self.current = self.__load()
+
+
+class Client:
+    # Command line client: a pool of keep-alive connections shared by parallel range downloads and uploads
+    PART_SIZE = 8 * 1024 * 1024
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, url: str, auth: Optional[str] = None, connections: int = 8, insecure: bool = False,
+                 timeout: float = 60):
+        from urllib.parse import urlsplit
+        import queue
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'unsupported url: {url}')
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = parts.path or '/'
+        self.connections = connections
+        self.insecure = insecure
+        self.timeout = timeout
+        self.pool = queue.LifoQueue()
+        self.headers = {'User-Agent': 'webdir-client'}
+        if auth:
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(auth.encode()).decode()
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'skipped': 0, 'failed': 0, 'bytes': 0, 'requests': 0}
+
+    def __connect(self):
+        import http.client
+        if not self.https:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        import ssl
+        context = ssl.create_default_context()
+        if self.insecure:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=context)
+
+    def request(self, method: str, path: str, headers: Optional[dict] = None, body=None, sink=None):
+        # sink(chunk) receives the body as it arrives, otherwise it is returned; retried once on a stale connection
+        import http.client
+        import queue
+        headers = {**self.headers, **(headers or {})}
+        for attempt in range(2):
+            try:
+                connection = self.pool.get_nowait()
+            except queue.Empty:
+                connection = self.__connect()
+            try:
+                connection.request(method, path, body=body() if callable(body) else body, headers=headers)
+                response = connection.getresponse()
+                data = b''
+                while chunk := response.read(self.CHUNK_SIZE):
+                    if sink is not None and 200 <= response.status < 300:
+                        sink(chunk)
+                    else:
+                        data += chunk
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+                connection.close()
+                if attempt:
+                    raise
+                continue
+            with self.lock:
+                self.stats['requests'] += 1
+            cookie = response.getheader('Set-Cookie')
+            if cookie:
+                # the session cookie spares the server a password check per request
+                self.headers['Cookie'] = cookie.split(';', 1)[0]
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.put(connection)
+            return response, data
+
+    def url(self, *names: str) -> str:
+        return urlquote('/'.join([self.path.rstrip('/'), *names]))
+
+    def __check(self, response, data: bytes, what: str):
+        if not 200 <= response.status < 300:
+            with suppress(ValueError):
+                data = json.loads(data)['detail'].encode()
+            raise OSError(f'{what}: {response.status} {data.decode(errors="replace")}')
+
+    def list(self, *names: str) -> dict[str, dict]:
+        response, data = self.request('GET', self.url(*names) + '/?json')
+        if response.status == 404:
+            return {}
+        self.__check(response, data, 'list ' + '/'.join(names))
+        return {entry['name']: entry for entry in json.loads(data)['entries']}
+
+    def walk(self, *names: str):
+        # yields (relative directory names, entries) for the remote tree, breadth first
+        pending = [names]
+        while pending:
+            names = pending.pop(0)
+            entries = self.list(*names)
+            yield names, entries
+            pending.extend((*names, name) for name, entry in entries.items()
+                           if entry['type'] == Constant.ENTRY_TYPE_DIRECTORY)
+
+    def download(self, names: tuple[str, ...], local_path: str, size: int, mtime: float, executor):
+        # large files are split into ranges fetched on separate connections and written in place
+        url = self.url(*names)
+        temp_path = local_path + '.webdir-part'
+        try:
+            with open(temp_path, 'wb') as f:
+                if size >= 2 * self.PART_SIZE:
+                    f.truncate(size)
+                    fd = f.fileno()
+
+                    def fetch(start: int):
+                        end = min(start + self.PART_SIZE, size) - 1
+                        offset = start
+
+                        def write(chunk):
+                            nonlocal offset
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                        response, data = self.request('GET', url, {'Range': f'bytes={start}-{end}'}, sink=write)
+                        self.__check(response, data, url)
+                        if response.status != 206 or offset != end + 1:
+                            raise OSError(f'{url}: range request was not honoured')
+                    # every range finishes before the file is closed, even when one of them failed
+                    futures = [executor.submit(fetch, start) for start in range(0, size, self.PART_SIZE)]
+                    errors = [error for error in (future.exception() for future in futures) if error is not None]
+                    if errors:
+                        raise errors[0]
+                else:
+                    response, data = self.request('GET', url, sink=f.write)
+                    self.__check(response, data, url)
+            os.utime(temp_path, (mtime, mtime))  # so the next run recognises it as unchanged
+            os.replace(temp_path, local_path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(temp_path)
+            raise
+        with self.lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += size
+
+    def upload(self, names: tuple[str, ...], local_path: str):
+        boundary = 'webdir-' + secrets.token_hex(8)
+        filename = names[-1].replace('"', '%22')
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="action"\r\n\r\nupload\r\n'
+                f'--{boundary}\r\nContent-Disposition: form-data; name="target"\r\n\r\n.\r\n'
+                f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        size = os.path.getsize(local_path)
+
+        def body():
+            yield head
+            with open(local_path, 'rb') as f:
+                while chunk := f.read(self.CHUNK_SIZE):
+                    yield chunk
+            yield tail
+        response, data = self.request('POST', self.url(*names[:-1]) + '/?action=upload&target=.', {
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'Content-Length': str(len(head) + size + len(tail)),
+        }, body)
+        self.__check(response, data, local_path)
+        with self.lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += size
+
+    def mkdir(self, names: tuple[str, ...]):
+        from urllib.parse import urlencode
+        response, data = self.request('POST', self.url(*names[:-1]) + '/', {
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }, urlencode([('action', 'new_folder'), ('target', '.'), ('name', names[-1])]).encode())
+        if response.status != 400:  # already exists
+            self.__check(response, data, '/'.join(names))
+
+    def __make_base(self):
+        # the remote directory is created from its deepest existing ancestor, the server creates the rest
+        from urllib.parse import urlencode
+        names = [name for name in self.path.split('/') if name]
+        for i in range(len(names), 0, -1):
+            parent = urlquote('/'.join(['', *names[:i - 1], '']))
+            response, _ = self.request('GET', urlquote('/'.join(['', *names[:i], ''])) + '?json')
+            if response.status != 404:
+                break
+            response, data = self.request('GET', parent + '?json')
+            if response.status == 404:
+                continue
+            response, data = self.request('POST', parent, {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            }, urlencode([('action', 'new_folder'), ('target', '.'), ('name', '/'.join(names[i - 1:]))]).encode())
+            self.__check(response, data, self.path)
+            break
 
-    if isfile(key_path):
-        key = import_key(root_ca_key_path)
-    else:
-        print(f'TLS: generating {key_path}')
-        key = generate_key()
-        export_key(key, key_path)
-        assert isfile(key_path), repr(key_path)
-        os.chmod(key_path, 0o600)
-        is_cert_dirty = True
-
-    if isfile(cert_path):
-        cert = import_certificate(cert_path)
-        remain = cert.not_valid_after_utc - datetime.now(timezone.utc)
-        if remain < timedelta(days=365):
-            print(f'TLS: renewing {cert_path}')
-            os.remove(cert_path)
-
-    if not isfile(cert_path) or is_cert_dirty:
-        print(f'TLS: generating {cert_path}')
-        cert = sign_usr_cert_has_san(
-            certificate_builder(cert_cn, key, root_ca_name, root_ca_key, 397),
-            subject_key=key, issuer_key=root_ca_key, san=[x509.DNSName(cert_cn)],
-        )
-        export_certificate(cert, cert_path)
-        assert isfile(cert_path), repr(cert_path)
-        is_cert_dirty = True
+    def get(self, local_root: str, executor, part_executor):
+        futures = []
+        for names, entries in self.walk():
+            directory = os.path.join(local_root, *names)
+            os.makedirs(directory, exist_ok=True)
+            for name, entry in entries.items():
+                if entry['type'] != Constant.ENTRY_TYPE_FILE:
+                    continue
+                local_path = os.path.join(directory, name)
+                with suppress(OSError):
+                    stat = os.stat(local_path)
+                    if stat.st_size == entry['size'] and int(stat.st_mtime) == int(entry['mtime']):
+                        self.stats['skipped'] += 1
+                        continue
+                futures.append(executor.submit(self.download, (*names, name), local_path, entry['size'],
+                                               entry['mtime'], part_executor))
+        return futures
+
+    def put(self, local_root: str, executor):
+        futures = []
+        self.__make_base()
+        remote = dict(self.walk())
+        for prefix, dirnames, filenames in os.walk(local_root):
+            names = tuple(filter(None, os.path.relpath(prefix, local_root).split(os.sep)))
+            names = () if names == ('.',) else names
+            entries = remote.get(names, {})
+            for dirname in dirnames:
+                if entries.get(dirname, {}).get('type') != Constant.ENTRY_TYPE_DIRECTORY:
+                    self.mkdir((*names, dirname))
+            for filename in filenames:
+                local_path = os.path.join(prefix, filename)
+                entry = entries.get(filename)
+                # uploads get a new mtime, so unchanged means same size and not modified since
+                if entry is not None and entry['size'] == os.path.getsize(local_path) \
+                        and entry['mtime'] >= os.path.getmtime(local_path):
+                    self.stats['skipped'] += 1
+                    continue
+                futures.append(executor.submit(self.upload, (*names, filename), local_path))
+        return futures
 
-    if not isfile(fullchain_path) or is_cert_dirty:
-        print(f'TLS: generating {fullchain_path}')
-        with open(cert_path) as in1, open(root_ca_cert_path) as in2, open(fullchain_path, 'w') as out:
-            out.write(in1.read())
-            out.write(in2.read())
-        assert isfile(fullchain_path), repr(fullchain_path)
+    @classmethod
+    def main(cls, argv: list[str]):
+        parser = ArgumentParser(prog='webdir.py client', description='transfer files to and from a webdir server')
+        parser.add_argument('command', choices=['ls', 'get', 'put'])
+        parser.add_argument('url', help='http(s)://host:port/path/ of a remote directory')
+        parser.add_argument('local', nargs='?', default='.', help='local directory (get, put)')
+        parser.add_argument('--auth', type=str, metavar='USER:PASS', help='basic authentication')
+        parser.add_argument('--jobs', '-j', type=int, default=8, help='concurrent connections')
+        parser.add_argument('--insecure', '-k', action='store_true', help='do not verify the TLS certificate')
+        args = parser.parse_args(argv)
+
+        if args.auth == 'PROMPT' or args.auth and args.auth.endswith(':PROMPT'):
+            username = args.auth.partition(':')[0] if args.auth != 'PROMPT' else input('username: ')
+            args.auth = '{}:{}'.format(username, getpass.getpass('password: '))
+        try:
+            cls(args.url, args.auth, args.jobs, args.insecure).__run(args)
+        except (OSError, ValueError) as e:
+            print(f'error: {e}', file=sys.stderr)
+            sys.exit(1)
 
-    print(f'TLS: using fullchain: {fullchain_path}')
-    print(f'TLS: using key: {key_path}')
-    return fullchain_path, key_path
+    def __run(self, args):
+        from concurrent.futures import ThreadPoolExecutor
+        if args.command == 'ls':
+            for name, entry in self.list().items():
+                is_dir = entry['type'] == Constant.ENTRY_TYPE_DIRECTORY
+                print('{:>10}  {}  {}'.format('-' if is_dir else Format.size(entry['size']), Format.date(entry['mtime']),
+                                              name + '/' * is_dir))
+            return
+
+        started = time.perf_counter()
+        # files and the ranges of large files use separate pools, so a file never waits on its own parts
+        with ThreadPoolExecutor(args.jobs) as executor, ThreadPoolExecutor(args.jobs) as part_executor:
+            if args.command == 'get':
+                futures = self.get(args.local, executor, part_executor)
+            else:
+                futures = self.put(args.local, executor)
+            for future in futures:
+                try:
+                    future.result()
+                except OSError as e:
+                    self.stats['failed'] += 1
+                    print(f'error: {e}', file=sys.stderr)
+        elapsed = time.perf_counter() - started
+        print(json.dumps({
+            **self.stats,
+            'seconds': round(elapsed, 3),
+            'mib_per_second': round(self.stats['bytes'] / elapsed / 2 ** 20, 2) if elapsed else None,
+        }))
+        if self.stats['failed']:
+            sys.exit(1)
 
 
 def app():
-    return create_fastapi_app(
+    if os.environ.get('WEBDIR_WORKER'):
+        # a worker of main(): rebuild the app from the parent's command line and the current --config
+        worker = json.loads(os.environ['WEBDIR_WORKER'])
+        return main(worker['argv'], worker['basic_auth'])
+    auth = None
+    if os.environ.get('WEBDIR_BASIC_AUTH'):
+        username, _, password = os.environ['WEBDIR_BASIC_AUTH'].partition(':')
+        auth = Auth({username: Auth.hash_password(password)})
+    elif os.environ.get('WEBDIR_AUTH_FILE'):
+        auth = Auth(Auth.load_users(os.environ['WEBDIR_AUTH_FILE']))
+    create_app = create_fastapi_app if os.environ.get('WEBDIR_CORE') == 'fastapi' else create_asgi_app
+    return create_app(
         os.environ.get('WEBDIR_ROOT', '.'),
-        os.environ.get('WEBDIR_BASIC_AUTH'),
+        os.environ.get('WEBDIR_BASE_PATH', '/'),
+        auth,
         os.environ.get('WEBDIR_NO_LIST') is not None,
         os.environ.get('WEBDIR_NO_MODIFY') is not None,
+        os.environ.get('WEBDIR_CREATE_WRITABLE') is not None,
+        os.environ.get('WEBDIR_INDEX_FILE'),
     )
 
 
-def main():
+def main(argv: Optional[list[str]] = None, resolved_basic_auth: Optional[dict[str, list]] = None):
+    # workers pass their parent's command line and resolved --basic-auth values, and get the app back
+    worker = argv is not None
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['client']:
+        return Client.main(argv[1:])
+
     @dataclass
     class Config:
         root: str
         host: str
         port: int
         https: bool
-        https_host: str
+        https_host: list[str]
+        tls_min: str
         basic_auth: str
+        auth_file: str
+        session_ttl: int
+        hash_password: bool
         no_list: bool
         no_modify: bool
         workers: int
         create_writable: bool
         base_path: str
         index_file: str
+        rate_limit: str
+        max_downloads: int
+        bandwidth: str
+        max_expensive: int
+        fsync: str
+        dedup: str
+        upload_hash: str
+        offload: str
+        offload_prefix: str
+        uds: str
+        core: str
+        admin: list[str]
+        profile: bool
+        profile_dir: str
+        profile_threshold: float
+        profile_interval: float
+        large_transfer: str
+        file_cache: str
+        file_cache_max: str
+        file_cache_inotify: bool
+        replicate_to: list[str]
+        replicate_auth: str
+        replicate_interval: float
+        replicate_peer: list[str]
+        quota: list[str]
+        user_quota: list[str]
+        min_free: str
+        trash: bool
+        trash_retention: float
+        trash_max: str
+        trash_rate: float
+        access_log: str
+        audit_log: str
+        log_max_size: str
+        log_max_age: float
+        log_keep: int
+        log_queue: int
+        prewarm: list[str]
+        prewarm_depth: int
+        prewarm_jobs: int
+        prewarm_interval: float
+        config: str
 
     def _path_type(path):
         assert os.path.exists(path), f'path {path!r} does not exist'
@@ -1510,35 +5447,144 @@ def main():
         parser.add_argument('--host', type=str,
                             default='0.0.0.0', help='bind host')
         parser.add_argument('--port', type=int, default=9999, help='bind port')
+        parser.add_argument('--uds', type=str, metavar='PATH', help='bind to a unix domain socket instead')
+        parser.add_argument('--core', type=str, choices=['asgi', 'fastapi'], default='asgi',
+                            help='serve with the built-in ASGI core or through FastAPI routing')
         parser.add_argument('--https', action='store_true', help='enable TLS')
-        parser.add_argument('--https-host', type=str, metavar='HOST',
-                            help='specified hostname for certificate')
+        parser.add_argument('--https-host', type=str, action='append', metavar='HOST',
+                            help='hostname or IP for the certificate, the first one is its CN (repeatable)')
+        parser.add_argument('--tls-min', type=str, choices=['1.2', '1.3'], default='1.2',
+                            help='lowest TLS version accepted')
         parser.add_argument('--basic-auth', type=str,
                             metavar='<USER:PASS>', help='authentication')
+        parser.add_argument('--auth-file', type=str, metavar='FILE',
+                            help='authenticate against <USER>:<HASH> lines (see --hash-password)')
+        parser.add_argument('--session-ttl', type=int, default=12 * 3600, metavar='SECONDS',
+                            help='lifetime of the signed session cookie issued after login')
+        parser.add_argument('--hash-password', action='store_true',
+                            help='prompt for a password, print an --auth-file line and exit')
         parser.add_argument('--no-list', '-L', action='store_true',
                             help='disable directory listing')
         parser.add_argument('--no-modify', '-M', action='store_true',
                             help='disable modification feature')
-        parser.add_argument('--workers', '-w', type=int, default=8,
-                            metavar='N', help='number of workers')
+        parser.add_argument('--workers', '-w', type=int, default=1,
+                            metavar='N', help='number of worker processes (SIGHUP replaces them one at a time)')
         parser.add_argument('--create-writable', '-W', action='store_true',
                             help='create writable directories and files for others')
         parser.add_argument('--base-path', '-P', type=str, default='/',
                             help='base path for the application')
         parser.add_argument('--index-file', '-I', type=str,
                             help='if a directory is requested, serve the index file by default')
-        args = parser.parse_args()
+        parser.add_argument('--rate-limit', type=str, metavar='RATE[/BURST]',
+                            help='requests per second allowed per client (user, or IP if anonymous)')
+        parser.add_argument('--max-downloads', type=int, metavar='N',
+                            help='concurrent downloads allowed per client')
+        parser.add_argument('--bandwidth', type=str, metavar='SIZE',
+                            help='download bytes per second allowed per client, e.g. 10M')
+        parser.add_argument('--max-expensive', type=int, metavar='N',
+                            help='server-wide cap on concurrent expensive actions (recursive delete, archives)')
+        parser.add_argument('--fsync', type=str, default=Durability.NONE.value,
+                            choices=[durability.value for durability in Durability],
+                            help='durability of uploads: none, fdatasync each file, or batch per request')
+        parser.add_argument('--dedup', type=str, choices=['hardlink', 'reflink'],
+                            help=f'store identical uploads once under {Constant.STATE_DIR_NAME}/store and link them into place')
+        parser.add_argument('--upload-hash', type=str, choices=Checksum.ALGORITHMS,
+                            help='compute and cache this digest while uploads stream in')
+        parser.add_argument('--offload', type=str, choices=['nginx', 'sendfile'],
+                            help='let the reverse proxy send file contents (X-Accel-Redirect or X-Sendfile)')
+        parser.add_argument('--offload-prefix', type=str, default='/', metavar='URI',
+                            help='internal nginx location that aliases the document root')
+        parser.add_argument('--admin', type=str, action='append', metavar='USER',
+                            help=f'open the {Constant.STATE_DIR_NAME}/ admin endpoints to this user, they are closed '
+                                 f'to everyone without it (repeatable)')
+        parser.add_argument('--profile', action='store_true',
+                            help=f'sample requests and save slow ones (also toggled at {Constant.STATE_DIR_NAME}/profile)')
+        parser.add_argument('--profile-dir', type=str, metavar='DIR',
+                            help=f'where slow request profiles go (default: {Constant.STATE_DIR_NAME}/profiles)')
+        parser.add_argument('--profile-threshold', type=float, default=500, metavar='MS',
+                            help='save profiles of requests slower than this')
+        parser.add_argument('--profile-interval', type=float, default=5, metavar='MS',
+                            help='stack sampling interval')
+        parser.add_argument('--large-transfer', type=str, default='64M', metavar='SIZE',
+                            help='stream transfers of at least this size past the page cache with fadvise hints (0: off)')
+        parser.add_argument('--file-cache', type=str, default='0', metavar='SIZE',
+                            help='keep up to this many bytes of small, hot files in memory (0: off)')
+        parser.add_argument('--file-cache-max', type=str, default='256K', metavar='SIZE',
+                            help='largest file the cache holds')
+        parser.add_argument('--file-cache-inotify', action='store_true',
+                            help='invalidate cached files by inotify instead of a stat per request')
+        parser.add_argument('--replicate-to', type=str, action='append', metavar='URL',
+                            help='ship uploads, new folders, moves and deletes to this peer webdir (repeatable, '
+                                 'give every node all the others)')
+        parser.add_argument('--replicate-auth', type=str, metavar='<USER:PASS>',
+                            help='credentials for the peers, a --replicate-peer user there')
+        parser.add_argument('--replicate-interval', type=float, default=300, metavar='SECONDS',
+                            help=f'anti-entropy pass with each peer (0: only on POST {Constant.STATE_DIR_NAME}/replication)')
+        parser.add_argument('--replicate-peer', type=str, action='append', metavar='USER',
+                            help='accept replication from peers authenticated as this user (repeatable, '
+                                 'nothing is accepted without it)')
+        parser.add_argument('--quota', type=str, action='append', metavar='DIR=SIZE',
+                            help='limit the bytes under a directory of the root (repeatable)')
+        parser.add_argument('--user-quota', type=str, action='append', metavar='[USER=]SIZE',
+                            help='limit the bytes of files a user uploaded, without USER for every user (repeatable)')
+        parser.add_argument('--min-free', type=str, default='0', metavar='SIZE',
+                            help='refuse uploads that would leave less free disk space than this')
+        parser.add_argument('--trash', action='store_true',
+                            help=f'delete by moving into {Constant.STATE_DIR_NAME}/trash, purged in the background '
+                                 f'(undo at {Constant.STATE_DIR_NAME}/trash)')
+        parser.add_argument('--trash-retention', type=float, default=86400, metavar='SECONDS',
+                            help='how long deleted entries can be restored')
+        parser.add_argument('--trash-max', type=str, metavar='SIZE',
+                            help='purge the oldest entries early when the trash grows over this')
+        parser.add_argument('--trash-rate', type=float, default=1000, metavar='N',
+                            help='files removed per second by the purger')
+        parser.add_argument('--access-log', type=str, metavar='FILE',
+                            help="JSON lines for every request, instead of uvicorn's access log ('-' for stdout)")
+        parser.add_argument('--audit-log', type=str, metavar='FILE',
+                            help='JSON lines for every upload, move, delete and other change, with the user')
+        parser.add_argument('--log-max-size', type=str, default='64M', metavar='SIZE',
+                            help='rotate a log file at this size (0: never)')
+        parser.add_argument('--log-max-age', type=float, default=86400, metavar='SECONDS',
+                            help='rotate a log file this long after it was opened (0: never)')
+        parser.add_argument('--log-keep', type=int, default=5, metavar='N',
+                            help='rotated files kept per log')
+        parser.add_argument('--log-queue', type=int, default=10000, metavar='N',
+                            help='records waiting for the writer before new ones are dropped (and counted)')
+        parser.add_argument('--prewarm', type=str, action='append', metavar='PATH',
+                            help='walk this directory of the root in the background at startup, so its first '
+                                 'listings are not cold (repeatable)')
+        parser.add_argument('--prewarm-depth', type=int, default=2, metavar='N',
+                            help='levels of subdirectories walked below each --prewarm path')
+        parser.add_argument('--prewarm-jobs', type=int, default=8, metavar='N',
+                            help='directories scanned concurrently')
+        parser.add_argument('--prewarm-interval', type=float, default=3600, metavar='SECONDS',
+                            help=f'walk again this often (0: only at startup and on POST {Constant.STATE_DIR_NAME}/prewarm)')
+        parser.add_argument('--config', type=str, metavar='FILE',
+                            help='JSON object of options by long name, under the command line; re-read on SIGHUP')
+        args = parser.parse_args(argv)
+        if args.config is not None:
+            try:
+                with open(args.config) as f:
+                    values = json.load(f)
+                assert isinstance(values, dict), 'expected a JSON object'
+            except (OSError, ValueError, AssertionError) as e:
+                parser.error(f'cannot load --config: {e}')
+            defaults = {}
+            for key, value in values.items():
+                key = key.replace('-', '_')
+                if key not in vars(args) or key == 'config':
+                    parser.error(f'unknown option in --config: {key}')
+                defaults[key] = value
+            parser.set_defaults(**defaults)
+            args = parser.parse_args(argv)
         return Config(**vars(args))
 
-    cfg = _parse_args()
-
-    basic_auth_show_password = False
-
-    if cfg.basic_auth is not None:
+    def _resolve_basic_auth(value: str) -> tuple[str, bool]:
         BASIC_AUTH_PROMPT = 'PROMPT'
         BASIC_AUTH_RANDOM = 'RANDOM'
-        basic_auth_tuple = cfg.basic_auth.split(':')
-        if len(basic_auth_tuple) == 1 and cfg.basic_auth == BASIC_AUTH_PROMPT:
+        basic_auth_show_password = False
+        basic_auth_tuple = value.split(':')
+        if len(basic_auth_tuple) == 1 and value == BASIC_AUTH_PROMPT:
             username = input('username: ')
             password = getpass.getpass('password: ')
         elif len(basic_auth_tuple) != 2:
@@ -1562,37 +5608,223 @@ def main():
                 basic_auth_show_password = True
             else:
                 password = basic_auth_tuple[1]
-        cfg.basic_auth = '{}:{}'.format(username, password)
+        return '{}:{}'.format(username, password), basic_auth_show_password
+
+    # PROMPT and RANDOM are resolved once, reloads and workers reuse the answer
+    resolved_basic_auth = dict(resolved_basic_auth or {})
+
+    def _load_config() -> tuple[Config, bool]:
+        cfg = _parse_args()
+        basic_auth_show_password = False
+        if cfg.basic_auth is not None:
+            if cfg.basic_auth not in resolved_basic_auth:
+                resolved_basic_auth[cfg.basic_auth] = _resolve_basic_auth(cfg.basic_auth)
+            cfg.basic_auth, basic_auth_show_password = resolved_basic_auth[cfg.basic_auth]
+        if cfg.https_host is not None:
+            cfg.https = True
+        return cfg, basic_auth_show_password
+
+    # hashed once per --basic-auth value, so a reload that keeps the password keeps its sessions
+    basic_auth_hashes = {}
+
+    def _load_users(cfg: Config) -> dict[str, str]:
+        users = {}
+        if cfg.auth_file is not None:
+            try:
+                users.update(Auth.load_users(cfg.auth_file))
+            except (OSError, ValueError) as e:
+                print(f'error: cannot load --auth-file: {e}')
+                sys.exit(1)
+        if cfg.basic_auth is not None:
+            username, _, password = cfg.basic_auth.partition(':')
+            if cfg.basic_auth not in basic_auth_hashes:
+                basic_auth_hashes[cfg.basic_auth] = Auth.hash_password(password)
+            users[username] = basic_auth_hashes[cfg.basic_auth]
+        return users
+
+    # changes to these take effect on SIGHUP, everything else needs a restart (or --workers > 1)
+    RELOADABLE = ('basic_auth', 'auth_file', 'session_ttl', 'no_list', 'no_modify', 'create_writable', 'index_file')
+
+    if not worker and _parse_args().hash_password:
+        username = input('username: ')
+        password = getpass.getpass('password: ')
+        print('{}:{}'.format(username, Auth.hash_password(password)))
+        return
+
+    cfg, basic_auth_show_password = _load_config()
+
+    users = _load_users(cfg)
+    auth = Auth(users, session_ttl=cfg.session_ttl) if users else None
+
+    limiter = None
+    if cfg.rate_limit or cfg.max_downloads or cfg.bandwidth or cfg.max_expensive:
+        try:
+            request_rate, _, request_burst = (cfg.rate_limit or '').partition('/')
+            limiter = Limiter(
+                request_rate=float(request_rate) if request_rate else None,
+                request_burst=float(request_burst) if request_burst else None,
+                max_downloads=cfg.max_downloads,
+                bandwidth=parse_size(cfg.bandwidth) if cfg.bandwidth else None,
+                max_expensive=cfg.max_expensive,
+            )
+        except ValueError as e:
+            print(f'error: invalid limit: {e}')
+            sys.exit(1)
 
-    if cfg.https_host is not None:
-        cfg.https = True
+    try:
+        large_transfer = parse_size(cfg.large_transfer)
+        file_cache_size = parse_size(cfg.file_cache)
+        file_cache_max = parse_size(cfg.file_cache_max)
+        min_free = parse_size(cfg.min_free)
+        trash_max = parse_size(cfg.trash_max) if cfg.trash_max else None
+        log_max_size = parse_size(cfg.log_max_size)
+        quotas = {}
+        for value in cfg.quota or ():
+            path, _, size = value.rpartition('=')
+            quotas[path or '.'] = parse_size(size)
+        user_quotas = {}
+        for value in cfg.user_quota or ():
+            user, _, size = value.rpartition('=')
+            user_quotas[user or '*'] = parse_size(size)
+    except ValueError as e:
+        print(f'error: {e}')
+        sys.exit(1)
+
+    for url in cfg.replicate_to or ():
+        if not re.match(r'https?://', url):
+            print(f'error: unsupported --replicate-to url: {url}')
+            sys.exit(1)
+    unknown_peers = set(cfg.replicate_peer or ()) - users.keys()
+    if unknown_peers:
+        print(f'error: --replicate-peer needs a user from --basic-auth or --auth-file: {", ".join(sorted(unknown_peers))}')
+        sys.exit(1)
+
+    if cfg.workers > 1:
+        # these keep their state in one process
+        shared = [option for option, value in (('--replicate-to', cfg.replicate_to),
+                                               ('--replicate-peer', cfg.replicate_peer), ('--quota', cfg.quota),
+                                               ('--user-quota', cfg.user_quota), ('--trash', cfg.trash),
+                                               ('--access-log', cfg.access_log), ('--audit-log', cfg.audit_log))
+                  if value]
+        if shared:
+            print(f'error: --workers > 1 cannot be combined with {", ".join(shared)}')
+            sys.exit(1)
 
-    for key, value in vars(cfg).items():
-        if key == 'basic_auth' and value and not basic_auth_show_password:
-            value = value.split(':')[0] + ':[redacted]'
-        print('CONFIG: {} = {}'.format(key, j(value)))
+    if not worker:
+        for key, value in vars(cfg).items():
+            if key == 'replicate_auth' and value:
+                value = value.split(':')[0] + ':[redacted]'
+            if key == 'basic_auth' and value and not basic_auth_show_password:
+                value = value.split(':')[0] + ':[redacted]'
+            print('CONFIG: {} = {}'.format(key, j(value)))
+
+    try:
+        import uvicorn
+        import importlib.util
+        # starlette parses forms with it, only on the first form request
+        if importlib.util.find_spec('multipart') is None:
+            raise ImportError("No module named 'multipart'", name='multipart')
+    except ImportError as e:
+        exit_with_package_import_error(e)
 
     uvicorn_kwargs = {
-        'app': create_fastapi_app(
-            cfg.root,
-            cfg.base_path,
-            cfg.basic_auth,
-            cfg.no_list,
-            cfg.no_modify,
-            cfg.create_writable,
-            cfg.index_file,
-        ),
         'host': cfg.host,
         'port': cfg.port,
+        'access_log': not cfg.access_log,
     }
 
+    if cfg.uds:
+        uvicorn_kwargs['uds'] = cfg.uds
+
+    tls = None
     if cfg.https:
-        (
-            uvicorn_kwargs['ssl_certfile'],
-            uvicorn_kwargs['ssl_keyfile'],
-        ) = generate_certificates(cfg.host, cfg.https_host)
+        tls = TLSContext(CertificateManager(CertificateManager.server_names(cfg.host, cfg.https_host)), cfg.tls_min)
+        uvicorn_kwargs['ssl_context_factory'] = tls
+
+    if cfg.workers > 1 and not worker:
+        # the parent only supervises: every worker builds its own app through app(), and on SIGHUP
+        # uvicorn starts a replacement before it stops each old worker, which finishes its requests first
+        if cfg.https:
+            tls.certificates.issue()
+        os.environ['WEBDIR_WORKER'] = json.dumps({'argv': argv, 'basic_auth': resolved_basic_auth})
+        script_dir, script_name = os.path.split(os.path.abspath(__file__))
+        uvicorn.run('{}:app'.format(os.path.splitext(script_name)[0]), factory=True, app_dir=script_dir,
+                    workers=cfg.workers, **uvicorn_kwargs)
+        return
 
-    uvicorn.run(**uvicorn_kwargs)
+    create_app = create_fastapi_app if cfg.core == 'fastapi' else create_asgi_app
+    app = create_app(
+        cfg.root,
+        cfg.base_path,
+        auth,
+        cfg.no_list,
+        cfg.no_modify,
+        cfg.create_writable,
+        cfg.index_file,
+        limiter=limiter,
+        durability=Durability(cfg.fsync),
+        dedup=cfg.dedup,
+        upload_hash=cfg.upload_hash,
+        offload=cfg.offload,
+        offload_prefix=cfg.offload_prefix,
+        admins=set(cfg.admin) if cfg.admin else None,
+        profile=cfg.profile,
+        profile_dir=cfg.profile_dir,
+        profile_threshold=cfg.profile_threshold,
+        profile_interval=cfg.profile_interval,
+        large_transfer=large_transfer,
+        file_cache=FileCache(file_cache_size, file_cache_max, cfg.file_cache_inotify) if file_cache_size else None,
+        replicate_to=tuple(cfg.replicate_to or ()),
+        replicate_auth=cfg.replicate_auth,
+        replicate_interval=cfg.replicate_interval,
+        replicate_peers=set(cfg.replicate_peer or ()),
+        quotas=quotas,
+        user_quotas=user_quotas,
+        min_free=min_free,
+        trash=cfg.trash,
+        trash_retention=cfg.trash_retention,
+        trash_max=trash_max,
+        trash_rate=cfg.trash_rate,
+        access_log=LogWriter(cfg.access_log, log_max_size, cfg.log_max_age, cfg.log_keep, cfg.log_queue)
+        if cfg.access_log else None,
+        audit_log=LogWriter(cfg.audit_log, log_max_size, cfg.log_max_age, cfg.log_keep, cfg.log_queue)
+        if cfg.audit_log else None,
+        prewarm=tuple(cfg.prewarm or ()),
+        prewarm_depth=cfg.prewarm_depth,
+        prewarm_jobs=cfg.prewarm_jobs,
+        prewarm_interval=cfg.prewarm_interval,
+    )
+    if worker:
+        return app
+    web_app = app if isinstance(app, WebApp) else app.state.web_app
+
+    def _reload():
+        try:
+            new_cfg, _ = _load_config()
+            users = _load_users(new_cfg)
+        except (SystemExit, EOFError):
+            print('RELOAD: error: keeping the current configuration')
+            return
+        for key, value in vars(new_cfg).items():
+            if key not in RELOADABLE and value != getattr(cfg, key):
+                print(f'RELOAD: warning: {key} changes on restart only')
+        web_app.reconfigure(users, new_cfg.session_ttl, no_list=new_cfg.no_list, no_modify=new_cfg.no_modify,
+                            create_writable=new_cfg.create_writable, index_file=new_cfg.index_file)
+        if tls is not None and tls.current is not None:
+            try:
+                tls.reload()
+            except (OSError, ValueError) as e:
+                print(f'RELOAD: error: keeping the current certificate: {e}')
+        print('RELOAD: done')
+
+    def _on_sighup(signum, frame):
+        # handlers run between bytecodes, so move the reload to a callback of the event loop
+        import asyncio
+        with suppress(RuntimeError):
+            asyncio.get_running_loop().call_soon_threadsafe(_reload)
+
+    signal.signal(signal.SIGHUP, _on_sighup)
+    uvicorn.run(app, **uvicorn_kwargs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,857 @@
+#!/usr/bin/env python3
+# Author: djosix
+# License: MIT
+# Description: Benchmarks for webdir.py, results are printed as JSON
+
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import socket
+import threading
+import http.client
+import asyncio
+import tempfile
+import statistics
+import subprocess
+import importlib.util
+from argparse import ArgumentParser
+from contextlib import suppress
+from urllib.parse import quote, unquote, urlencode
+
+
+def load_webdir():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webdir.py')
+    spec = importlib.util.spec_from_file_location('webdir', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['webdir'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+async def asgi_request(app, method: str, url: str, headers: dict = None, body: bytes = b'', keep_body: bool = True):
+    # Drives an ASGI app in-process, without any server or HTTP client; body may also be an iterator of chunks
+    path, _, query = url.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': unquote(path),
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        'client': ('127.0.0.1', 40000),
+        'server': ('localhost', 80),
+    }
+    done = asyncio.Event()
+    chunks = iter([body] if isinstance(body, bytes) else body)
+    pending = next(chunks, b'')
+    request_sent = False
+    response = {'status': None, 'headers': {}, 'body': b'', 'size': 0}
+
+    async def receive():
+        nonlocal pending, request_sent
+        if not request_sent:
+            chunk, pending = pending, next(chunks, None)
+            request_sent = pending is None
+            return {'type': 'http.request', 'body': chunk, 'more_body': not request_sent}
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {k.decode().lower(): v.decode() for k, v in message['headers']}
+        elif message['type'] == 'http.response.body':
+            response['size'] += len(message.get('body', b''))
+            if keep_body:
+                response['body'] += message.get('body', b'')
+            if not message.get('more_body'):
+                done.set()
+
+    await app(scope, receive, send)
+    return response
+
+
+def check_offload(args):
+    webdir = load_webdir()
+    root = tempfile.mkdtemp(prefix='webdir-offload-')
+    os.makedirs(os.path.join(root, 'dir', 'site'))
+    with open(os.path.join(root, 'dir', 'a b.txt'), 'w') as f:
+        f.write('hello')
+    with open(os.path.join(root, 'dir', '文件.txt'), 'w') as f:
+        f.write('hello')
+    with open(os.path.join(root, 'dir', 'site', 'index.html'), 'w') as f:
+        f.write('<html></html>')
+    with open(os.path.join(root, 'secret.txt'), 'w') as f:
+        f.write('secret')
+    os.chmod(os.path.join(root, 'secret.txt'), 0o000)
+    credentials = 'Basic ' + base64.b64encode(b'user:pass').decode()
+
+    def expect(name, response, status, header=None, value=None):
+        ok = response['status'] in (status if isinstance(status, tuple) else (status,))
+        if header is None:
+            ok = ok and 'x-accel-redirect' not in response['headers'] and 'x-sendfile' not in response['headers']
+        else:
+            ok = ok and response['headers'].get(header) == value
+        results.append({'case': name, 'ok': ok, 'status': response['status'],
+                        'headers': {k: v for k, v in response['headers'].items() if k.startswith('x-')}})
+
+    results = []
+    try:
+        for mode, header in (('nginx', 'x-accel-redirect'), ('sendfile', 'x-sendfile')):
+            auth = webdir.Auth({'user': webdir.Auth.hash_password('pass')})
+            app = webdir.create_asgi_app(root, '/files', auth, False, False, False, 'index.html',
+                                            offload=mode, offload_prefix='/protected/')
+            authorized = {'Authorization': credentials}
+
+            def local(relpath):
+                return quote(os.path.join(root, relpath)) if mode == 'sendfile' else '/protected/' + quote(relpath)
+
+            async def run():
+                expect(f'{mode}: file', await asgi_request(app, 'GET', '/files/dir/a%20b.txt', authorized),
+                       200, header, local('dir/a b.txt'))
+                expect(f'{mode}: non-latin-1 name', await asgi_request(app, 'GET', '/files/dir/' + quote('文件.txt'),
+                                                                       authorized), 200, header, local('dir/文件.txt'))
+                expect(f'{mode}: index file', await asgi_request(app, 'GET', '/files/dir/site/', authorized),
+                       200, header, local('dir/site/index.html'))
+                expect(f'{mode}: unauthenticated', await asgi_request(app, 'GET', '/files/dir/a%20b.txt'), 401)
+                expect(f'{mode}: missing', await asgi_request(app, 'GET', '/files/dir/nope', authorized), 404)
+                expect(f'{mode}: traversal', await asgi_request(app, 'GET', '/files/../../etc/passwd', authorized),
+                       (400, 404))
+                expect(f'{mode}: state dir', await asgi_request(app, 'GET', '/files/.webdir/x', authorized),
+                       (403, 404))
+                expect(f'{mode}: listing', await asgi_request(app, 'GET', '/files/dir/', authorized), 200)
+                if os.geteuid() != 0:  # root bypasses permission bits
+                    expect(f'{mode}: unreadable', await asgi_request(app, 'GET', '/files/secret.txt', authorized), 403)
+
+            asyncio.run(run())
+    finally:
+        os.chmod(os.path.join(root, 'secret.txt'), 0o600)
+        shutil.rmtree(root, ignore_errors=True)
+    if not all(result['ok'] for result in results):
+        print(json.dumps({'benchmark': args.benchmark, 'results': results}, indent=2))
+        sys.exit(1)
+    return results
+
+
+def bench_importtime(args):
+    # Modules that must not be imported just to parse the command line
+    deferred = ('fastapi', 'pydantic', 'starlette', 'uvicorn', 'multipart', 'python_multipart',
+                'cryptography', 'markupsafe', 'asyncio', 'sqlite3')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webdir.py')
+
+    def top_level_imports(command):
+        process = subprocess.run([sys.executable, '-X', 'importtime', *command],
+                                 capture_output=True, text=True, check=True)
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if not name.startswith('  '):  # nested imports are part of their parent's cumulative time
+                yield name.strip(), int(cumulative) / 1000
+
+    # imported by the interpreter itself (site, encodings, ...), not by webdir.py
+    baseline = {name for name, _ in top_level_imports(['-c', 'pass'])}
+    walls, totals, modules = [], [], {}
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        imports = [(name, ms) for name, ms in top_level_imports([script, *args.argv]) if name not in baseline]
+        walls.append((time.perf_counter() - start) * 1000)
+        totals.append(sum(ms for _, ms in imports))
+        for name, ms in imports:
+            modules.setdefault(name, []).append(ms)
+    slowest = sorted(((statistics.median(ms), name) for name, ms in modules.items()), reverse=True)[:args.top]
+    result = {
+        'argv': args.argv,
+        'runs': args.runs,
+        'wall_ms_median': round(statistics.median(walls), 1),
+        'import_ms_median': round(statistics.median(totals), 1),
+        'budget_ms': args.max_ms,
+        'slowest_imports': [{'module': name, 'cumulative_ms': round(ms, 1)} for ms, name in slowest],
+        'deferred_but_imported': sorted({name for name in modules if name.split('.')[0] in deferred}),
+    }
+    if result['deferred_but_imported'] or (args.max_ms and result['import_ms_median'] > args.max_ms):
+        print(json.dumps({'benchmark': args.benchmark, 'results': [result]}, indent=2))
+        sys.exit(1)
+    return [result]
+
+
+def generate_tree(root: str, args):
+    # wide: one directory with many entries, deep: a long chain of directories,
+    # small: many small files spread over a few directories, huge: a few large files
+    payload = os.urandom(1024 * 1024)
+    os.makedirs(os.path.join(root, 'wide'))
+    for i in range(args.wide):
+        with open(os.path.join(root, 'wide', f'file-{i:06d}.txt'), 'wb') as f:
+            f.write(payload[:i % 4096])
+    deep = os.path.join(root, 'deep')
+    for i in range(args.depth):
+        deep = os.path.join(deep, f'level-{i:03d}')
+    os.makedirs(deep)
+    for i in range(10):
+        with open(os.path.join(deep, f'leaf-{i}.txt'), 'wb') as f:
+            f.write(payload[:1024])
+    for i in range(args.small):
+        directory = os.path.join(root, 'small', f'dir-{i % 16:02d}')
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'small-{i:06d}.bin'), 'wb') as f:
+            f.write(payload[:1024 + i % 3072])
+    os.makedirs(os.path.join(root, 'huge'))
+    for i in range(args.huge):
+        with open(os.path.join(root, 'huge', f'huge-{i}.bin'), 'wb') as f:
+            for offset in range(0, args.huge_size, len(payload)):
+                f.write(payload[:args.huge_size - offset])
+    for name in ('upload', 'mkdir', 'move', 'moved', 'delete'):
+        os.makedirs(os.path.join(root, 'scratch', name))
+    return deep[len(root):]
+
+
+def multipart_body(fields: list[tuple[str, str]], files: list[tuple[str, str, bytes]]):
+    boundary = 'webdir-bench-' + os.urandom(8).hex()
+    parts = []
+    for name, value in fields:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, content in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def urlencoded_body(fields: list[tuple[str, str]]):
+    return urlencode(fields).encode(), 'application/x-www-form-urlencoded'
+
+
+def read_proc_status(pid: int) -> dict:
+    result = {}
+    with suppress(OSError), open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                result[key] = int(value.split()[0]) * 1024
+    return result
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_scenario(host: str, port: int, concurrency: int, make_request, count: int):
+    # make_request(i) -> (method, url, headers, body); every worker keeps one connection alive
+    latencies, errors, transferred = [], [], [0]
+    lock = threading.Lock()
+    indexes = iter(range(count))
+
+    def worker():
+        connection = http.client.HTTPConnection(host, port, timeout=300)
+        while True:
+            with lock:
+                i = next(indexes, None)
+            if i is None:
+                break
+            method, url, headers, body = make_request(i)
+            start = time.perf_counter()
+            try:
+                connection.request(method, url, body=body, headers=headers)
+                response = connection.getresponse()
+                size = 0
+                while chunk := response.read(1024 * 1024):
+                    size += len(chunk)
+                status = response.status
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=300)
+                status, size = repr(e), 0
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed * 1000)
+                transferred[0] += size + len(body or b'')
+                if status not in (200, 206, 302):
+                    errors.append(status)
+        connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(min(concurrency, count))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': count,
+        'errors': len(errors),
+        'error_samples': [str(e) for e in errors[:5]],
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(count / elapsed, 1),
+        'mib_per_second': round(transferred[0] / elapsed / 2 ** 20, 2),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p99': round(percentile(latencies, 99), 2),
+            'mean': round(statistics.fmean(latencies), 2) if latencies else 0.0,
+            'max': round(max(latencies, default=0.0), 2),
+        },
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(root: str, server_args: list[str], port: int = None, env: dict = None):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webdir.py')
+    port = port or free_port()
+    server = subprocess.Popen([sys.executable, script, root, '--host', '127.0.0.1', '--port', str(port),
+                               *server_args], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              env={**os.environ, **(env or {})})
+    deadline = time.monotonic() + 30
+    while True:
+        with suppress(OSError), socket.create_connection(('127.0.0.1', port), timeout=1):
+            return server, port
+        if server.poll() is not None or time.monotonic() > deadline:
+            server.terminate()
+            raise RuntimeError('server did not start')
+        time.sleep(0.05)
+
+
+def bench_load(args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webdir.py')
+    workdir = tempfile.mkdtemp(prefix='webdir-load-', dir=args.dir)
+    root = os.path.join(workdir, 'root')
+    started = time.perf_counter()
+    deep = generate_tree(root, args)
+    generated = time.perf_counter() - started
+
+    server, port = start_server(root, args.server_args)
+    browser = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) Chrome/120.0'}
+    small_files = sorted(os.path.relpath(os.path.join(prefix, name), root)
+                         for prefix, _, names in os.walk(os.path.join(root, 'small')) for name in names)
+    upload_payload = os.urandom(args.upload_size)
+    n = args.requests
+
+    def get(url, headers=None):
+        return lambda i: ('GET', url, headers or {}, None)
+
+    def form(url, fields_of):
+        def make_request(i):
+            body, content_type = urlencoded_body(fields_of(i))
+            return 'POST', url, {'Content-Type': content_type}, body
+        return make_request
+
+    def upload(i):
+        body, content_type = multipart_body([('action', 'upload'), ('target', '.')],
+                                            [('file', f'upload-{i:06d}.bin', upload_payload)])
+        return 'POST', '/scratch/upload/', {'Content-Type': content_type}, body
+
+    for i in range(n):
+        with open(os.path.join(root, 'scratch', 'move', f'm-{i:06d}'), 'wb') as f:
+            f.write(b'm')
+        os.makedirs(os.path.join(root, 'scratch', 'delete', f'd-{i:06d}', 'sub'))
+        with open(os.path.join(root, 'scratch', 'delete', f'd-{i:06d}', 'sub', 'f'), 'wb') as f:
+            f.write(b'd')
+
+    huge_size = args.huge_size
+    scenarios = {
+        'list_html_wide': (n, get('/wide/', browser)),
+        'list_json_wide': (n, get('/wide/?json')),
+        'list_text_wide': (n, get('/wide/')),
+        'list_html_deep': (n, get(quote(deep) + '/', browser)),
+        'file_small': (n, lambda i: ('GET', '/' + quote(small_files[i % len(small_files)]), {}, None)),
+        'file_range': (n, lambda i: ('GET', '/huge/huge-0.bin',
+                                     {'Range': 'bytes={}-{}'.format(*sorted(((i * 7919 * 4096) % huge_size,
+                                                                            (i * 7919 * 4096) % huge_size + 65535)))},
+                                     None)),
+        'file_huge': (max(1, args.huge), lambda i: ('GET', f'/huge/huge-{i % max(1, args.huge)}.bin', {}, None)),
+        'upload': (n, upload),
+        'mkdir': (n, form('/scratch/mkdir/', lambda i: [('action', 'new_folder'), ('target', '.'),
+                                                        ('name', f'new-{i:06d}')])),
+        'move': (n, form('/scratch/move/', lambda i: [('action', 'move'), ('source', f'm-{i:06d}'),
+                                                      ('target', f'../moved/m-{i:06d}')])),
+        'delete': (n, form('/scratch/delete/', lambda i: [('action', 'delete'), ('name', f'd-{i:06d}')])),
+    }
+    selected = args.scenarios or list(scenarios)
+
+    results = []
+    try:
+        for name in selected:
+            count, make_request = scenarios[name]
+            result = run_scenario('127.0.0.1', port, args.concurrency, make_request, count)
+            memory = read_proc_status(server.pid)
+            result.update({'scenario': name, 'concurrency': args.concurrency,
+                           'server_rss_bytes': memory.get('VmRSS'), 'server_peak_rss_bytes': memory.get('VmHWM')})
+            results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = None
+    with suppress(OSError, subprocess.CalledProcessError):
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(script),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    return {
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'server_args': args.server_args,
+        'tree': {'wide': args.wide, 'depth': args.depth, 'small': args.small,
+                 'huge': args.huge, 'huge_size': args.huge_size, 'generate_seconds': round(generated, 2)},
+        'scenarios': results,
+    }
+
+
+def bench_fsync(args):
+    webdir = load_webdir()
+    workloads = {
+        'small': (args.small_count, args.small_size),
+        'large': (args.large_count, args.large_size),
+    }
+    results = []
+    for workload, (count, size) in workloads.items():
+        payload = os.urandom(min(size, 1024 * 1024))
+        for durability in webdir.Durability:
+            workdir = tempfile.mkdtemp(prefix='webdir-bench-', dir=args.dir)
+            try:
+                start = time.perf_counter()
+                files = []
+                for i in range(count):
+                    file = webdir.AtomicFile(os.path.join(workdir, f'{i:06d}'), 0o644)
+                    remain = size
+                    while remain > 0:
+                        file.write(payload[:remain])
+                        remain -= len(payload)
+                    files.append(file)
+                    if durability != webdir.Durability.BATCH:
+                        # one upload request per file
+                        webdir.AtomicFile.commit_all(files, durability)
+                        files = []
+                webdir.AtomicFile.commit_all(files, durability)
+                elapsed = time.perf_counter() - start
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            results.append({
+                'workload': workload,
+                'durability': durability.value,
+                'files': count,
+                'file_size': size,
+                'seconds': round(elapsed, 4),
+                'files_per_second': round(count / elapsed, 1),
+                'mib_per_second': round(count * size / elapsed / 2 ** 20, 1),
+            })
+    return results
+
+
+def page_cache_residency(path: str) -> float:
+    # fraction of the file's pages in the page cache, from mincore(2); -1 where unsupported
+    import ctypes
+    import mmap
+    size = os.path.getsize(path)
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    if pages == 0:
+        return 1.0
+    with suppress(Exception), open(path, 'rb') as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY) as mm:
+        vector = (ctypes.c_ubyte * pages)()
+        anchor = ctypes.c_char.from_buffer(mm)
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.mincore(ctypes.c_void_p(ctypes.addressof(anchor)), ctypes.c_size_t(size), vector) == 0:
+                return sum(page & 1 for page in vector) / pages
+        finally:
+            del anchor
+    return -1.0
+
+
+def evict(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def bench_pagecache(args):
+    # small-file read latency, and what stays cached, while one large download or upload runs next to it
+    webdir = load_webdir()
+    webdir.import_web_packages()
+    root = tempfile.mkdtemp(prefix='webdir-bench-', dir=args.dir)
+    payload = os.urandom(1024 * 1024)
+    results = []
+    try:
+        os.makedirs(os.path.join(root, 'hot'))
+        hot = []
+        for i in range(args.hot):
+            hot.append(os.path.join(root, 'hot', f'hot-{i:05d}.bin'))
+            with open(hot[-1], 'wb') as f:
+                f.write(payload[i % 4096:i % 4096 + args.hot_size])
+        large = os.path.join(root, 'large.bin')
+        with open(large, 'wb') as f:
+            for offset in range(0, args.large_size, len(payload)):
+                f.write(payload[:args.large_size - offset])
+
+        def upload_body(boundary: str):
+            yield (f'--{boundary}\r\nContent-Disposition: form-data; name="action"\r\n\r\nupload\r\n'
+                   f'--{boundary}\r\nContent-Disposition: form-data; name="target"\r\n\r\nuploaded.bin\r\n'
+                   f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="uploaded.bin"\r\n'
+                   f'Content-Type: application/octet-stream\r\n\r\n').encode()
+            for offset in range(0, args.large_size, len(payload)):
+                yield payload[:args.large_size - offset]
+            yield f'\r\n--{boundary}--\r\n'.encode()
+
+        async def run(app, transfer: str):
+            latencies = []
+            if transfer == 'download':
+                request = asgi_request(app, 'GET', '/large.bin', keep_body=False)
+            else:
+                boundary = 'webdir-bench-' + os.urandom(8).hex()
+                request = asgi_request(app, 'POST', '/', {'Content-Type': f'multipart/form-data; boundary={boundary}'},
+                                       upload_body(boundary))
+            task = asyncio.ensure_future(request)
+            started = time.perf_counter()
+            i = 0
+            while not task.done():
+                start = time.perf_counter()
+                await asgi_request(app, 'GET', '/hot/' + os.path.basename(hot[i % len(hot)]))
+                latencies.append(time.perf_counter() - start)
+                i += 1
+                await asyncio.sleep(0)
+            response = await task
+            assert response['status'] in (200, 302), response
+            return time.perf_counter() - started, latencies
+
+        for transfer in ('download', 'upload'):
+            for hints in (False, True):
+                uploaded = os.path.join(root, 'uploaded.bin')
+                with suppress(FileNotFoundError):
+                    os.remove(uploaded)
+                app = webdir.create_asgi_app(root, '/', None, False, False, False, None,
+                                             large_transfer=args.threshold if hints else 0)
+                evict(large)
+                for path in hot:
+                    with open(path, 'rb') as f:
+                        f.read()
+                elapsed, latencies = asyncio.run(run(app, transfer))
+                results.append({
+                    'transfer': transfer,
+                    'hints': hints,
+                    'size': args.large_size,
+                    'mib_per_second': round(args.large_size / elapsed / 2 ** 20, 1),
+                    'small_reads': len(latencies),
+                    'small_p50_ms': round(percentile(latencies, 50) * 1000, 3),
+                    'small_p99_ms': round(percentile(latencies, 99) * 1000, 3),
+                    'small_max_ms': round(max(latencies, default=0) * 1000, 3),
+                    'large_cached': round(page_cache_residency(large if transfer == 'download' else uploaded), 3),
+                    'hot_cached': round(statistics.mean(page_cache_residency(path) for path in hot), 3),
+                })
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def bench_client(args):
+    # the client subcommand against a local server: one connection against --jobs, and a rerun that skips everything
+    from concurrent.futures import ThreadPoolExecutor
+    webdir = load_webdir()
+    workdir = tempfile.mkdtemp(prefix='webdir-client-', dir=args.dir)
+    root, source = os.path.join(workdir, 'root'), os.path.join(workdir, 'source')
+    payload = os.urandom(1024 * 1024)
+    for i in range(args.files):
+        directory = os.path.join(source, f'dir-{i % 10}', f'sub-{i % 3}')
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'file-{i:05d}.bin'), 'wb') as f:
+            f.write(payload[:args.file_size])
+    with open(os.path.join(source, 'large.bin'), 'wb') as f:
+        for offset in range(0, args.large_size, len(payload)):
+            f.write(payload[:args.large_size - offset])
+    shutil.copytree(source, os.path.join(root, 'tree'))
+    server, port = start_server(root, args.server_args)
+
+    def run(command: str, remote: str, local: str, jobs: int):
+        client = webdir.Client(f'http://127.0.0.1:{port}/{remote}/', connections=jobs)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(jobs) as executor, ThreadPoolExecutor(jobs) as part_executor:
+            if command == 'get':
+                futures = client.get(local, executor, part_executor)
+            else:
+                futures = client.put(local, executor)
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - started
+        return {
+            'command': command,
+            'jobs': jobs,
+            **client.stats,
+            'seconds': round(elapsed, 3),
+            'mib_per_second': round(client.stats['bytes'] / elapsed / 2 ** 20, 1),
+        }
+
+    results = []
+    try:
+        for jobs in (1, args.jobs):
+            local = os.path.join(workdir, f'get-{jobs}')
+            results.append(run('get', 'tree', local, jobs))
+            results[-1]['run'] = 'fresh'
+        results.append(run('get', 'tree', local, args.jobs))
+        results[-1]['run'] = 'unchanged'
+        for jobs in (1, args.jobs):
+            results.append(run('put', f'put-{jobs}', source, jobs))
+            results[-1]['run'] = 'fresh'
+        results.append(run('put', f'put-{args.jobs}', source, args.jobs))
+        results[-1]['run'] = 'unchanged'
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'tree': {'files': args.files, 'file_size': args.file_size, 'large_size': args.large_size},
+        'server_args': args.server_args,
+        'runs': results,
+    }
+
+
+def bench_replication(args):
+    # a full mesh of local nodes: how long until every node holds what was written to one, and the catch-up
+    # of a node that was down while writes happened
+    from concurrent.futures import ThreadPoolExecutor
+    webdir = load_webdir()
+    workdir = tempfile.mkdtemp(prefix='webdir-replication-', dir=args.dir)
+    roots = [os.path.join(workdir, f'node-{i}') for i in range(args.nodes)]
+    ports = [free_port() for _ in roots]
+    source = os.path.join(workdir, 'source')
+    os.makedirs(source)
+    payload = os.urandom(1024 * 1024)
+    for i in range(args.files):
+        with open(os.path.join(source, f'file-{i:05d}.bin'), 'wb') as f:
+            f.write(payload[i % 1024:i % 1024 + args.file_size])
+    servers = {}
+    # every node accepts the others as this user, which may also read the admin endpoints
+    credentials = 'peer:bench'
+
+    def start(i: int):
+        peers = [arg for j, port in enumerate(ports) if j != i
+                 for arg in ('--replicate-to', f'http://127.0.0.1:{port}/')]
+        os.makedirs(roots[i], exist_ok=True)
+        servers[i], _ = start_server(roots[i], [*peers, '--replicate-auth', credentials, '--basic-auth', credentials,
+                                                '--replicate-peer', 'peer', '--admin', 'peer', *args.server_args],
+                                     ports[i])
+
+    def stop(i: int):
+        servers[i].terminate()
+        servers[i].wait()
+
+    def digest(i: int, directory: str) -> dict:
+        client = webdir.Client(f'http://127.0.0.1:{ports[i]}/', credentials)
+        response, data = client.request('GET', f'/.webdir/replicate?path={quote(directory, safe="")}')
+        assert response.status == 200, data
+        return json.loads(data)
+
+    def converge(directory: str, nodes: list[int]) -> float:
+        started = time.perf_counter()
+        expected = digest(0, directory)
+        while any(digest(i, directory) != expected for i in nodes):
+            if time.perf_counter() - started > args.timeout:
+                raise RuntimeError(f'{directory} did not converge in {args.timeout}s')
+            time.sleep(0.05)
+        return time.perf_counter() - started
+
+    def upload(directory: str, port: int) -> float:
+        client = webdir.Client(f'http://127.0.0.1:{port}/{directory}/', credentials, connections=args.jobs)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.jobs) as executor:
+            for future in client.put(source, executor):
+                future.result()
+        return time.perf_counter() - started
+
+    results = []
+    try:
+        for i in range(args.nodes):
+            start(i)
+        written = upload('live', ports[0])
+        lag = converge('live', list(range(1, args.nodes)))
+        results.append({'run': 'live', 'write_seconds': round(written, 3), 'converge_seconds': round(lag, 3),
+                        'files_per_second': round(args.files / (written + lag), 1)})
+
+        down = args.nodes - 1
+        stop(down)
+        written = upload('catch-up', ports[0])
+        started = time.perf_counter()
+        start(down)
+        lag = converge('catch-up', [down])
+        results.append({'run': 'catch-up', 'write_seconds': round(written, 3),
+                        'converge_seconds': round(time.perf_counter() - started, 3)})
+        client = webdir.Client(f'http://127.0.0.1:{ports[0]}/', credentials)
+        results.append({'run': 'status', **json.loads(client.request('GET', '/.webdir/replication')[1])})
+    finally:
+        for i in servers:
+            with suppress(OSError):
+                stop(i)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'nodes': args.nodes,
+        'files': args.files,
+        'file_size': args.file_size,
+        'server_args': args.server_args,
+        'runs': results,
+    }
+
+
+def bench_tls(args):
+    # certificate setup fresh and cached, then connections per second over TLS 1.2 and 1.3,
+    # each with full handshakes and resumed from the previous connection's session
+    import io
+    import ssl
+    from contextlib import redirect_stdout
+    webdir = load_webdir()
+    workdir = tempfile.mkdtemp(prefix='webdir-tls-', dir=args.dir)
+    root, home = os.path.join(workdir, 'root'), os.path.join(workdir, 'home')
+    os.makedirs(root)
+    os.makedirs(home)
+    with open(os.path.join(root, 'small.txt'), 'wb') as f:
+        f.write(b'x' * 100)
+    server_args = ['--https', '--https-host', 'localhost', *args.server_args]
+    results = []
+    server = None
+
+    def handshakes(version: ssl.TLSVersion, resume: bool) -> dict:
+        context = ssl.create_default_context(cafile=os.path.join(home, '.webdir', 'root_ca', 'cert.pem'))
+        context.minimum_version = context.maximum_version = version
+        session, reused, latencies = None, 0, []
+        started = time.perf_counter()
+        for _ in range(args.count):
+            began = time.perf_counter()
+            with socket.create_connection(('127.0.0.1', port)) as raw:
+                # or the request waits behind the resumed handshake's last flight for a delayed ACK
+                raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock = context.wrap_socket(raw, server_hostname='localhost', session=session)
+                latencies.append(time.perf_counter() - began)
+                reused += sock.session_reused
+                # TLS 1.3 tickets arrive after the handshake, so a request is made before taking the session
+                sock.sendall(b'GET /small.txt HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+                while sock.recv(65536):
+                    pass
+                if resume:
+                    session = sock.session
+                sock.close()
+        elapsed = time.perf_counter() - started
+        return {
+            'version': version.name,
+            'resume': resume,
+            'connections_per_second': round(args.count / elapsed, 1),
+            'handshake_p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'handshake_p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'reused': reused,
+        }
+
+    saved_home = os.environ['HOME']
+    try:
+        os.environ['HOME'] = home
+        for run in ('fresh', 'cached'):
+            started = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                webdir.CertificateManager(['localhost', '127.0.0.1', '::1']).issue()
+            results.append({'run': f'certificates-{run}', 'ms': round((time.perf_counter() - started) * 1000, 3)})
+        os.environ['HOME'] = saved_home
+        server, port = start_server(root, server_args, env={'HOME': home})
+        for version in (ssl.TLSVersion.TLSv1_2, ssl.TLSVersion.TLSv1_3):
+            for resume in (False, True):
+                results.append({'run': 'handshakes', **handshakes(version, resume)})
+    finally:
+        os.environ['HOME'] = saved_home
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'count': args.count,
+        'server_args': server_args,
+        'runs': results,
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_fsync = subparsers.add_parser('fsync', help='throughput of the upload durability policies')
+    parser_fsync.add_argument('--dir', type=str, help='directory on the filesystem to test (default: $TMPDIR)')
+    parser_fsync.add_argument('--small-count', type=int, default=1000)
+    parser_fsync.add_argument('--small-size', type=int, default=4096)
+    parser_fsync.add_argument('--large-count', type=int, default=4)
+    parser_fsync.add_argument('--large-size', type=int, default=256 * 1024 * 1024)
+    parser_fsync.set_defaults(func=bench_fsync)
+
+    parser_importtime = subparsers.add_parser('importtime', help='startup import cost, fails on regressions')
+    parser_importtime.add_argument('--runs', type=int, default=5)
+    parser_importtime.add_argument('--top', type=int, default=10)
+    parser_importtime.add_argument('--max-ms', type=float, default=50.0,
+                                   help='budget for the median total import time')
+    parser_importtime.add_argument('argv', nargs='*', default=['--help'], help='arguments for webdir.py')
+    parser_importtime.set_defaults(func=bench_importtime)
+
+    parser_load = subparsers.add_parser('load', help='latency, throughput and memory of every action')
+    parser_load.add_argument('--dir', type=str, help='where to generate the synthetic tree (default: $TMPDIR)')
+    parser_load.add_argument('--wide', type=int, default=5000, help='entries in the wide directory')
+    parser_load.add_argument('--depth', type=int, default=32, help='depth of the deep tree')
+    parser_load.add_argument('--small', type=int, default=2000, help='number of small files')
+    parser_load.add_argument('--huge', type=int, default=2, help='number of huge files')
+    parser_load.add_argument('--huge-size', type=int, default=128 * 1024 * 1024)
+    parser_load.add_argument('--upload-size', type=int, default=64 * 1024)
+    parser_load.add_argument('--requests', '-n', type=int, default=200, help='requests per scenario')
+    parser_load.add_argument('--concurrency', '-c', type=int, default=8)
+    parser_load.add_argument('--scenario', dest='scenarios', action='append', metavar='NAME',
+                             help='run only this scenario (repeatable)')
+    parser_load.add_argument('server_args', nargs='*', help='extra webdir.py arguments, after --')
+    parser_load.set_defaults(func=bench_load)
+
+    parser_pagecache = subparsers.add_parser('pagecache', help='small-file latency next to a large transfer')
+    parser_pagecache.add_argument('--dir', type=str, help='directory on the filesystem to test (default: $TMPDIR)')
+    parser_pagecache.add_argument('--hot', type=int, default=2000, help='number of small, hot files')
+    parser_pagecache.add_argument('--hot-size', type=int, default=16 * 1024)
+    parser_pagecache.add_argument('--large-size', type=int, default=1024 * 1024 * 1024)
+    parser_pagecache.add_argument('--threshold', type=int, default=64 * 1024 * 1024,
+                                  help='--large-transfer of the server when hints are on')
+    parser_pagecache.set_defaults(func=bench_pagecache)
+
+    parser_client = subparsers.add_parser('client', help='the transfer client against a local server')
+    parser_client.add_argument('--dir', type=str, help='where to generate the test tree (default: $TMPDIR)')
+    parser_client.add_argument('--files', type=int, default=1000)
+    parser_client.add_argument('--file-size', type=int, default=16 * 1024)
+    parser_client.add_argument('--large-size', type=int, default=256 * 1024 * 1024)
+    parser_client.add_argument('--jobs', '-j', type=int, default=8)
+    parser_client.add_argument('server_args', nargs='*', help='extra webdir.py arguments, after --')
+    parser_client.set_defaults(func=bench_client)
+
+    parser_replication = subparsers.add_parser('replication', help='convergence and catch-up of local replicas')
+    parser_replication.add_argument('--dir', type=str, help='where the nodes keep their roots (default: $TMPDIR)')
+    parser_replication.add_argument('--nodes', type=int, default=3)
+    parser_replication.add_argument('--files', type=int, default=500)
+    parser_replication.add_argument('--file-size', type=int, default=16 * 1024)
+    parser_replication.add_argument('--jobs', '-j', type=int, default=8)
+    parser_replication.add_argument('--timeout', type=float, default=120)
+    parser_replication.add_argument('server_args', nargs='*', help='extra webdir.py arguments, after --')
+    parser_replication.set_defaults(func=bench_replication)
+
+    parser_tls = subparsers.add_parser('tls', help='--https startup and handshake rate, full and resumed')
+    parser_tls.add_argument('--dir', type=str, help='where the root and certificates go (default: $TMPDIR)')
+    parser_tls.add_argument('--count', type=int, default=500, help='connections per run')
+    parser_tls.add_argument('server_args', nargs='*', help='extra webdir.py arguments, after --')
+    parser_tls.set_defaults(func=bench_tls)
+
+    parser_offload = subparsers.add_parser('check-offload', help='check the headers emitted by --offload modes')
+    parser_offload.set_defaults(func=check_offload)
+
+    args = parser.parse_args()
+    print(json.dumps({'benchmark': args.benchmark, 'results': args.func(args)}, indent=2))
+
+
+if __name__ == '__main__':
+    main()